@@ -0,0 +1,716 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+CouchDB Stand-in
+A small, in-memory, CouchDB-compatible HTTP server used to benchmark the
+service without a real CouchDB. It speaks the subset of the CouchDB API
+that the cloudant client and the Inventory model rely on:
+
+  /_session, /<db> (HEAD/GET/PUT/DELETE), documents, _all_docs,
+  _bulk_docs, _find, _explain, _index, _changes (normal and longpoll)
+  and the /<db>/_partition/<key>/... equivalents.
+
+Run it with:
+  python -m benchmarks.couchdb_standin --port 5984
+"""
+import argparse
+import hashlib
+import json
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit, parse_qsl, unquote
+
+######################################################################
+#  M A N G O   S E L E C T O R S
+######################################################################
+def _type_rank(value):
+    """ Returns the CouchDB collation rank of a JSON value """
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, list):
+        return 4
+    return 5
+
+def _collate(left, right):
+    """ Compares two JSON values using (simplified) CouchDB collation """
+    left_rank, right_rank = _type_rank(left), _type_rank(right)
+    if left_rank != right_rank:
+        return -1 if left_rank < right_rank else 1
+    if left_rank in (1, 2, 3):
+        if left == right:
+            return 0
+        return -1 if left < right else 1
+    if left_rank == 4:
+        for lval, rval in zip(left, right):
+            result = _collate(lval, rval)
+            if result:
+                return result
+        return (len(left) > len(right)) - (len(left) < len(right))
+    return 0
+
+_MISSING = object()
+
+def _field(doc, path):
+    """ Resolves a dotted field path in a document """
+    value = doc
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+def _match_operator(value, operator, argument):
+    """ Applies a single Mango condition operator """
+    if operator == '$exists':
+        return (value is not _MISSING) == bool(argument)
+    if value is _MISSING:
+        return operator == '$ne' or operator == '$nin'
+    if operator == '$eq':
+        return _type_rank(value) == _type_rank(argument) and \
+            _collate(value, argument) == 0
+    if operator == '$ne':
+        return not _match_operator(value, '$eq', argument)
+    if operator in ('$gt', '$gte', '$lt', '$lte'):
+        if _type_rank(value) != _type_rank(argument):
+            return False
+        result = _collate(value, argument)
+        return {'$gt': result > 0, '$gte': result >= 0,
+                '$lt': result < 0, '$lte': result <= 0}[operator]
+    if operator == '$in':
+        return any(_match_operator(value, '$eq', arg) for arg in argument)
+    if operator == '$nin':
+        return not any(_match_operator(value, '$eq', arg) for arg in argument)
+    if operator == '$type':
+        names = {0: 'null', 1: 'boolean', 2: 'number', 3: 'string',
+                 4: 'array', 5: 'object'}
+        return names[_type_rank(value)] == argument
+    if operator == '$not':
+        return not _match_condition(value, argument)
+    raise ValueError('unsupported operator {}'.format(operator))
+
+def _match_condition(value, condition):
+    """ Matches a field value against a condition (literal or operators) """
+    if isinstance(condition, dict) and \
+            condition and all(k.startswith('$') for k in condition):
+        return all(_match_operator(value, op, arg)
+                   for op, arg in condition.items())
+    return _match_operator(value, '$eq', condition)
+
+def matches(doc, selector):
+    """ Returns True if the document satisfies the Mango selector """
+    for key, condition in selector.items():
+        if key == '$and':
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$not':
+            if matches(doc, condition):
+                return False
+        elif not _match_condition(_field(doc, key), condition):
+            return False
+    return True
+
+def selector_fields(selector):
+    """ Returns the set of fields a selector references """
+    fields = set()
+    for key, condition in selector.items():
+        if key in ('$and', '$or', '$nor'):
+            for sub in condition:
+                fields |= selector_fields(sub)
+        elif key == '$not':
+            fields |= selector_fields(condition)
+        else:
+            fields.add(key)
+    return fields
+
+######################################################################
+#  D A T A B A S E
+######################################################################
+class Database():
+    """ An in-memory CouchDB database """
+
+    def __init__(self, name, lock, partitioned=False):
+        self.name = name
+        self.partitioned = partitioned
+        self.docs = {}       # id -> latest revision body (with _id/_rev)
+        self.deleted = {}    # id -> rev of the deletion tombstone
+        self.seq = 0
+        self.changes = {}    # id -> seq of the last change
+        self.indexes = []
+        self.changed = threading.Condition(lock)
+
+    def _next_rev(self, doc_id, body):
+        """ Computes the next revision for a document """
+        current = self.docs.get(doc_id, {}).get('_rev') or \
+            self.deleted.get(doc_id)
+        generation = int(current.split('-')[0]) + 1 if current else 1
+        digest = hashlib.md5(json.dumps(body, sort_keys=True)
+                             .encode('utf8')).hexdigest()
+        return '{}-{}'.format(generation, digest)
+
+    def _record_change(self, doc_id):
+        """ Appends a change for the document to the changes feed """
+        self.seq += 1
+        self.changes[doc_id] = self.seq
+        self.changed.notify_all()
+
+    def current_rev(self, doc_id):
+        """ Returns the current revision of a document, if any """
+        if doc_id in self.docs:
+            return self.docs[doc_id]['_rev']
+        return self.deleted.get(doc_id)
+
+    def put(self, doc):
+        """ Stores a document, returns (status, body) CouchDB style """
+        doc_id = doc.get('_id') or uuid.uuid4().hex
+        if self.partitioned and not doc_id.startswith('_design/') and \
+                ':' not in doc_id:
+            return 400, {'error': 'illegal_docid',
+                         'reason': 'Doc id must be of form partition:id'}
+        existing = self.docs.get(doc_id)
+        if existing is not None and doc.get('_rev') != existing['_rev']:
+            return 409, {'error': 'conflict',
+                         'reason': 'Document update conflict.',
+                         'id': doc_id}
+        if existing is None and doc.get('_rev') and \
+                doc.get('_rev') != self.deleted.get(doc_id):
+            return 409, {'error': 'conflict',
+                         'reason': 'Document update conflict.',
+                         'id': doc_id}
+        body = {k: v for k, v in doc.items() if not k.startswith('_')}
+        rev = self._next_rev(doc_id, body)
+        if doc.get('_deleted'):
+            if existing is None:
+                return 404, {'error': 'not_found', 'reason': 'missing',
+                             'id': doc_id}
+            del self.docs[doc_id]
+            self.deleted[doc_id] = rev
+        else:
+            body['_id'] = doc_id
+            body['_rev'] = rev
+            self.docs[doc_id] = body
+            self.deleted.pop(doc_id, None)
+        self._record_change(doc_id)
+        return 201, {'ok': True, 'id': doc_id, 'rev': rev}
+
+    def sorted_ids(self, prefix=None):
+        """ Returns document ids in _all_docs order """
+        ids = sorted(self.docs)
+        if prefix is not None:
+            ids = [doc_id for doc_id in ids if doc_id.startswith(prefix)]
+        return ids
+
+    def docs_in(self, partition=None):
+        """ Returns the documents, optionally restricted to a partition """
+        prefix = None if partition is None else partition + ':'
+        return [self.docs[doc_id] for doc_id in self.sorted_ids(prefix)
+                if not doc_id.startswith('_design/')]
+
+######################################################################
+#  H T T P   H A N D L E R
+######################################################################
+def _json_param(params, *names):
+    """ Returns the first JSON-decoded query parameter present """
+    for name in names:
+        if name in params:
+            try:
+                return json.loads(params[name])
+            except ValueError:
+                return params[name]
+    return None
+
+def _bool_param(params, name, default=False):
+    """ Returns a boolean query parameter """
+    if name not in params:
+        return default
+    return params[name].lower() == 'true'
+
+class CouchHandler(BaseHTTPRequestHandler):
+    """ Handles the subset of the CouchDB HTTP API used by the service """
+    protocol_version = 'HTTP/1.1'
+    server_version = 'CouchDB/3.1.0 (stand-in)'
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """ Keep the benchmark output quiet """
+
+    # -------------------------------------------------------------
+    # plumbing
+    # -------------------------------------------------------------
+    @property
+    def state(self):
+        """ The shared server state """
+        return self.server.state
+
+    def _send(self, code, body, headers=None):
+        """ Sends a JSON response """
+        data = b'' if body is None else json.dumps(body).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _body(self):
+        """ Reads the request body as JSON (or a form for _session) """
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if not raw:
+            return {}
+        if 'json' in (self.headers.get('Content-Type') or ''):
+            return json.loads(raw.decode('utf8'))
+        try:
+            return json.loads(raw.decode('utf8'))
+        except ValueError:
+            return dict(parse_qsl(raw.decode('utf8')))
+
+    def _route(self):
+        """ Dispatches the request """
+        url = urlsplit(self.path)
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        params = dict(parse_qsl(url.query))
+        try:
+            self._dispatch(parts, params)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as error:  # pylint: disable=broad-except
+            self._send(500, {'error': 'unknown_error', 'reason': str(error)})
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _route
+
+    def _dispatch(self, parts, params):
+        """ Routes on path segments """
+        method = self.command
+        if not parts:
+            return self._send(200, {'couchdb': 'Welcome',
+                                    'version': '3.1.0',
+                                    'vendor': {'name': 'stand-in'}})
+        if parts[0] == '_session':
+            if method == 'POST':
+                self._body()
+            return self._send(200, {'ok': True, 'name': 'admin',
+                                    'roles': ['_admin']},
+                              {'Set-Cookie': 'AuthSession=standin; '
+                                             'Path=/; HttpOnly'})
+        if parts[0] == '_all_dbs':
+            return self._send(200, sorted(self.state['dbs']))
+        if parts[0] == '_up':
+            return self._send(200, {'status': 'ok'})
+        name = parts[0]
+        database = self.state['dbs'].get(name)
+        if len(parts) == 1:
+            return self._database(method, name, database, params)
+        if database is None:
+            return self._send(404, {'error': 'not_found',
+                                    'reason': 'Database does not exist.'})
+        rest = parts[1:]
+        partition = None
+        if rest[0] == '_partition' and len(rest) >= 2:
+            if not database.partitioned:
+                return self._send(400, {'error': 'bad_request',
+                                        'reason': 'database is not '
+                                                  'partitioned'})
+            partition, rest = rest[1], rest[2:]
+            if not rest:
+                with self.server.lock:
+                    count = len(database.docs_in(partition))
+                return self._send(200, {'db_name': name,
+                                        'partition': partition,
+                                        'doc_count': count})
+        endpoint = rest[0]
+        if endpoint == '_all_docs':
+            return self._all_docs(database, params, partition)
+        if endpoint == '_find':
+            return self._find(database, partition)
+        if endpoint == '_explain':
+            return self._explain(database, partition)
+        if endpoint == '_bulk_docs':
+            return self._bulk_docs(database)
+        if endpoint == '_changes':
+            return self._changes(database, params)
+        if endpoint == '_index':
+            return self._index(method, database, rest)
+        if endpoint == '_design':
+            return self._document(method, database, '/'.join(rest[:2]),
+                                  params)
+        return self._document(method, database, '/'.join(rest), params)
+
+    # -------------------------------------------------------------
+    # databases
+    # -------------------------------------------------------------
+    def _database(self, method, name, database, params):
+        """ HEAD/GET/PUT/DELETE/POST on a database """
+        if method == 'PUT':
+            with self.server.lock:
+                if database is not None:
+                    return self._send(412, {'error': 'file_exists'})
+                self.state['dbs'][name] = Database(
+                    name, self.server.lock, _bool_param(params, 'partitioned'))
+            return self._send(201, {'ok': True})
+        if database is None:
+            return self._send(404, {'error': 'not_found',
+                                    'reason': 'Database does not exist.'})
+        if method == 'DELETE':
+            with self.server.lock:
+                del self.state['dbs'][name]
+            return self._send(200, {'ok': True})
+        if method == 'POST':
+            body = self._body()
+            with self.server.lock:
+                code, result = database.put(body)
+            return self._send(code, result)
+        with self.server.lock:
+            info = {'db_name': name,
+                    'doc_count': len(database.docs),
+                    'doc_del_count': len(database.deleted),
+                    'update_seq': '{}-standin'.format(database.seq),
+                    'props': {'partitioned': True}
+                             if database.partitioned else {}}
+        return self._send(200, info)
+
+    # -------------------------------------------------------------
+    # documents
+    # -------------------------------------------------------------
+    def _document(self, method, database, doc_id, params):
+        """ HEAD/GET/PUT/DELETE on a document """
+        if method in ('GET', 'HEAD'):
+            with self.server.lock:
+                doc = database.docs.get(doc_id)
+                doc = dict(doc) if doc is not None else None
+            if doc is None:
+                return self._send(404, {'error': 'not_found',
+                                        'reason': 'missing'})
+            return self._send(200, doc, {'ETag': '"{}"'.format(doc['_rev'])})
+        if method == 'PUT':
+            body = self._body()
+            body['_id'] = doc_id
+            if 'rev' in params and '_rev' not in body:
+                body['_rev'] = params['rev']
+            with self.server.lock:
+                code, result = database.put(body)
+            return self._send(code, result)
+        if method == 'DELETE':
+            with self.server.lock:
+                current = database.current_rev(doc_id)
+                if doc_id not in database.docs:
+                    return self._send(404, {'error': 'not_found',
+                                            'reason': 'deleted'})
+                if params.get('rev') != current:
+                    return self._send(409, {'error': 'conflict'})
+                code, result = database.put({'_id': doc_id,
+                                             '_rev': current,
+                                             '_deleted': True})
+            return self._send(200 if code == 201 else code, result)
+        return self._send(405, {'error': 'method_not_allowed'})
+
+    def _all_docs(self, database, params, partition):
+        """ GET/POST _all_docs """
+        body = self._body() if self.command == 'POST' else {}
+        keys = body.get('keys')
+        if keys is None:
+            keys = _json_param(params, 'keys')
+        include_docs = _bool_param(params, 'include_docs')
+        descending = _bool_param(params, 'descending')
+        limit = _json_param(params, 'limit')
+        skip = _json_param(params, 'skip') or 0
+        with self.server.lock:
+            rows = []
+            if keys is not None:
+                for key in keys:
+                    if key in database.docs:
+                        doc = database.docs[key]
+                        row = {'id': key, 'key': key,
+                               'value': {'rev': doc['_rev']}}
+                        if include_docs:
+                            row['doc'] = dict(doc)
+                    elif key in database.deleted:
+                        row = {'id': key, 'key': key,
+                               'value': {'rev': database.deleted[key],
+                                         'deleted': True}}
+                        if include_docs:
+                            row['doc'] = None
+                    else:
+                        row = {'key': key, 'error': 'not_found'}
+                    rows.append(row)
+            else:
+                prefix = None if partition is None else partition + ':'
+                ids = database.sorted_ids(prefix)
+                if descending:
+                    ids.reverse()
+                start = _json_param(params, 'startkey', 'start_key')
+                end = _json_param(params, 'endkey', 'end_key')
+                key = _json_param(params, 'key')
+                inclusive_end = _bool_param(params, 'inclusive_end', True)
+                for doc_id in ids:
+                    if key is not None and doc_id != key:
+                        continue
+                    if start is not None and \
+                            (doc_id > start if descending else doc_id < start):
+                        continue
+                    if end is not None:
+                        past = doc_id < end if descending else doc_id > end
+                        if past or (not inclusive_end and doc_id == end):
+                            continue
+                    doc = database.docs[doc_id]
+                    row = {'id': doc_id, 'key': doc_id,
+                           'value': {'rev': doc['_rev']}}
+                    if include_docs:
+                        row['doc'] = dict(doc)
+                    rows.append(row)
+            total = len(database.docs)
+            rows = rows[skip:]
+            if limit is not None:
+                rows = rows[:limit]
+            seq = database.seq
+        result = {'total_rows': total, 'offset': skip, 'rows': rows}
+        if _bool_param(params, 'update_seq'):
+            result['update_seq'] = '{}-standin'.format(seq)
+        return self._send(200, result)
+
+    def _bulk_docs(self, database):
+        """ POST _bulk_docs """
+        body = self._body()
+        results = []
+        with self.server.lock:
+            for doc in body.get('docs', []):
+                code, result = database.put(doc)
+                if code >= 400:
+                    result = {'id': doc.get('_id'),
+                              'error': result['error'],
+                              'reason': result.get('reason', '')}
+                results.append(result)
+        return self._send(201, results)
+
+    # -------------------------------------------------------------
+    # mango
+    # -------------------------------------------------------------
+    def _pick_index(self, database, selector, use_index=None):
+        """ Chooses an index the way CouchDB would (roughly) """
+        fields = selector_fields(selector)
+        for index in database.indexes:
+            if use_index and index['ddoc'] != '_design/' + str(
+                    use_index if isinstance(use_index, str)
+                    else use_index[0]).replace('_design/', ''):
+                continue
+            index_fields = [list(f)[0] if isinstance(f, dict) else f
+                            for f in index['def']['fields']]
+            if index_fields and all(f in fields for f in index_fields):
+                return index, index_fields
+        return {'ddoc': None, 'name': '_all_docs', 'type': 'special',
+                'def': {'fields': [{'_id': 'asc'}]}}, None
+
+    def _find(self, database, partition):
+        """ POST _find """
+        body = self._body()
+        selector = body.get('selector', {})
+        limit = body.get('limit', 25)
+        skip = body.get('skip', 0)
+        fields = body.get('fields')
+        bookmark = body.get('bookmark')
+        started = time.time()
+        with self.server.lock:
+            index, index_fields = self._pick_index(database, selector,
+                                                   body.get('use_index'))
+            candidates = database.docs_in(partition)
+            if bookmark and bookmark != 'nil':
+                candidates = [d for d in candidates if d['_id'] > bookmark]
+            docs = [dict(d) for d in candidates if matches(d, selector)]
+        examined = len(candidates)
+        if index_fields:
+            examined = len(docs)
+        if body.get('sort'):
+            for spec in reversed(body['sort']):
+                field, order = (list(spec.items())[0]
+                                if isinstance(spec, dict) else (spec, 'asc'))
+                docs.sort(key=lambda d, f=field: (
+                    _type_rank(d.get(f)), d.get(f)),
+                          reverse=order == 'desc')
+        docs = docs[skip:skip + limit]
+        next_bookmark = docs[-1]['_id'] if docs else 'nil'
+        if fields:
+            docs = [{f: d[f] for f in fields if f in d} for d in docs]
+        result = {'docs': docs, 'bookmark': next_bookmark}
+        if index['name'] == '_all_docs':
+            result['warning'] = ('No matching index found, create an index '
+                                 'to optimize query time.')
+        if body.get('execution_stats'):
+            result['execution_stats'] = {
+                'total_keys_examined': examined if index_fields else 0,
+                'total_docs_examined': examined,
+                'total_quorum_docs_examined': 0,
+                'results_returned': len(docs),
+                'execution_time_ms': (time.time() - started) * 1000.0
+            }
+        return self._send(200, result)
+
+    def _explain(self, database, partition):
+        """ POST _explain """
+        body = self._body()
+        selector = body.get('selector', {})
+        with self.server.lock:
+            index, _ = self._pick_index(database, selector,
+                                        body.get('use_index'))
+        return self._send(200, {'dbname': database.name,
+                                'index': index,
+                                'partitioned': partition is not None,
+                                'selector': selector,
+                                'limit': body.get('limit', 25),
+                                'skip': body.get('skip', 0),
+                                'fields': body.get('fields', 'all_fields')})
+
+    def _index(self, method, database, rest):
+        """ GET/POST/DELETE _index """
+        if method == 'GET':
+            with self.server.lock:
+                indexes = [{'ddoc': None, 'name': '_all_docs',
+                            'type': 'special',
+                            'def': {'fields': [{'_id': 'asc'}]}}] + \
+                    list(database.indexes)
+            return self._send(200, {'total_rows': len(indexes),
+                                    'indexes': indexes})
+        if method == 'POST':
+            body = self._body()
+            definition = body.get('index', {})
+            fields = definition.get('fields', [])
+            name = body.get('name') or hashlib.sha1(
+                json.dumps(fields).encode('utf8')).hexdigest()
+            ddoc = body.get('ddoc') or name
+            if not ddoc.startswith('_design/'):
+                ddoc = '_design/' + ddoc
+            with self.server.lock:
+                for index in database.indexes:
+                    if index['name'] == name:
+                        return self._send(200, {'result': 'exists',
+                                                'id': ddoc, 'name': name})
+                database.indexes.append({
+                    'ddoc': ddoc, 'name': name,
+                    'type': body.get('type', 'json'),
+                    'partitioned': body.get('partitioned',
+                                            database.partitioned),
+                    'def': {'fields': [f if isinstance(f, dict)
+                                       else {f: 'asc'} for f in fields]}
+                })
+            return self._send(200, {'result': 'created',
+                                    'id': ddoc, 'name': name})
+        if method == 'DELETE' and len(rest) >= 4:
+            ddoc, name = '_design/' + rest[1].replace('_design/', ''), rest[3]
+            with self.server.lock:
+                database.indexes = [i for i in database.indexes
+                                    if not (i['ddoc'] == ddoc and
+                                            i['name'] == name)]
+            return self._send(200, {'ok': True})
+        return self._send(405, {'error': 'method_not_allowed'})
+
+    # -------------------------------------------------------------
+    # changes
+    # -------------------------------------------------------------
+    def _changes(self, database, params):
+        """ GET/POST _changes (normal and longpoll feeds) """
+        if self.command == 'POST':
+            self._body()
+        since = params.get('since', '0')
+        limit = _json_param(params, 'limit')
+        include_docs = _bool_param(params, 'include_docs')
+        feed = params.get('feed', 'normal')
+        timeout = (_json_param(params, 'timeout') or 60000) / 1000.0
+        with self.server.lock:
+            if since == 'now':
+                since_seq = database.seq
+            else:
+                since_seq = int(str(since).split('-')[0] or 0)
+            if feed == 'longpoll' and database.seq <= since_seq:
+                database.changed.wait(timeout)
+            ordered = sorted((seq, doc_id) for doc_id, seq
+                             in database.changes.items() if seq > since_seq)
+            if limit is not None:
+                ordered = ordered[:limit]
+            results = []
+            for seq, doc_id in ordered:
+                deleted = doc_id not in database.docs
+                rev = database.current_rev(doc_id)
+                row = {'seq': '{}-standin'.format(seq), 'id': doc_id,
+                       'changes': [{'rev': rev}]}
+                if deleted:
+                    row['deleted'] = True
+                if include_docs:
+                    row['doc'] = dict(database.docs[doc_id]) \
+                        if not deleted else \
+                        {'_id': doc_id, '_rev': rev, '_deleted': True}
+                results.append(row)
+            last = ordered[-1][0] if ordered else max(since_seq, database.seq)
+            pending = len([1 for seq in database.changes.values()
+                           if seq > last])
+        return self._send(200, {'results': results,
+                                'last_seq': '{}-standin'.format(last),
+                                'pending': pending})
+
+######################################################################
+#  S E R V E R
+######################################################################
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """ http.server.ThreadingHTTPServer, which python 3.6 doesn't have """
+    daemon_threads = True
+
+class CouchDBStandin(ThreadingHTTPServer):
+    """ Threaded HTTP server holding the in-memory databases """
+
+    def __init__(self, address=('127.0.0.1', 5984)):
+        super().__init__(address, CouchHandler)
+        self.state = {'dbs': {}}
+        self.lock = threading.RLock()
+
+    @property
+    def url(self):
+        """ Base URL of the running server """
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def start(self):
+        """ Serves requests from a daemon thread """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5984)
+    args = parser.parse_args()
+    server = CouchDBStandin((args.host, args.port))
+    print('CouchDB stand-in listening on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Synthetic inventory generator and bulk loader
+Generates inventory rows with a configurable product cardinality and
+popularity skew, condition mix, availability and restock ratio, and
+loads them with _bulk_docs batches from a pool of processes. Every batch
+is generated from (seed, batch number), so a run is reproducible whatever
+the number of processes.
+
+The database is configured like the service (CLOUDANT_*, BINDING_CLOUDANT,
+NATURAL_KEYS, PARTITIONED, SHARDS) and the document ids follow the same
+scheme. With NATURAL_KEYS there is one row per product and condition, so
+--rows can't exceed --products times the number of conditions.
+
+Run it from the root of the repository:
+  python -m benchmarks.generate_data --rows 1000000 --products 50000 \\
+      --processes 8 --dbname inventory-1m
+"""
+import argparse
+import bisect
+import itertools
+import json
+import multiprocessing
+import random
+import sys
+import time
+import uuid
+
+from service.models import Inventory
+
+CONDITIONS = ('new', 'open_box', 'used')
+
+class Settings():
+    """ What to generate """
+
+    def __init__(self, rows=10000, products=1000, product_skew=1.0,
+                 conditions=None, available=0.9, restock_ratio=0.1,
+                 max_quantity=100, seed=0, batch_size=1000):
+        self.rows = rows
+        self.products = products
+        self.product_skew = product_skew
+        self.conditions = conditions or {'new': 0.6, 'open_box': 0.1,
+                                         'used': 0.3}
+        self.available = available
+        self.restock_ratio = restock_ratio
+        self.max_quantity = max_quantity
+        self.seed = seed
+        self.batch_size = batch_size
+        # cumulative weights for the Zipf-like product popularity
+        self._product_cdf = list(itertools.accumulate(
+            1.0 / rank ** product_skew for rank in range(1, products + 1)))
+        self._condition_cdf = list(itertools.accumulate(
+            self.conditions.values()))
+
+    @property
+    def batches(self):
+        """ Number of batches of a full run """
+        return (self.rows + self.batch_size - 1) // self.batch_size
+
+    def product(self, rng):
+        """ Picks a product id, product 1 being the most popular """
+        point = rng.random() * self._product_cdf[-1]
+        return bisect.bisect_right(self._product_cdf, point) + 1
+
+    def condition(self, rng):
+        """ Picks a condition with the configured weights """
+        point = rng.random() * self._condition_cdf[-1]
+        index = bisect.bisect_right(self._condition_cdf, point)
+        return list(self.conditions)[min(index, len(self.conditions) - 1)]
+
+def parse_weights(text):
+    """ Parses "new=0.6,used=0.4" into a dict of weights """
+    weights = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in CONDITIONS:
+            raise ValueError('unknown condition {}'.format(name))
+        weights[name.strip()] = float(weight)
+    return weights
+
+def generate_batch(settings, number, natural_keys=False, prefixed=False):
+    """
+    Returns the documents of batch number. natural_keys gives them
+    <product_id>:<condition> ids, prefixed gives them <product_id>:<uuid>
+    ids (partitioned or sharded databases)
+    """
+    rng = random.Random('{}-{}'.format(settings.seed, number))
+    start = number * settings.batch_size
+    docs = []
+    for row in range(start, min(start + settings.batch_size, settings.rows)):
+        if natural_keys:
+            product_id = row // len(CONDITIONS) + 1
+            condition = CONDITIONS[row % len(CONDITIONS)]
+        else:
+            product_id = settings.product(rng)
+            condition = settings.condition(rng)
+        restock_level = rng.randint(5, 20)
+        if rng.random() < settings.restock_ratio:
+            quantity = rng.randint(0, restock_level - 1)
+        else:
+            quantity = rng.randint(restock_level,
+                                   max(settings.max_quantity, restock_level))
+        doc = Inventory(product_id=product_id, quantity=quantity,
+                        restock_level=restock_level, condition=condition,
+                        available=rng.random() < settings.available)
+        if natural_keys:
+            doc.id = Inventory.natural_key(product_id, condition)
+        else:
+            doc.id = uuid.UUID(int=rng.getrandbits(128)).hex
+            if prefixed:
+                doc.id = '{}:{}'.format(product_id, doc.id)
+        docs.append(doc.serialize())
+    return docs
+
+######################################################################
+#  L O A D E R
+######################################################################
+_WORKER = {}
+
+def _init_worker(dbname, settings):
+    """ Connects a pool process to the database """
+    Inventory.init_db(dbname)
+    _WORKER['settings'] = settings
+
+def _load_batch(number):
+    """ Generates and writes one batch, returns (rows, written, seconds) """
+    settings = _WORKER['settings']
+    started = time.perf_counter()
+    docs = generate_batch(settings, number, Inventory.natural_keys,
+                          Inventory.partitioned or bool(Inventory.shards))
+    by_database = {}
+    for doc in docs:
+        database = Inventory.database_for(doc['product_id'])
+        by_database.setdefault(id(database), (database, []))[1].append(doc)
+    written = sum(Inventory.bulk_save(database, batch,
+                                      batch_size=settings.batch_size,
+                                      skip_conflicts=True)
+                  for database, batch in by_database.values())
+    return len(docs), written, time.perf_counter() - started
+
+def load(dbname, settings, processes=1, progress=None):
+    """ Loads every batch, returns the throughput report """
+    started = time.perf_counter()
+    rows = written = 0
+    batch_seconds = 0.0
+    # create the database(s) once, before the workers connect
+    _init_worker(dbname, settings)
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (dbname, settings))
+        results = pool.imap_unordered(_load_batch, range(settings.batches))
+    else:
+        pool = None
+        results = (_load_batch(number) for number in range(settings.batches))
+    try:
+        for done, (count, saved, seconds) in enumerate(results, 1):
+            rows += count
+            written += saved
+            batch_seconds += seconds
+            if progress is not None:
+                progress(done, settings.batches, rows,
+                         time.perf_counter() - started)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.perf_counter() - started
+    return {'dbname': dbname, 'rows': rows, 'written': written,
+            'conflicts': rows - written, 'batches': settings.batches,
+            'batch_size': settings.batch_size, 'processes': processes,
+            'seed': settings.seed, 'elapsed_s': round(elapsed, 3),
+            'rows_per_s': round(rows / elapsed, 1) if elapsed else None,
+            'mean_batch_ms': round(batch_seconds / settings.batches * 1000.0,
+                                   3) if settings.batches else None}
+
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--dbname', required=True)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--products', type=int, default=10000,
+                        help='number of distinct product ids')
+    parser.add_argument('--product-skew', type=float, default=1.0,
+                        help='Zipf exponent of product popularity '
+                        '(0 is uniform)')
+    parser.add_argument('--conditions', type=parse_weights,
+                        default='new=0.6,open_box=0.1,used=0.3',
+                        help='condition weights')
+    parser.add_argument('--available', type=float, default=0.9,
+                        help='fraction of available rows')
+    parser.add_argument('--restock-ratio', type=float, default=0.1,
+                        help='fraction of rows below their restock level')
+    parser.add_argument('--max-quantity', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='documents per _bulk_docs')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    args = parser.parse_args(argv)
+    if Inventory.natural_keys and \
+            args.rows > args.products * len(CONDITIONS):
+        parser.error('with NATURAL_KEYS --rows is at most --products x {}'
+                     .format(len(CONDITIONS)))
+    settings = Settings(args.rows, args.products, args.product_skew,
+                        args.conditions, args.available, args.restock_ratio,
+                        args.max_quantity, args.seed, args.batch_size)
+
+    def progress(done, total, rows, elapsed):
+        if done == total or done % 50 == 0:
+            print('{}/{} batches, {} rows, {:.0f} rows/s'.format(
+                done, total, rows, rows / elapsed if elapsed else 0),
+                  file=sys.stderr)
+    report = load(args.dbname, settings, args.processes, progress)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return report
+
+if __name__ == '__main__':
+    main()
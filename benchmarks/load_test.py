@@ -0,0 +1,411 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+End-to-end load test of the Inventory service
+Starts the CouchDB stand-in and the service (unless their URLs are given),
+seeds a database and drives each mix of requests for a fixed duration with
+a number of concurrent clients. The report is JSON: requests per second
+and p50/p95/p99 latency (ms) per endpoint and per mix, tagged with the
+commit, so runs can be compared across commits.
+
+Mixes
+-----
+read-heavy      clients polling products, single lookups, availability
+bulk-sync       batch _lookup of ids then updates, plus new inventory
+restock         restock reports (restock=true, restock-level)
+disable-storm   products disabled while clients poll them
+
+Run it from the root of the repository:
+  python -m benchmarks.load_test --concurrency 16 --duration 30 \\
+      --output bench.json
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit, urlencode
+from urllib.request import Request, urlopen
+
+from benchmarks.couchdb_standin import CouchDBStandin
+
+CONDITIONS = ('new', 'open_box', 'used')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+######################################################################
+#  R E S U L T S
+######################################################################
+def percentile(values, pct):
+    """ Returns the nearest-rank percentile of sorted values """
+    if not values:
+        return None
+    rank = max(math.ceil(pct / 100.0 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+class Recorder():
+    """ Collects the latency and status of every request, by endpoint """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, status):
+        """ Records one request """
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if status is None or status >= 500:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self, elapsed):
+        """ Returns the statistics of every endpoint and of the mix """
+        with self._lock:
+            latencies = {key: sorted(values)
+                         for key, values in self.latencies.items()}
+            errors = dict(self.errors)
+        endpoints = {endpoint: _stats(values, errors.get(endpoint, 0),
+                                      elapsed)
+                     for endpoint, values in sorted(latencies.items())}
+        everything = sorted(value for values in latencies.values()
+                            for value in values)
+        total = _stats(everything, sum(errors.values()), elapsed)
+        total['duration_s'] = round(elapsed, 3)
+        total['endpoints'] = endpoints
+        return total
+
+def _stats(values, errors, elapsed):
+    """ Returns count, rps and latency percentiles of sorted values """
+    def millis(value):
+        return None if value is None else round(value * 1000.0, 3)
+    return {'requests': len(values), 'errors': errors,
+            'rps': round(len(values) / elapsed, 2) if elapsed else None,
+            'mean_ms': millis(sum(values) / len(values)) if values else None,
+            'p50_ms': millis(percentile(values, 50)),
+            'p95_ms': millis(percentile(values, 95)),
+            'p99_ms': millis(percentile(values, 99)),
+            'max_ms': millis(values[-1]) if values else None}
+
+######################################################################
+#  C L I E N T
+######################################################################
+class Client():
+    """ A keep-alive HTTP connection to the service that times requests """
+
+    def __init__(self, base_url, recorder):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.recorder = recorder
+        self.connection = http.client.HTTPConnection(self.host, self.port,
+                                                     timeout=60)
+
+    def request(self, endpoint, method, path, body=None):
+        """ Sends a request, records it under endpoint, returns JSON """
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        started = time.perf_counter()
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+            status = response.status
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            self.recorder.record(endpoint, time.perf_counter() - started,
+                                 None)
+            return None
+        self.recorder.record(endpoint, time.perf_counter() - started, status)
+        if status >= 400 or not data:
+            return None
+        return json.loads(data.decode('utf8'))
+
+    def close(self):
+        """ Closes the connection """
+        self.connection.close()
+
+class Dataset():
+    """ What the clients know about the seeded data """
+
+    def __init__(self, ids, products):
+        self.ids = ids
+        self.products = products
+
+    def random_id(self, rng):
+        """ Returns the id of a seeded (or created) inventory """
+        return self.ids[rng.randrange(len(self.ids))]
+
+    def random_product(self, rng):
+        """ Returns a product id, popular products first (Zipf-like) """
+        return min(int(rng.paretovariate(1.2)), self.products)
+
+######################################################################
+#  M I X E S
+######################################################################
+def poll_product(client, rng, data):
+    """ A storefront polling the stock of a product """
+    client.request('GET /inventory?product-id', 'GET', '/inventory?' +
+                   urlencode({'product-id': data.random_product(rng)}))
+
+def poll_available(client, rng, data):
+    """ A storefront polling the available stock of a product """
+    client.request('GET /inventory?available&product-id', 'GET',
+                   '/inventory?' + urlencode({
+                       'available': 'true',
+                       'product-id': data.random_product(rng)}))
+
+def get_one(client, rng, data):
+    """ A lookup of a single inventory """
+    client.request('GET /inventory/<id>', 'GET',
+                   '/inventory/' + data.random_id(rng))
+
+def sync_batch(client, rng, data):
+    """ A warehouse sync: fetch a batch of ids, then update a few """
+    ids = [data.random_id(rng) for _ in range(50)]
+    found = client.request('POST /inventory/_lookup', 'POST',
+                           '/inventory/_lookup', {'ids': ids}) or []
+    found = [item for item in found if 'error' not in item]
+    for item in rng.sample(found, min(5, len(found))):
+        body = {key: item[key] for key in ('product_id', 'quantity',
+                                           'restock_level', 'condition',
+                                           'available')}
+        body['quantity'] = rng.randint(0, 100)
+        client.request('PUT /inventory/<id>', 'PUT',
+                       '/inventory/' + item['_id'], body)
+
+def create_inventory(client, rng, data):
+    """ A new inventory entry from the warehouse """
+    created = client.request('POST /inventory', 'POST', '/inventory', {
+        'product_id': data.random_product(rng),
+        'quantity': rng.randint(0, 100), 'restock_level': rng.randint(5, 20),
+        'condition': rng.choice(CONDITIONS), 'available': True})
+    if created:
+        data.ids.append(created['_id'])
+
+def restock_report(client, _rng, _data):
+    """ The report of what needs restocking """
+    client.request('GET /inventory?restock', 'GET',
+                   '/inventory?restock=true')
+
+def restock_level_report(client, rng, _data):
+    """ The inventory at a given restock level """
+    client.request('GET /inventory?restock-level', 'GET',
+                   '/inventory?restock-level={}'.format(rng.randint(5, 20)))
+
+def disable_product(client, rng, data):
+    """ A product pulled from sale """
+    client.request('PUT /inventory/<pid>/disable', 'PUT',
+                   '/inventory/{}/disable'.format(data.random_product(rng)))
+
+MIXES = {
+    'read-heavy': [(6, poll_product), (3, get_one), (1, poll_available)],
+    'bulk-sync': [(4, sync_batch), (1, create_inventory)],
+    'restock': [(3, restock_report), (1, restock_level_report)],
+    'disable-storm': [(2, disable_product), (3, poll_product)],
+}
+
+def run_mix(name, service_url, concurrency, duration, data, seed):
+    """ Drives a mix with concurrent clients, returns its summary """
+    actions = [action for weight, action in MIXES[name]
+               for _ in range(weight)]
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+
+    def worker(number):
+        rng = random.Random('{}-{}-{}'.format(seed, name, number))
+        client = Client(service_url, recorder)
+        try:
+            while time.perf_counter() < deadline:
+                rng.choice(actions)(client, rng, data)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(number,), daemon=True)
+               for number in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.summary(time.perf_counter() - started)
+
+######################################################################
+#  S E T U P
+######################################################################
+def free_port():
+    """ Returns a TCP port nobody listens on """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def couch_request(url, method='GET', body=None):
+    """ Sends a JSON request to CouchDB """
+    request = Request(url, method=method, data=None if body is None
+                      else json.dumps(body).encode('utf8'),
+                      headers={'Content-Type': 'application/json'})
+    with urlopen(request) as response:
+        return json.loads(response.read().decode('utf8'))
+
+def seed(couch_url, dbname, count, products, rng, batch_size=1000):
+    """ Creates the database and fills it, returns the document ids """
+    database_url = couch_url.rstrip('/') + '/' + dbname
+    couch_request(database_url, 'PUT')
+    ids = []
+    for start in range(0, count, batch_size):
+        docs = []
+        for _ in range(min(batch_size, count - start)):
+            doc_id = uuid.UUID(int=rng.getrandbits(128)).hex
+            docs.append({'_id': doc_id,
+                         'product_id': min(int(rng.paretovariate(1.2)),
+                                           products),
+                         'quantity': rng.randint(0, 100),
+                         'restock_level': rng.randint(5, 20),
+                         'condition': rng.choice(CONDITIONS),
+                         'available': rng.random() < 0.9})
+            ids.append(doc_id)
+        couch_request(database_url + '/_bulk_docs', 'POST', {'docs': docs})
+    return ids
+
+def start_service(couch_url, dbname, port, server, workers):
+    """ Starts the service in a subprocess against couch_url """
+    couch = urlsplit(couch_url)
+    env = dict(os.environ, DATABASE_NAME=dbname, BINDING_CLOUDANT=json.dumps({
+        'username': couch.username or 'admin',
+        'password': couch.password or 'pass',
+        'host': couch.hostname, 'port': couch.port,
+        'url': '{}://{}:{}/'.format(couch.scheme, couch.hostname,
+                                    couch.port)}))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [path for path in [os.environ.get('PYTHONPATH')] if path])
+    if server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '--log-level=warning',
+                   '--workers={}'.format(workers), '--threads=4',
+                   '--bind=127.0.0.1:{}'.format(port), 'service:app']
+    else:
+        env['FLASK_APP'] = 'service:app'
+        command = [sys.executable, '-m', 'flask', 'run', '--with-threads',
+                   '--host=127.0.0.1', '--port={}'.format(port)]
+    return subprocess.Popen(command, cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+def wait_until_ready(service_url, timeout=30.0):
+    """ Waits for the service (the first request connects to CouchDB) """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with urlopen(service_url.rstrip('/') + '/healthcheck', timeout=5):
+                return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+def git_commit():
+    """ Returns the commit being benchmarked, if known """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--mix', action='append', choices=sorted(MIXES),
+                        help='mix to run (repeatable, default: all)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20.0,
+                        help='seconds per mix')
+    parser.add_argument('--docs', type=int, default=5000,
+                        help='inventory documents to seed')
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--couchdb-url',
+                        help='use this CouchDB instead of the stand-in')
+    parser.add_argument('--service-url',
+                        help='load test a running service (no seeding)')
+    parser.add_argument('--server', choices=('gunicorn', 'flask'),
+                        default='gunicorn')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='gunicorn workers')
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+    processes, standin = [], None
+
+    try:
+        service_url = args.service_url
+        if service_url is None:
+            couch_url = args.couchdb_url
+            if couch_url is None:
+                standin = CouchDBStandin(('127.0.0.1', free_port()))
+                standin.start()
+                couch_url = standin.url
+            dbname = 'bench-{}'.format(uuid.uuid4().hex[:8])
+            ids = seed(couch_url, dbname, args.docs, args.products, rng)
+            port = free_port()
+            processes.append(start_service(couch_url, dbname, port,
+                                           args.server, args.workers))
+            service_url = 'http://127.0.0.1:{}'.format(port)
+        else:
+            listed = json.loads(urlopen(service_url.rstrip('/') +
+                                        '/inventory').read().decode('utf8'))
+            ids = [item['_id'] for item in listed]
+        wait_until_ready(service_url)
+        data = Dataset(ids, args.products)
+
+        report = {'commit': git_commit(), 'time': time.time(),
+                  'python': platform.python_version(),
+                  'server': args.server if not args.service_url else None,
+                  'couchdb': 'stand-in' if standin else 'couchdb',
+                  'concurrency': args.concurrency,
+                  'duration_s': args.duration, 'docs': len(ids),
+                  'products': args.products, 'seed': args.seed, 'mixes': {}}
+        for name in args.mix or list(MIXES):
+            report['mixes'][name] = run_mix(name, service_url,
+                                            args.concurrency, args.duration,
+                                            data, args.seed)
+            print('{:<14} {:>8.1f} req/s  p50 {:>7} ms  p99 {:>7} ms'.format(
+                name, report['mixes'][name]['rps'] or 0,
+                report['mixes'][name]['p50_ms'],
+                report['mixes'][name]['p99_ms']), file=sys.stderr)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if standin is not None:
+            standin.shutdown()
+            standin.server_close()
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(text + '\n')
+    else:
+        print(text)
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Microbenchmarks of the model and marshalling hot paths
+Times Inventory.serialize, Inventory.deserialize, Inventory.all,
+Inventory.find_by_restock and the encoding of InventoryCollection.get
+(the fast JSON path and flask-restplus marshalling) over datasets built
+with tests/inventory_factory.py and served by an in-process fake
+database (no CouchDB, no HTTP).
+
+Every benchmark runs for a number of rounds and reports min, median, mean
+and stddev in seconds. --save writes the results as a baseline; --compare
+fails (exit status 1) when the median of a benchmark is slower than the
+baseline by more than --threshold percent.
+
+Run it from the root of the repository:
+  python -m benchmarks.microbench --sizes 1k,100k --save baseline.json
+  python -m benchmarks.microbench --sizes 1k,100k --compare baseline.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+# pylint: disable=wrong-import-position
+from inventory_factory import InventoryFactory
+from service import app
+from service.models import Inventory
+from service.service import api, collection_cache, InventoryCollection
+
+BENCHMARKS = ('serialize', 'deserialize', 'all', 'find_by_restock',
+              'marshal_collection', 'marshal_collection_restplus')
+
+######################################################################
+#  F A K E   D A T A B A S E
+######################################################################
+class FakeDatabase(dict):
+    """
+    In-process stand-in for a CloudantDatabase: a dict of documents by
+    id that iterates over the documents like the cloudant client does
+    """
+
+    def __init__(self, docs, name='microbench'):
+        super().__init__((doc['_id'], doc) for doc in docs)
+        self.database_name = name
+
+    def __iter__(self):
+        return iter(self.values())
+
+@contextlib.contextmanager
+def installed(database):
+    """ Makes Inventory read from the fake database """
+    saved = {name: getattr(Inventory, name)
+             for name in ('database', 'shards', 'replicas', 'executor')}
+    Inventory.database, Inventory.shards = database, []
+    Inventory.replicas, Inventory.executor = {}, None
+    try:
+        yield database
+    finally:
+        for name, value in saved.items():
+            setattr(Inventory, name, value)
+
+def parse_size(text):
+    """ Returns the number of documents of "1k", "100k", "1M" or "500" """
+    text = text.strip()
+    scale = {'k': 1000, 'K': 1000, 'm': 1000000, 'M': 1000000}
+    if text[-1] in scale:
+        return int(float(text[:-1]) * scale[text[-1]])
+    return int(text)
+
+def build_docs(count):
+    """ Returns count inventory documents made by InventoryFactory """
+    docs = []
+    for number in range(count):
+        inventory = InventoryFactory()
+        inventory.id = '{:012x}'.format(number)
+        docs.append(inventory.serialize())
+    return docs
+
+######################################################################
+#  B E N C H M A R K S
+######################################################################
+def prepare(name, docs):
+    """ Returns the function timed by a benchmark """
+    if name == 'serialize':
+        inventories = [Inventory().deserialize(doc) for doc in docs]
+        return lambda: [inventory.serialize() for inventory in inventories]
+    if name == 'deserialize':
+        return lambda: [Inventory().deserialize(doc) for doc in docs]
+    if name == 'all':
+        return Inventory.all
+    if name == 'find_by_restock':
+        return lambda: Inventory.find_by_restock(True)
+    if name in ('marshal_collection', 'marshal_collection_restplus'):
+        encode = api.representations['application/json']
+        fast = name == 'marshal_collection'
+
+        def marshal_collection():
+            saved, app.config['FAST_JSON'] = app.config['FAST_JSON'], fast
+            # time the encoding, not the response cache
+            max_bytes, collection_cache.max_bytes = \
+                collection_cache.max_bytes, 0
+            try:
+                with app.test_request_context('/inventory'):
+                    resp = InventoryCollection().get()
+                    if isinstance(resp, tuple):     # marshalled
+                        resp = encode(*resp)
+                    return resp.get_data()
+            finally:
+                app.config['FAST_JSON'] = saved
+                collection_cache.max_bytes = max_bytes
+        return marshal_collection
+    raise ValueError('unknown benchmark {}'.format(name))
+
+def measure(func, min_rounds=5, max_rounds=1000, min_time=1.0):
+    """
+    Calls func until it ran min_rounds times and for min_time seconds
+    (or max_rounds times), returns the statistics of the rounds
+    """
+    func()  # warm up
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < max_rounds and (
+            len(timings) < min_rounds or
+            time.perf_counter() - started < min_time):
+        begin = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - begin)
+    return {'rounds': len(timings), 'min': min(timings),
+            'median': statistics.median(timings),
+            'mean': statistics.mean(timings),
+            'stddev': statistics.stdev(timings) if len(timings) > 1 else 0.0}
+
+def run(sizes, names=BENCHMARKS, min_time=1.0, log=None):
+    """ Runs the benchmarks for every size, returns them by name[size] """
+    results = {}
+    logging.disable(logging.INFO)  # the finders log every call
+    try:
+        for size in sizes:
+            docs = build_docs(parse_size(size))
+            with installed(FakeDatabase(docs)):
+                for name in names:
+                    key = '{}[{}]'.format(name, size)
+                    results[key] = measure(prepare(name, docs),
+                                           min_rounds=3 if len(docs) > 10**5
+                                           else 5, min_time=min_time)
+                    if log is not None:
+                        log('{:<32} {:>12.6f}s median ({} rounds)'.format(
+                            key, results[key]['median'],
+                            results[key]['rounds']))
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Compares medians with the baseline, returns (rows, regressions).
+    A row is (name, baseline, current, change in percent)
+    """
+    rows, regressions = [], []
+    for name, stats in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            rows.append((name, None, stats['median'], None))
+            continue
+        change = (stats['median'] - before['median']) / before['median'] \
+            * 100.0
+        rows.append((name, before['median'], stats['median'], change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+def git_commit():
+    """ Returns the commit being benchmarked, if known """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', default='1k,100k',
+                        help='dataset sizes, e.g. 1k,100k,1M')
+    parser.add_argument('--benchmark', action='append', choices=BENCHMARKS,
+                        help='benchmark to run (repeatable, default: all)')
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='seconds each benchmark runs for at least')
+    parser.add_argument('--save', help='write the results as a baseline')
+    parser.add_argument('--compare', help='baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent slower than the baseline that fails')
+    args = parser.parse_args(argv)
+
+    def log(line):
+        print(line, file=sys.stderr)
+    results = run(args.sizes.split(','), args.benchmark or BENCHMARKS,
+                  args.min_time, log)
+    report = {'commit': git_commit(), 'time': time.time(),
+              'python': platform.python_version(),
+              'benchmarks': results}
+    if args.save:
+        with open(args.save, 'w') as stream:
+            json.dump(report, stream, indent=2, sort_keys=True)
+            stream.write('\n')
+    if not args.compare:
+        if not args.save:
+            print(json.dumps(report, indent=2, sort_keys=True))
+        return 0
+
+    with open(args.compare) as stream:
+        baseline = json.load(stream)
+    rows, regressions = compare(results, baseline['benchmarks'],
+                                args.threshold)
+    print('{:<32} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline',
+                                              'current', 'change'))
+    for name, before, after, change in rows:
+        print('{:<32} {:>12} {:>12.6f} {:>8}'.format(
+            name, '-' if before is None else '{:.6f}'.format(before), after,
+            '-' if change is None else '{:+.1f}%'.format(change)))
+    if regressions:
+        print('regressed by more than {}% against {} ({}): {}'.format(
+            args.threshold, args.compare, baseline.get('commit'),
+            ', '.join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
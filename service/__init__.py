@@ -21,17 +21,91 @@ and SQL database
 import os
 import sys
 from flask import Flask
+from service.profiling import ProfilerMiddleware
 
 # Get configuration from environment
 SECRET_KEY = os.getenv('SECRET_KEY', 's3cr3t-key-shhhh')
+DATABASE_NAME = os.getenv('DATABASE_NAME', 'asd')
+PROFILE_SECRET = os.getenv('PROFILE_SECRET')
+PROFILE_DIR = os.getenv('PROFILE_DIR')
+TRACE_FILE = os.getenv('TRACE_FILE')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
 
 # Create Flask application
 app = Flask(__name__)
 
 app.config['SECRET_KEY'] = SECRET_KEY
+# return a Server-Timing header (db, deserialize, marshal) on every response
+app.config['SERVER_TIMING'] = \
+    os.getenv('SERVER_TIMING', 'False').lower() == 'true'
+# encode the Inventory responses straight to JSON instead of marshalling
+# them with flask-restplus (the output is the same)
+app.config['FAST_JSON'] = os.getenv('FAST_JSON', 'True').lower() == 'true'
+# write a trace of the sampled requests to TRACE_FILE (JSON lines)
+app.config['TRACE_FILE'] = TRACE_FILE
+app.config['TRACE_SAMPLE_RATE'] = TRACE_SAMPLE_RATE
+# trace allocations with tracemalloc and track memory per endpoint; the
+# /debug/memory endpoints need the X-Profile: $PROFILE_SECRET header
+app.config['PROFILE_SECRET'] = PROFILE_SECRET
+app.config['MEMORY_PROFILE'] = \
+    os.getenv('MEMORY_PROFILE', 'False').lower() == 'true'
+app.config['MEMORY_PROFILE_FRAMES'] = int(os.getenv('MEMORY_PROFILE_FRAMES',
+                                                    '1'))
+app.config['MEMORY_PROFILE_SIGNAL'] = os.getenv('MEMORY_PROFILE_SIGNAL',
+                                                'SIGUSR2')
+# gzip (or brotli if installed) the responses of at least COMPRESS_MIN_SIZE
+# bytes for the clients that accept it
+app.config['COMPRESS'] = os.getenv('COMPRESS', 'True').lower() == 'true'
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+app.config['COMPRESS_LEVEL'] = int(os.getenv('COMPRESS_LEVEL', '6'))
+app.config['COMPRESS_BROTLI_QUALITY'] = \
+    int(os.getenv('COMPRESS_BROTLI_QUALITY', '4'))
+# static assets built by "flask build-assets", served from /assets
+app.config['ASSETS_DIR'] = os.getenv('ASSETS_DIR',
+                                     os.path.join(app.root_path, 'assets'))
+# a comment every EVENTS_HEARTBEAT seconds keeps the /inventory/events
+# streams open; they end after EVENTS_DURATION seconds and the browser
+# reconnects from the last event
+app.config['EVENTS_HEARTBEAT'] = float(os.getenv('EVENTS_HEARTBEAT', '15'))
+app.config['EVENTS_DURATION'] = float(os.getenv('EVENTS_DURATION', '300'))
+# every stream holds a gunicorn thread: past EVENTS_MAX_STREAMS open
+# streams a worker answers 503, which keeps threads for the other requests
+app.config['EVENTS_MAX_STREAMS'] = int(os.getenv('EVENTS_MAX_STREAMS', '4'))
+# POST the restock crossings of the writes (quantity going below the
+# restock level or back above it) in batches to the comma separated
+# WEBHOOK_URLS, signed with WEBHOOK_SECRET when set
+app.config['WEBHOOK_URLS'] = [url.strip() for url in
+                              os.getenv('WEBHOOK_URLS', '').split(',')
+                              if url.strip()]
+app.config['WEBHOOK_SECRET'] = os.getenv('WEBHOOK_SECRET')
+app.config['WEBHOOK_BATCH_SIZE'] = int(os.getenv('WEBHOOK_BATCH_SIZE', '100'))
+app.config['WEBHOOK_BATCH_INTERVAL'] = \
+    float(os.getenv('WEBHOOK_BATCH_INTERVAL', '1'))
+app.config['WEBHOOK_MAX_ATTEMPTS'] = int(os.getenv('WEBHOOK_MAX_ATTEMPTS',
+                                                   '5'))
+# keep up to RESPONSE_CACHE_BYTES of GET /inventory responses (0 turns it
+# off); the writes of other processes are seen through the update sequence
+# of the database read (or its replica), at most every
+# RESPONSE_CACHE_SEQ_INTERVAL seconds
+app.config['RESPONSE_CACHE_BYTES'] = \
+    int(os.getenv('RESPONSE_CACHE_BYTES', str(16 * 1024 * 1024)))
+app.config['RESPONSE_CACHE_SEQ_INTERVAL'] = \
+    float(os.getenv('RESPONSE_CACHE_SEQ_INTERVAL', '1'))
+# LOG_FORMAT=json writes JSON lines from a background thread; INFO and
+# DEBUG records can be sampled (LOG_SAMPLING="flask.app=0.1") or rate
+# limited per second (LOG_RATE_LIMIT="werkzeug=50") per logger
+app.config['LOG_FORMAT'] = os.getenv('LOG_FORMAT', 'text').lower()
+app.config['LOG_SAMPLING'] = os.getenv('LOG_SAMPLING')
+app.config['LOG_RATE_LIMIT'] = os.getenv('LOG_RATE_LIMIT')
+app.config['LOG_QUEUE_SIZE'] = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# profile the requests sent with "X-Profile: $PROFILE_SECRET"
+if PROFILE_SECRET:
+    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, PROFILE_SECRET,
+                                      directory=PROFILE_DIR)
 
 # Import the rutes After the Flask app is created
-from service import service, models
+from service import service, models, commands
 from .models import Inventory
 
 # Set up logging for production
@@ -43,7 +117,7 @@ app.logger.info(' I N V E N T O R Y  \
 app.logger.info(70 * '*')
 
 @app.before_first_request
-def init_db(dbname='asd'):
+def init_db(dbname=DATABASE_NAME):
     """ Initlaize the CouchDB """
     Inventory.init_db(dbname)
 
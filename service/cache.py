@@ -0,0 +1,181 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+In-process caches of the Inventory service
+NegativeCache remembers the ids a lookup found missing for a few seconds,
+so the requests for ids that don't exist stop reaching CouchDB. The
+writes that produce an id, and the changes feed, take it out again.
+
+ResponseCache keeps the bodies of the collection queries under their
+arguments and a version of the data: the writes of this process and the
+update sequence of the databases the bodies are read from, read at most
+every seq_interval seconds. A write only changes the version; the bodies
+of the previous one are dropped as soon as a request sees the new one.
+"""
+import collections
+import threading
+import time
+
+from service.metrics import Counter, Gauge
+
+NEGATIVE_CACHE = Counter('inventory_negative_cache_total',
+                         'Lookups of missing ids answered by the negative '
+                         'cache (hit), ids stored and ids invalidated',
+                         ('outcome',))
+
+RESPONSE_CACHE = Counter('inventory_response_cache_total',
+                         'Collection responses served from the cache (hit), '
+                         'computed (miss) and evicted (evicted_size, '
+                         'evicted_stale)', ('outcome',))
+RESPONSE_CACHE_BYTES = Gauge('inventory_response_cache_bytes',
+                             'Size of the cached collection responses')
+
+class NegativeCache():
+    """ A bounded set of the ids found missing in the last ttl seconds """
+
+    def __init__(self, ttl=5.0, size=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.size = size
+        self.clock = clock
+        self._ids = collections.OrderedDict()  # id: expiry, oldest first
+        self._generation = 0  # bumped by every invalidation
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            expiry = self._ids.get(key)
+            if expiry is None:
+                return False
+            if expiry <= self.clock():
+                del self._ids[key]
+                return False
+        NEGATIVE_CACHE.inc(outcome='hit')
+        return True
+
+    def __len__(self):
+        return len(self._ids)
+
+    def generation(self):
+        """ Returns a token to pass to add() after the lookup """
+        return self._generation
+
+    def add(self, key, generation=None):
+        """
+        Remembers a missing id, unless something was invalidated since
+        generation was read: the lookup may have missed a new document
+        """
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._ids.pop(key, None)
+            self._ids[key] = self.clock() + self.ttl
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+        NEGATIVE_CACHE.inc(outcome='stored')
+
+    def discard(self, key):
+        """ Forgets an id that now exists """
+        with self._lock:
+            self._generation += 1
+            if self._ids.pop(key, None) is None:
+                return
+        NEGATIVE_CACHE.inc(outcome='invalidated')
+
+    def clear(self):
+        """ Forgets every id """
+        with self._lock:
+            self._generation += 1
+            self._ids.clear()
+
+class ResponseCache():
+    """ Response bodies by query and data version, up to max_bytes """
+
+    def __init__(self, max_bytes, local_version, update_seqs,
+                 seq_interval=1.0, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.local_version = local_version
+        self.update_seqs = update_seqs
+        self.seq_interval = seq_interval
+        self.clock = clock
+        self.stats = dict.fromkeys(('hit', 'miss', 'evicted_size',
+                                    'evicted_stale'), 0)
+        self._entries = collections.OrderedDict()  # key: body, LRU first
+        self._bytes = 0
+        self._version = None
+        self._seqs = None
+        self._seqs_read = None
+        self._lock = threading.Lock()
+        self._seq_lock = threading.Lock()
+
+    def version(self):
+        """
+        Returns the current version of the data. The bodies of any other
+        version are dropped
+        """
+        with self._seq_lock:
+            now = self.clock()
+            if self._seqs_read is None or \
+                    now - self._seqs_read >= self.seq_interval:
+                self._seqs = tuple(self.update_seqs())
+                self._seqs_read = now
+            version = (self.local_version(), self._seqs)
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._count('evicted_stale', len(self._entries))
+                self._entries.clear()
+                self._bytes = 0
+                RESPONSE_CACHE_BYTES.set(0)
+        return version
+
+    def get(self, key, version):
+        """ Returns the body of a query at a version, None on a miss """
+        with self._lock:
+            body = self._entries.get(key) if version == self._version \
+                else None
+            if body is None:
+                self._count('miss')
+                return None
+            self._entries.move_to_end(key)
+            self._count('hit')
+            return body
+
+    def put(self, key, version, body):
+        """ Keeps the body of a query computed at a version """
+        if len(body) > self.max_bytes // 4:
+            return  # would push out too many others
+        with self._lock:
+            if version != self._version:
+                return  # the data changed while it was computed
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[key] = body
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._count('evicted_size')
+            RESPONSE_CACHE_BYTES.set(self._bytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _count(self, outcome, amount=1):
+        if amount:
+            self.stats[outcome] += amount
+            RESPONSE_CACHE.inc(amount, outcome=outcome)
@@ -0,0 +1,116 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Admin commands for the Inventory service
+Run them with the flask CLI, e.g.:
+  FLASK_APP=service:app flask migrate-natural-keys --merge
+"""
+import os
+import click
+from service.compression import build_assets
+from service.models import Inventory, SLOW_QUERY_LOG
+from service.querylog import QueryLog, recommend_indexes
+
+# Import Flask application
+from . import app, DATABASE_NAME
+
+######################################################################
+# MIGRATE TO NATURAL KEYS
+######################################################################
+@app.cli.command('migrate-natural-keys')
+@click.option('--dbname', default=DATABASE_NAME, help='Database to migrate')
+@click.option('--merge', is_flag=True,
+              help='Merge duplicate product/condition rows')
+@click.option('--batch-size', default=500, help='Documents per _bulk_docs')
+def migrate_natural_keys(dbname, merge, batch_size):
+    """ Re-key every document as <product_id>:<condition> """
+    Inventory.init_db(dbname)
+    stats = Inventory.migrate_natural_keys(merge=merge,
+                                           batch_size=batch_size)
+    click.echo('migrated: {migrated}  unchanged: {unchanged}  '
+               'merged: {merged}'.format(**stats))
+    for doc_id in stats['duplicates']:
+        click.echo('duplicate left in place: {}'.format(doc_id))
+
+######################################################################
+# MIGRATE TO A PARTITIONED DATABASE
+######################################################################
+@app.cli.command('migrate-partitioned')
+@click.option('--dbname', default=DATABASE_NAME, help='Database to copy')
+@click.option('--target', required=True,
+              help='Partitioned database to create and fill')
+@click.option('--batch-size', default=500, help='Documents per _bulk_docs')
+def migrate_partitioned(dbname, target, batch_size):
+    """ Copy every document into a database partitioned by product_id """
+    Inventory.init_db(dbname)
+    copied = Inventory.migrate_partitioned(target, batch_size=batch_size)
+    click.echo('copied: {}'.format(copied))
+    click.echo('set DATABASE_NAME={} to switch the service over'
+               .format(target))
+
+######################################################################
+# RECOMMEND INDEXES FOR THE SLOW QUERIES
+######################################################################
+@app.cli.command('recommend-indexes')
+@click.option('--dbname', default=DATABASE_NAME,
+              help='Database the queries ran against')
+@click.option('--log', 'log_path', default=SLOW_QUERY_LOG or None,
+              required=not SLOW_QUERY_LOG, help='Slow query log to analyze')
+@click.option('--top', default=5, help='Number of indexes to recommend')
+@click.option('--create', is_flag=True,
+              help='Create the recommended indexes')
+def recommend_indexes_command(dbname, log_path, top, create):
+    """ Recommend (or create) indexes covering the costliest queries """
+    Inventory.init_db(dbname)
+    existing = Inventory.databases()[0].get_query_indexes(raw_result=True)
+    log = QueryLog.load(log_path)
+    recommendations = recommend_indexes(log.top(len(log.table)),
+                                        existing['indexes'], limit=top)
+    if not recommendations:
+        click.echo('every logged query is covered by an index')
+    for index in recommendations:
+        click.echo('{name}: fields {fields}{scope}'.format(
+            scope=' (partitioned)' if index['partitioned'] else '', **index))
+        click.echo('  {queries} queries ({slow} slow), {seconds:.3f}s, '
+                   '{docs_examined} docs examined for {results_returned} '
+                   'returned'.format(**index))
+        for selector in index['selectors']:
+            click.echo('  ' + selector)
+        if create:
+            for database in Inventory.databases():
+                database.create_query_index(
+                    design_document_id=index['name'],
+                    index_name=index['name'], fields=index['fields'],
+                    partitioned=index['partitioned'])
+            Inventory.query_log.forget_indexes()
+            click.echo('  created')
+
+######################################################################
+# BUILD THE STATIC ASSETS
+######################################################################
+@app.cli.command('build-assets')
+@click.option('--target', default=app.config['ASSETS_DIR'],
+              help='Directory of the built assets')
+@click.option('--level', default=9, help='gzip level')
+@click.option('--brotli-quality', default=11,
+              help='brotli quality (if brotli is installed)')
+def build_assets_command(target, level, brotli_quality):
+    """ Builds hashed, precompressed copies of the css and js files """
+    manifest = build_assets(app.static_folder, target, level,
+                            brotli_quality)
+    for name, hashed in sorted(manifest.items()):
+        click.echo('{} -> {}'.format(name, hashed))
+    click.echo('{} assets written to {}'.format(
+        len(manifest), os.path.abspath(target)))
@@ -0,0 +1,128 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Response compression for the Inventory service
+Negotiates gzip, or brotli when the brotli package is installed, for the
+responses large enough to be worth it, and builds the content-hashed,
+precompressed copies of the static assets that are served from /assets.
+"""
+import hashlib
+import json
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only without it
+    brotli = None
+
+from service.metrics import phase
+
+MANIFEST = 'manifest.json'
+EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+COMPRESSIBLE = ('application/json', 'application/javascript', 'text/')
+ASSET_TYPES = ('.css', '.js')
+
+def encodings():
+    """ Returns the encodings this process can produce, preferred first """
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def negotiate(accept_encodings, available=None):
+    """
+    Returns the encoding of available (default: encodings()) with the
+    highest quality in the parsed Accept-Encoding header, or None
+    """
+    best, best_quality = None, 0
+    for encoding in encodings() if available is None else available:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+@phase('compress')
+def compress(data, encoding, level):
+    """ Compresses data with gzip (level 1-9) or brotli (quality 0-11) """
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    # wbits 31 writes a gzip header with no timestamp: same input, same
+    # output
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def compressible(response, min_size):
+    """ True if a response is worth compressing """
+    if not 200 <= response.status_code < 300 or \
+            response.status_code == 204 or response.direct_passthrough or \
+            response.is_streamed or 'Content-Encoding' in response.headers:
+        return False
+    if not response.mimetype.startswith(COMPRESSIBLE):
+        return False
+    return response.calculate_content_length() >= min_size
+
+######################################################################
+#  S T A T I C   A S S E T S
+######################################################################
+def build_assets(source, target, level=9, brotli_quality=11):
+    """
+    Copies the css and js files under source to target with a hash of
+    their content in their names, next to their .gz (and .br) versions,
+    and writes the manifest mapping the original names to the hashed ones
+    """
+    manifest = {}
+    target = os.path.abspath(target)
+    for directory, subdirectories, files in os.walk(source):
+        subdirectories[:] = [name for name in subdirectories if
+                             os.path.abspath(os.path.join(directory, name))
+                             != target]
+        for name in sorted(files):
+            if not name.endswith(ASSET_TYPES):
+                continue
+            path = os.path.join(directory, name)
+            with open(path, 'rb') as stream:
+                data = stream.read()
+            relative = os.path.relpath(path, source).replace(os.sep, '/')
+            stem, extension = os.path.splitext(relative)
+            hashed = '{}.{}{}'.format(
+                stem, hashlib.sha256(data).hexdigest()[:12], extension)
+            output = os.path.join(target, hashed)
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            _write(output, data)
+            for encoding in encodings():
+                compressed = compress(data, encoding, brotli_quality
+                                      if encoding == 'br' else level)
+                if len(compressed) < len(data):
+                    _write(output + EXTENSIONS[encoding], compressed)
+            manifest[relative] = hashed
+    with open(os.path.join(target, MANIFEST), 'w') as stream:
+        json.dump(manifest, stream, indent=2, sort_keys=True)
+    return manifest
+
+def _write(path, data):
+    with open(path, 'wb') as stream:
+        stream.write(data)
+
+def load_manifest(directory):
+    """ Returns the manifest of built assets, empty if never built """
+    try:
+        with open(os.path.join(directory, MANIFEST)) as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return {}
+
+def rewrite_links(html, manifest, source='static/', target='assets/'):
+    """ Points the links of a page at the hashed assets """
+    for name, hashed in manifest.items():
+        html = html.replace(source + name, target + hashed)
+    return html
@@ -0,0 +1,106 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Fast JSON encoding of API models
+Encodes objects straight to the bytes that marshal() followed by the
+flask-restplus JSON representation would return: the keys of the model
+in order, json.dumps separators and ASCII escapes. Values that are not
+exactly a str, int or bool (or None) go through marshal() instead, so the
+output is the same either way.
+"""
+import json
+from json.encoder import encode_basestring_ascii
+from flask_restplus import fields, marshal, representations
+
+def _string(value):
+    if type(value) is str:  # pylint: disable=unidiomatic-typecheck
+        return encode_basestring_ascii(value)
+    return 'null' if value is None else None
+
+def _integer(value):
+    if type(value) is int:  # pylint: disable=unidiomatic-typecheck
+        return int.__repr__(value)
+    return 'null' if value is None else None
+
+def _boolean(value):
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    return 'null' if value is None else None
+
+# exact field classes only, subclasses may override format()
+_ENCODERS = {fields.String: _string, fields.Integer: _integer,
+             fields.Boolean: _boolean}
+
+def stdlib_representation(app):
+    """
+    True when the JSON representation is plain json.dumps without
+    settings (flask-restplus uses ujson when it is installed, and indents
+    in debug mode)
+    """
+    return representations.dumps is json.dumps and not app.debug and \
+        not app.config.get('RESTPLUS_JSON')
+
+class ModelEncoder():
+    """ Encodes objects with the fields of an API model as JSON """
+
+    def __init__(self, model, attributes=None):
+        self.model = model
+        attributes = attributes or {}
+        self.attributes = [(key, attributes.get(key, key))
+                           for key in model]
+        self.columns = []
+        for number, (key, field) in enumerate(model.items()):
+            encoder = _ENCODERS.get(type(field)) \
+                if field.attribute is None and field.default is None \
+                else None
+            prefix = '{' if number == 0 else ', '
+            self.columns.append((prefix + encode_basestring_ascii(key) +
+                                 ': ', attributes.get(key, key), encoder))
+
+    def as_dict(self, obj):
+        """ Returns the model attributes of obj as a dict to marshal """
+        return {key: getattr(obj, attribute, None)
+                for key, attribute in self.attributes}
+
+    def marshal(self, data, mask=None):
+        """ Marshals an object or a list of objects the usual way """
+        if isinstance(data, (list, tuple)):
+            return [marshal(self.as_dict(obj), self.model, mask=mask)
+                    for obj in data]
+        return marshal(self.as_dict(data), self.model, mask=mask)
+
+    def encode_item(self, obj):
+        """ Returns the JSON text of one object """
+        parts = []
+        for prefix, attribute, encoder in self.columns:
+            text = None if encoder is None else \
+                encoder(getattr(obj, attribute, None))
+            if text is None:
+                return json.dumps(marshal(self.as_dict(obj), self.model))
+            parts.append(prefix)
+            parts.append(text)
+        parts.append('}')
+        return ''.join(parts)
+
+    def encode(self, data):
+        """ Returns the JSON response body of an object or list as bytes """
+        if isinstance(data, (list, tuple)):
+            text = '[' + ', '.join([self.encode_item(obj)
+                                    for obj in data]) + ']'
+        else:
+            text = self.encode_item(data)
+        return (text + '\n').encode('ascii')
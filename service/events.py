@@ -0,0 +1,254 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Server-Sent Events of the Inventory changes
+Each worker follows the changes feed with one background thread, started
+by the first subscriber and stopped after the last one leaves, and fans
+the changes out to the connected clients as create, update, delete and
+disable events. The id of an event is the sequence of its change, so a
+client that reconnects with Last-Event-ID gets the changes it missed.
+"""
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+
+from service.metrics import Counter, Gauge
+from service.models import Inventory
+
+EVENT_SUBSCRIBERS = Gauge('inventory_event_subscribers',
+                          'Clients connected to /inventory/events')
+EVENTS_DROPPED = Counter('inventory_event_subscribers_dropped_total',
+                         'Clients disconnected for falling behind')
+
+logger = logging.getLogger(__name__)
+
+def summary(inventory):
+    """ Returns what the filters look at: (product_id, restock, available) """
+    return (inventory.product_id,
+            inventory.quantity < inventory.restock_level,
+            inventory.available)
+
+def classify(change, previous=None):
+    """
+    Returns the type of an event: create (first revision), delete,
+    disable (available turned false) or update. previous is the summary
+    of the Inventory before the change, if known
+    """
+    if change['deleted']:
+        return 'delete'
+    if change['rev'].startswith('1-'):
+        return 'create'
+    if previous is not None and previous[2] and \
+            not change['inventory'].available:
+        return 'disable'
+    return 'update'
+
+def make_event(change, previous=None):
+    """ Returns the event of a change """
+    inventory = change['inventory']
+    return {'id': change['seq'], 'type': classify(change, previous),
+            'key': (change['id'], change['rev']),
+            'current': None if inventory is None else summary(inventory),
+            'previous': previous,
+            'data': {'_id': change['id'],
+                     'inventory': None if inventory is None
+                                  else inventory.serialize()}}
+
+RESET = 'event: reset\ndata: {}\n\n'
+
+def format_event(event):
+    """ Returns an event in the text/event-stream format """
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        event['id'], event['type'], json.dumps(event['data']))
+
+class Subscription():
+    """ The events of one client, filtered by product_id and restock """
+
+    def __init__(self, product_id=None, restock=None, size=1000):
+        self.product_id = product_id
+        self.restock = restock
+        self.events = queue.Queue(size)
+        self.overflowed = False
+
+    def _matches(self, state):
+        return (self.product_id is None or state[0] == self.product_id) \
+            and (self.restock is None or state[1] == self.restock)
+
+    def wants(self, event):
+        """
+        True if the Inventory matches the filters now or did before the
+        change, so the client can drop the ones that stopped matching
+        """
+        if event['current'] is not None and self._matches(event['current']):
+            return True
+        if event['previous'] is not None:
+            return self._matches(event['previous'])
+        # the previous state is unknown, let the client decide
+        return event['type'] != 'create'
+
+    def put(self, event):
+        """ Queues an event, False once the client has fallen behind """
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+        return not self.overflowed
+
+class ChangeHub():
+    """ Shares one long poll of the changes feed between the clients """
+
+    def __init__(self, poll_timeout=25.0, state_size=10000,
+                 retry_delay=1.0):
+        self.poll_timeout = poll_timeout
+        self.state_size = state_size
+        self.retry_delay = retry_delay
+        self.since = None
+        self._subscribers = []
+        self._state = collections.OrderedDict()  # id: summary
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, subscription):
+        """ Adds a subscription, starting to follow the feed if needed """
+        with self._lock:
+            self._subscribers.append(subscription)
+            EVENT_SUBSCRIBERS.inc()
+            if self._thread is None:
+                # read the current sequence first: the changes after it
+                # reach the new subscriber even before the thread polls
+                self.since = Inventory.update_seqs()
+                self._state.clear()
+                self._thread = threading.Thread(target=self._run,
+                                                name='inventory-events',
+                                                daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Removes a subscription """
+        with self._lock:
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+                EVENT_SUBSCRIBERS.dec()
+
+    def position(self):
+        """ Returns the sequence the feed is followed from """
+        since = self.since
+        return None if since is None else ','.join(since)
+
+    def subscribers(self):
+        """ Returns the number of subscriptions """
+        with self._lock:
+            return len(self._subscribers)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+            try:
+                changes, last_seq, _ = Inventory.changes(
+                    self.since, longpoll=True, timeout=self.poll_timeout)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Reading the changes feed failed')
+                time.sleep(self.retry_delay)
+                continue
+            for change in changes:
+                self.publish(make_event(change, self._remember(change)))
+            self.since = last_seq.split(',')
+
+    def _remember(self, change):
+        """ Records the state after a change, returns the one before """
+        previous = self._state.pop(change['id'], None)
+        if not change['deleted']:
+            self._state[change['id']] = summary(change['inventory'])
+            if len(self._state) > self.state_size:
+                self._state.popitem(last=False)
+        return previous
+
+    def publish(self, event):
+        """ Queues an event for the subscriptions that want it """
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            if subscription.wants(event) and not subscription.put(event):
+                EVENTS_DROPPED.inc()
+                self.unsubscribe(subscription)
+
+def replay(last_event_id, limit):
+    """
+    Returns the events after last_event_id, or None if there are more
+    than limit of them (the client has to reload instead)
+    """
+    changes, _, pending = Inventory.changes(last_event_id.split(','), limit)
+    if pending:
+        return None
+    return [make_event(change) for change in changes]
+
+def stream(hub, subscription, last_event_id=None, heartbeat=15.0,
+           duration=300.0, retry=1000, replay_limit=1000):
+    """
+    Yields the text/event-stream of a subscription for duration seconds
+    (the browser reconnects after retry milliseconds), with a comment
+    every heartbeat seconds to keep the connection open
+    """
+    hub.subscribe(subscription)
+    try:
+        yield 'retry: {}\n{}\n'.format(retry, _checkpoint(hub, subscription))
+        replayed = set()
+        events = replay(last_event_id, replay_limit) if last_event_id \
+            else []
+        if events is None:
+            yield RESET
+            events = []
+        for event in events:
+            replayed.add(event['key'])
+            if subscription.wants(event):
+                yield format_event(event)
+        deadline = time.monotonic() + duration
+        while not subscription.overflowed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                event = subscription.events.get(
+                    timeout=min(heartbeat, remaining))
+            except queue.Empty:
+                yield _checkpoint(hub, subscription) + ': keep-alive\n\n'
+                continue
+            if event['key'] not in replayed:
+                yield format_event(event)
+        # fell behind: the client reloads and subscribes again
+        yield RESET
+    finally:
+        hub.unsubscribe(subscription)
+
+def _checkpoint(hub, subscription):
+    """
+    Returns an id line that moves the Last-Event-ID of the client to the
+    position of the hub, when every change before it has been sent
+    """
+    position = hub.position()
+    # the hub queues the events of a page before moving past it
+    if position is None or not subscription.events.empty():
+        return ''
+    return 'id: {}\n'.format(position)
+
+# the one subscription to the changes feed of this worker
+hub = ChangeHub()
@@ -0,0 +1,72 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Streaming export of Inventory as NDJSON or CSV
+Turns the documents read by Inventory.export_docs / export_changes into
+lines as they arrive. The rows have the fields of the import plus the
+_id, so an export can be imported again; the rows of an incremental
+export also carry _deleted and the _seq to resume from after them.
+"""
+import csv
+import io
+import json
+from service.importer import FIELDS
+
+COLUMNS = ('_id',) + FIELDS
+CHANGE_COLUMNS = COLUMNS + ('_deleted', '_seq')
+
+def export_row(doc, seq=None):
+    """ Returns the exported fields of a document """
+    if doc.get('_deleted'):
+        row = {'_id': doc['_id'], '_deleted': True}
+    else:
+        row = {name: doc.get(name) for name in COLUMNS}
+    if seq is not None:
+        row['_seq'] = seq
+    return row
+
+def ndjson_lines(rows):
+    """ Yields one JSON object per line """
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+def csv_lines(rows, columns=COLUMNS):
+    """ Yields the header, then one CSV line per row """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, columns, lineterminator='\n')
+    writer.writeheader()
+    for row in rows:
+        row = dict(row)
+        for name, value in row.items():
+            if isinstance(value, bool):
+                row[name] = 'true' if value else 'false'
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def chunked(lines, size=65536):
+    """ Joins lines into chunks of about size characters """
+    chunk, length = [], 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield ''.join(chunk)
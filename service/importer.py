@@ -0,0 +1,150 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Bulk import of Inventory from NDJSON or CSV
+The rows are read from a stream one line at a time, validated like the
+Inventory posted to /inventory and written with one _bulk_docs request
+per batch, so the memory used doesn't grow with the size of the input.
+"""
+import csv
+import json
+from service.models import Inventory, DataValidationError, IMPORT_BATCH_SIZE
+
+FIELDS = ('product_id', 'quantity', 'restock_level', 'condition',
+          'available')
+INTEGER_FIELDS = ('product_id', 'quantity', 'restock_level')
+BOOLEANS = {'true': True, '1': True, 'yes': True,
+            'false': False, '0': False, 'no': False}
+MAX_ERRORS = 100
+
+def decode_lines(stream):
+    """ Yields the lines of a binary stream as text """
+    for line in stream:
+        yield line.decode('utf8', 'replace')
+
+def parse_ndjson(lines):
+    """ Yields (line number, dict or DataValidationError) """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as error:
+            yield number, DataValidationError('Invalid JSON: {}'
+                                              .format(error))
+            continue
+        if not isinstance(data, dict):
+            yield number, DataValidationError('Invalid Inventory: not an '
+                                              'object')
+        else:
+            yield number, data
+
+def parse_csv(lines):
+    """
+    Yields (line number, dict or DataValidationError) for the rows of a
+    CSV file whose header names the Inventory fields
+    """
+    reader = csv.DictReader(lines)
+    missing = [name for name in FIELDS if name not in (reader.fieldnames
+                                                        or ())]
+    if missing:
+        raise DataValidationError('CSV header is missing {}'
+                                  .format(', '.join(missing)))
+    for row in reader:
+        try:
+            yield reader.line_num, _convert(row)
+        except DataValidationError as error:
+            yield reader.line_num, error
+
+def _convert(row):
+    """ Returns the Inventory data of a CSV row """
+    data = {name: row[name] for name in FIELDS}
+    for name in INTEGER_FIELDS:
+        try:
+            data[name] = int(data[name])
+        except (TypeError, ValueError):
+            raise DataValidationError('Invalid Inventory: {} must be an '
+                                      'integer'.format(name))
+    try:
+        data['available'] = BOOLEANS[(data['available'] or '').lower()]
+    except KeyError:
+        raise DataValidationError('Invalid Inventory: available must be '
+                                  'true or false')
+    return data
+
+class Importer():
+    """ Validates parsed rows and writes them in batches """
+
+    def __init__(self, upsert=False, batch_size=IMPORT_BATCH_SIZE,
+                 max_errors=MAX_ERRORS):
+        if upsert and not Inventory.natural_keys:
+            # without natural keys the stored Inventory can't be matched
+            raise DataValidationError('Upserts need NATURAL_KEYS')
+        self.upsert = upsert
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.summary = {'lines': 0, 'created': 0, 'updated': 0,
+                        'failed': 0, 'errors': []}
+        self._batch = []    # (line number, Inventory)
+        self._keys = set()  # natural keys in the batch
+
+    def run(self, rows):
+        """ Imports (line number, data) rows, returns the summary """
+        for number, data in rows:
+            self.summary['lines'] += 1
+            if isinstance(data, DataValidationError):
+                self.error(number, data)
+                continue
+            try:
+                inventory = Inventory().deserialize(data)
+                inventory.id = None
+                inventory.validate()
+            except DataValidationError as error:
+                self.error(number, error)
+                continue
+            key = Inventory.natural_key(inventory.product_id,
+                                        inventory.condition)
+            if key in self._keys:
+                # a row repeats a key of the batch: it applies after it
+                self.flush()
+            if Inventory.natural_keys:
+                self._keys.add(key)
+            self._batch.append((number, inventory))
+            if len(self._batch) >= self.batch_size:
+                self.flush()
+        self.flush()
+        return self.summary
+
+    def flush(self):
+        """ Writes the pending batch """
+        if not self._batch:
+            return
+        created, updated, errors = Inventory.import_batch(
+            [inventory for _, inventory in self._batch], self.upsert)
+        self.summary['created'] += created
+        self.summary['updated'] += updated
+        for position, message in errors:
+            self.error(self._batch[position][0], message)
+        self._batch = []
+        self._keys = set()
+
+    def error(self, number, error):
+        """ Records the error of a line """
+        self.summary['failed'] += 1
+        if len(self.summary['errors']) < self.max_errors:
+            self.summary['errors'].append({'line': number,
+                                           'error': str(error)})
+        else:
+            self.summary['errors_truncated'] = True
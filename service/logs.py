@@ -0,0 +1,181 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Structured logging for the Inventory service
+Request threads only put the log records on a bounded queue; a
+QueueListener thread formats them as JSON lines and writes them to
+STDOUT. INFO and DEBUG records of the hot path loggers can be sampled or
+rate limited per logger before they are queued, WARNING and above always
+go through.
+
+The messages are formatted lazily: a record keeps its msg and args until
+the listener thread formats it, so a dropped record is never formatted.
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+
+from service.metrics import Counter
+from service.tracing import current_span
+
+LOG_DROPPED = Counter('inventory_log_records_dropped_total',
+                      'Log records dropped by sampling, rate limiting or a '
+                      'full log queue', ('logger', 'reason'))
+
+# attributes of every LogRecord, anything else was passed with extra=
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord(
+    '', 0, '', 0, '', (), None)).keys()) | {'message', 'asctime',
+                                           'trace_id', 'span_id'}
+
+def parse_rates(text, cast=float):
+    """ Parses "flask.app=0.1,werkzeug=0.01" into a dict by logger """
+    rates = {}
+    for item in (text or '').split(','):
+        if not item.strip():
+            continue
+        name, _, rate = item.partition('=')
+        rates[name.strip()] = cast(rate)
+    return rates
+
+def _lookup(rates, name):
+    """ Returns the rate of logger name or of its closest parent """
+    while name:
+        if name in rates:
+            return rates[name]
+        name = name.rpartition('.')[0]
+    return rates.get('root')
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as one JSON object per line """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.utcfromtimestamp(record.created)
+                    .isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'message': record.getMessage()}
+        for name in ('trace_id', 'span_id'):
+            if getattr(record, name, None):
+                entry[name] = getattr(record, name)
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction (sample_rates) or at most a number per second
+    (rate_limits) of the INFO and DEBUG records of each logger
+    """
+
+    def __init__(self, sample_rates=None, rate_limits=None,
+                 clock=time.monotonic):
+        super().__init__()
+        self.sample_rates = sample_rates or {}
+        self.rate_limits = rate_limits or {}
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = _lookup(self.sample_rates, record.name)
+        if rate is not None and random.random() >= rate:
+            LOG_DROPPED.inc(logger=record.name, reason='sampled')
+            return False
+        limit = _lookup(self.rate_limits, record.name)
+        if limit is not None and not self._take(record.name, limit):
+            LOG_DROPPED.inc(logger=record.name, reason='rate_limited')
+            return False
+        return True
+
+    def _take(self, name, limit):
+        """ Takes a token from the bucket of logger name """
+        now = self.clock()
+        with self._lock:
+            tokens, last = self._buckets.get(name, (limit, now))
+            tokens = min(limit, tokens + (now - last) * limit)
+            if tokens < 1:
+                self._buckets[name] = (tokens, now)
+                return False
+            self._buckets[name] = (tokens - 1, now)
+            return True
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records without formatting them, and drops them when the
+    queue is full rather than blocking the request thread
+    """
+
+    def prepare(self, record):
+        # the listener runs outside of the request context
+        active = current_span()
+        if active is not None:
+            record.trace_id = active.trace.trace_id
+            record.span_id = active.span_id
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc(logger=record.name, reason='queue_full')
+
+_LISTENER = None
+
+def stop_listener():
+    """ Writes the queued records and stops the listener thread """
+    global _LISTENER  # pylint: disable=global-statement
+    if _LISTENER is not None:
+        _LISTENER.stop()
+        _LISTENER = None
+
+def configure_json_logging(loggers, level, stream, sample_rates=None,
+                           rate_limits=None, queue_size=10000):
+    """
+    Replaces the handlers of loggers with a queue handler feeding a JSON
+    writer thread, returns the queue handler
+    """
+    stop_listener()
+    records = queue.Queue(queue_size)
+    writer = logging.StreamHandler(stream)
+    writer.setFormatter(JsonFormatter())
+    handler = LazyQueueHandler(records)
+    handler.setLevel(level)
+    handler.addFilter(SamplingFilter(sample_rates, rate_limits))
+    for logger in loggers:
+        for old in list(logger.handlers):
+            logger.removeHandler(old)
+        logger.addHandler(handler)
+        logger.setLevel(level)
+    global _LISTENER  # pylint: disable=global-statement
+    _LISTENER = logging.handlers.QueueListener(records, writer)
+    _LISTENER.start()
+    return handler
+
+atexit.register(stop_listener)
@@ -0,0 +1,152 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Memory profiling for the Inventory service
+Process RSS and peak RSS, tracemalloc snapshots diffed against the
+previous one, and the memory each endpoint allocates.
+
+The per-endpoint peaks come from the process wide tracemalloc peak,
+reset at the start of every request, so they are exact when a worker
+handles one request at a time and an upper bound otherwise. Python
+before 3.9 can't reset the peak (tracemalloc.reset_peak), and there the
+endpoints have no peak at all.
+"""
+import os
+import sys
+import threading
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # pragma: no cover (not on Windows)
+    resource = None
+
+# whether the tracemalloc peak can be measured per request
+REQUEST_PEAKS = hasattr(tracemalloc, 'reset_peak')
+
+def rss_bytes():
+    """ Returns the resident set size of the process """
+    try:
+        with open('/proc/self/statm') as stream:
+            return int(stream.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+def peak_rss_bytes():
+    """ Returns the highest resident set size of the process """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _site(stat):
+    """ Returns an allocation site of a Statistic(Diff) as a dict """
+    frame = stat.traceback[0]
+    site = {'file': frame.filename, 'line': frame.lineno,
+            'size_bytes': stat.size, 'count': stat.count}
+    if hasattr(stat, 'size_diff'):
+        site['size_diff_bytes'] = stat.size_diff
+        site['count_diff'] = stat.count_diff
+    if len(stat.traceback) > 1:
+        site['traceback'] = ['{}:{}'.format(item.filename, item.lineno)
+                             for item in stat.traceback]
+    return site
+
+class MemoryProfiler():
+    """ tracemalloc snapshots and per-endpoint memory statistics """
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.request_peaks = REQUEST_PEAKS
+        self.endpoints = {}
+        self._previous = None
+        self._lock = threading.Lock()
+        self._filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>')]
+
+    @property
+    def tracing(self):
+        """ True while tracemalloc traces allocations """
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        """ Starts tracing allocations """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self):
+        """ Stops tracing and forgets the snapshots """
+        tracemalloc.stop()
+        with self._lock:
+            self._previous = None
+
+    def snapshot(self, limit=20, group_by='lineno'):
+        """
+        Takes a snapshot and returns its top allocation sites, and the top
+        differences with the previous snapshot (which it replaces)
+        """
+        self.start()
+        snapshot = tracemalloc.take_snapshot().filter_traces(self._filters)
+        with self._lock:
+            previous, self._previous = self._previous, snapshot
+        report = self.usage()
+        report['top'] = [_site(stat) for stat in
+                         snapshot.statistics(group_by)[:limit]]
+        if previous is not None:
+            report['diff'] = [_site(stat) for stat in
+                              snapshot.compare_to(previous, group_by)[:limit]]
+        return report
+
+    def usage(self):
+        """ Returns the process and tracemalloc memory figures """
+        current, peak = tracemalloc.get_traced_memory()
+        return {'rss_bytes': rss_bytes(), 'peak_rss_bytes': peak_rss_bytes(),
+                'tracing': self.tracing, 'traced_bytes': current,
+                'traced_peak_bytes': peak}
+
+    def request_started(self):
+        """ Returns the memory state at the start of a request """
+        if self.tracing and self.request_peaks:
+            tracemalloc.reset_peak()
+        return rss_bytes(), tracemalloc.get_traced_memory()[0]
+
+    def request_finished(self, endpoint, started):
+        """ Records the memory used by a request to endpoint """
+        rss_before, traced_before = started
+        rss_after = rss_bytes()
+        traced_after, traced_peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'max_rss_bytes': 0, 'rss_growth_bytes': 0,
+                'retained_bytes': 0})
+            stats['requests'] += 1
+            stats['max_rss_bytes'] = max(stats['max_rss_bytes'], rss_after)
+            stats['rss_growth_bytes'] += max(rss_after - rss_before, 0)
+            if self.tracing:
+                stats['retained_bytes'] += traced_after - traced_before
+                # without reset_peak the peak is the process' highest
+                if self.request_peaks:
+                    stats['max_allocated_bytes'] = max(
+                        stats.get('max_allocated_bytes', 0),
+                        traced_peak - traced_before)
+
+    def endpoint_report(self):
+        """ Returns a copy of the per-endpoint statistics """
+        with self._lock:
+            return {endpoint: dict(stats)
+                    for endpoint, stats in sorted(self.endpoints.items())}
@@ -0,0 +1,358 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Metrics for the Inventory service
+A minimal, thread safe registry of counters, gauges and histograms that
+renders the Prometheus text exposition format served on GET /metrics
+
+Metrics
+-------
+inventory_http_request_duration_seconds (histogram) endpoint, method
+inventory_http_requests_in_flight (gauge)
+inventory_http_responses_total (counter) endpoint, method, status
+inventory_db_operation_duration_seconds (histogram) operation
+inventory_db_retries_total (counter) status
+inventory_db_throttled_total (counter)
+
+It also collects the per-request phase timings (db, deserialize, marshal)
+returned in the Server-Timing header
+"""
+import time
+import threading
+import functools
+import contextvars
+from service.tracing import current_span
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5,
+                   0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+def _format_value(value):
+    """ Formats a sample value the way Prometheus expects """
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _format_labels(names, values, extra=None):
+    """ Formats a label set as {name="value",...} """
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = ['{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                                .replace('"', r'\"').replace('\n', r'\n'))
+               for name, value in pairs]
+    return '{' + ','.join(escaped) + '}'
+
+class Registry():
+    """ Holds every metric rendered by /metrics """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """ Adds a metric to the registry """
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Returns every metric in the Prometheus text format """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """ Clears every recorded value (use for testing) """
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            metric.reset()
+
+REGISTRY = Registry()
+
+class Metric():
+    """ Base class of the metrics: a value per label set """
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        """ Returns the label values in declaration order """
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def reset(self):
+        """ Clears every recorded value """
+        with self._lock:
+            self._values = {}
+
+    def value(self, **labels):
+        """ Returns the current value for a label set """
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        """ Returns the exposition lines of the metric """
+        with self._lock:
+            items = sorted(self._values.items())
+        return ['{}{} {}'.format(self.name, _format_labels(self.labels, key),
+                                 _format_value(value))
+                for key, value in items]
+
+class Counter(Metric):
+    """ A value that only goes up """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """ Increments the counter """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """ A value that goes up and down """
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        """ Increments the gauge """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """ Decrements the gauge """
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        """ Sets the gauge """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    """ Counts observations into cumulative buckets """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        super().__init__(name, help_text, labels, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, amount, **labels):
+        """ Records an observation """
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key,
+                                             ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + amount)
+
+    def value(self, **labels):
+        """ Returns the (count, sum) of the observations for a label set """
+        with self._lock:
+            counts, total = self._values.get(self._key(labels),
+                                             ([0] * len(self.buckets), 0.0))
+        return counts[-1], total
+
+    def time(self, **labels):
+        """ Times a block or a function (as a decorator) """
+        return _Timer(self, labels)
+
+    def samples(self):
+        """ Returns the _bucket, _sum and _count exposition lines """
+        with self._lock:
+            items = sorted((key, (list(counts), total))
+                           for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts):
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(self.labels, key,
+                                   ('le', _format_value(bound))),
+                    count))
+            labels = _format_labels(self.labels, key)
+            lines.append('{}_sum{} {}'.format(self.name, labels,
+                                              _format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, labels,
+                                                counts[-1]))
+        return lines
+
+class _Timer():
+    """ Context manager and decorator observing elapsed time """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self._starts = threading.local()
+
+    def __enter__(self):
+        stack = getattr(self._starts, 'stack', [])
+        stack.append(time.perf_counter())
+        self._starts.stack = stack
+        return self
+
+    def __exit__(self, *exc):
+        started = self._starts.stack.pop()
+        self.histogram.observe(time.perf_counter() - started, **self.labels)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+######################################################################
+#  P E R - R E Q U E S T   T I M I N G S
+######################################################################
+_TIMINGS = contextvars.ContextVar('inventory_timings', default=None)
+
+class Timings():
+    """
+    Durations and counts of the phases of one request, rendered as a
+    Server-Timing header. Phases may be recorded from several threads
+    (shard queries) so the durations are cumulative, not wall clock
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        """ Adds the duration of one occurrence of a phase """
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def header(self):
+        """ Returns the Server-Timing header value """
+        with self._lock:
+            durations = dict(self.durations)
+            calls = self.counts.get('db', 0)
+        entries = ['{};dur={:.3f}'.format(name, seconds * 1000.0)
+                   for name, seconds in sorted(durations.items())]
+        entries.append('db-calls;desc="{}"'.format(calls))
+        entries.append('total;dur={:.3f}'.format(
+            (time.perf_counter() - self.started) * 1000.0))
+        return ', '.join(entries)
+
+def start_timings():
+    """ Starts collecting the timings of the current request """
+    timings = Timings()
+    _TIMINGS.set(timings)
+    return timings
+
+def stop_timings():
+    """ Stops collecting timings, returns what was collected """
+    timings = _TIMINGS.get()
+    _TIMINGS.set(None)
+    return timings
+
+def record_phase(name, seconds):
+    """ Records a phase duration if the current request collects timings """
+    timings = _TIMINGS.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+class phase():  # pylint: disable=invalid-name
+    """ Context manager and decorator recording a phase of the request """
+
+    def __init__(self, name):
+        self.name = name
+        self._starts = threading.local()
+
+    def __enter__(self):
+        stack = getattr(self._starts, 'stack', [])
+        stack.append(time.perf_counter())
+        self._starts.stack = stack
+        return self
+
+    def __exit__(self, *exc):
+        record_phase(self.name, time.perf_counter() - self._starts.stack.pop())
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _TIMINGS.get() is None:
+                return func(*args, **kwargs)
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+######################################################################
+#  S E R V I C E   M E T R I C S
+######################################################################
+HTTP_DURATION = Histogram('inventory_http_request_duration_seconds',
+                          'Time spent handling requests',
+                          labels=('endpoint', 'method'))
+HTTP_IN_FLIGHT = Gauge('inventory_http_requests_in_flight',
+                       'Requests currently being handled')
+HTTP_RESPONSES = Counter('inventory_http_responses_total',
+                         'Responses sent, by status code',
+                         labels=('endpoint', 'method', 'status'))
+DB_DURATION = Histogram('inventory_db_operation_duration_seconds',
+                        'Time spent in CouchDB operations of the model, '
+                        'retries included',
+                        labels=('operation',))
+DB_RETRIES = Counter('inventory_db_retries_total',
+                     'Operations retried by the model after an HTTP error',
+                     labels=('status',))
+DB_THROTTLED = Counter('inventory_db_throttled_total',
+                       '429 Too Many Requests responses replayed by the '
+                       'Cloudant adapter')
+
+class RetryLogger():
+    """
+    Logger handed to the @retry decorators
+    Counts every retry in DB_RETRIES, marks it on the active trace span
+    and logs it with the wrapped logger
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def warning(self, msg, *args, **kwargs):
+        """ Called by retry before each new attempt """
+        error = args[0] if args else None
+        response = getattr(error, 'response', None)
+        DB_RETRIES.inc(status=getattr(response, 'status_code', 'error'))
+        active = current_span()
+        if active is not None:
+            active.event('retry', error=str(error),
+                         delay=args[1] if len(args) > 1 else None)
+        self.logger.warning(msg, *args, **kwargs)
@@ -29,28 +29,151 @@ condition (string) ( new / open box / used )
 available (boolean)
 """
 import os
+import copy
 import json
+import uuid
+import zlib
+import heapq
+import time
 import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from retry import retry
 from cloudant.client import Cloudant
+from cloudant.document import Document
 from cloudant.query import Query
 from cloudant.adapters import Replay429Adapter
-from requests import HTTPError
+from cloudant.error import CloudantDatabaseException
+from requests import HTTPError, RequestException
+from requests.packages.urllib3.util.retry import Retry
+from service.metrics import DB_DURATION, DB_THROTTLED, RetryLogger, \
+    phase, record_phase
+from service.tracing import span, traced, current_span
+from service.querylog import QueryLog
+from service.singleflight import SingleFlight
+from service.cache import NegativeCache
 
 # get configruation from enviuronment (12-factor)
 ADMIN_PARTY = os.environ.get('ADMIN_PARTY', 'False').lower() == 'true'
 CLOUDANT_HOST = os.environ.get('CLOUDANT_HOST', 'localhost')
 CLOUDANT_USERNAME = os.environ.get('CLOUDANT_USERNAME', 'admin')
 CLOUDANT_PASSWORD = os.environ.get('CLOUDANT_PASSWORD', 'pass')
+# use <product_id>:<condition> as the document id (see migrate_natural_keys)
+NATURAL_KEYS = os.environ.get('NATURAL_KEYS', 'False').lower() == 'true'
+# create new databases partitioned by product_id
+PARTITIONED = os.environ.get('PARTITIONED', 'False').lower() == 'true'
+# spread documents over several databases by product_id: either a number of
+# databases on the same server, or a JSON list of {url, username, password,
+# dbname} overrides (one per shard, possibly on different hosts)
+SHARDS = os.environ.get('SHARDS', '')
+# requests that may scatter across the shards at once (gunicorn --threads):
+# the shard queries run on a pool of SCATTER_THREADS threads per shard
+SCATTER_THREADS = int(os.environ.get('SCATTER_THREADS', 8))
+# read from a replica of the database (per shard: "replica_url" in SHARDS)
+REPLICA_URL = os.environ.get('REPLICA_URL', '')
+# seconds a failed replica is skipped before reads try it again
+REPLICA_RETRY_INTERVAL = float(os.environ.get('REPLICA_RETRY_INTERVAL', 30))
+# seconds a replica request may take before the read fails over, so a
+# replica that hangs is skipped like one that refuses connections
+REPLICA_TIMEOUT = float(os.environ.get('REPLICA_TIMEOUT', 5))
+# seconds a client keeps reading from the primary after it writes
+READ_YOUR_WRITES = float(os.environ.get('READ_YOUR_WRITES', 5))
+
+# Mango queries slower than this (ms) are logged with their execution_stats
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+# JSON lines file of the slow queries read by "flask recommend-indexes"
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', '')
+# seconds the index a slow query shape used is remembered before explaining
+# it again (indexes may have been created meanwhile)
+EXPLAIN_TTL = float(os.environ.get('EXPLAIN_TTL', 300))
+# documents per _find request (pages are followed with the bookmark)
+QUERY_PAGE_SIZE = int(os.environ.get('QUERY_PAGE_SIZE', 100))
+# documents per _bulk_docs request of POST /inventory/import
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 500))
+# documents per _all_docs / _changes request of GET /inventory/export
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', 1000))
+# seconds between the polls of the shards of a long polled GET
+# /inventory/changes (a single database waits in CouchDB)
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 1))
+
+# share one request between the identical find / find_by calls in flight
+COALESCE_READS = os.environ.get('COALESCE_READS', 'True').lower() == 'true'
+
+# seconds the ids found missing are answered without a lookup, and the
+# number of them remembered
+NEGATIVE_CACHE_TTL = float(os.environ.get('NEGATIVE_CACHE_TTL', 5))
+NEGATIVE_CACHE_SIZE = int(os.environ.get('NEGATIVE_CACHE_SIZE', 10000))
+
+# the conditions an Inventory can be in
+CONDITIONS = ('new', 'open_box', 'used')
 
 # global variables for retry (must be int)
 RETRY_COUNT = int(os.environ.get('RETRY_COUNT', 10))
 RETRY_DELAY = int(os.environ.get('RETRY_DELAY', 1))
 RETRY_BACKOFF = int(os.environ.get('RETRY_BACKOFF', 2))
 
+class MeteredReplay429Adapter(Replay429Adapter):
+    """
+    Replay429Adapter that counts the 429 responses it replays and records
+    every CouchDB call in the request's db timing and trace
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredReplay429Adapter, self).__init__(*args, **kwargs)
+        # urllib3 copies the class of the Retry on every increment
+        self.max_retries.__class__ = _MeteredRetry
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        """
+        Sends the request, timing it as a db call and a trace span. The
+        adapter returns once the headers arrive and Session.send reads the
+        body after it, so a body that isn't streamed is read here to be
+        part of the call
+        """
+        started = time.perf_counter()
+        with span('couchdb ' + request.method,
+                  **{'http.method': request.method,
+                     'http.path': request.path_url.split('?')[0]}) as call:
+            try:
+                response = super(MeteredReplay429Adapter, self).send(
+                    request, **kwargs)
+                if not kwargs.get('stream'):
+                    response.content  # pylint: disable=pointless-statement
+            finally:
+                record_phase('db', time.perf_counter() - started)
+            call.set('http.status_code', response.status_code)
+            return response
+
+class _MeteredRetry(Retry):
+    """ urllib3 Retry that records 429 responses in DB_THROTTLED """
+
+    def increment(self, *args, **kwargs):
+        response = kwargs.get('response')
+        if response is not None and response.status == 429:
+            DB_THROTTLED.inc()
+            active = current_span()
+            if active is not None:
+                active.event('throttled', status=429)
+        return super(_MeteredRetry, self).increment(*args, **kwargs)
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
+class DuplicateKeyError(DataValidationError):
+    """ Used when an Inventory already exists for a product and condition """
+
+def _copy_result(result):
+    """ Copies the Inventory of a read, the callers may change them """
+    if isinstance(result, list):
+        return [copy.copy(inventory) for inventory in result]
+    return copy.copy(result)
+
+# the reads pinned to the primary after a write of their thread must see
+# it: they never join a read that may have started before
+reads = SingleFlight(copy=_copy_result, enabled=COALESCE_READS,
+                     bypass=lambda: Inventory.primary_until() > time.time())
+
 class Inventory():
     """
     Class that represents an inventory
@@ -58,8 +181,24 @@ class Inventory():
     from us by SQLAlchemy's object relational mappings (ORM)
     """
     logger = logging.getLogger('flask.app')
+    retry_logger = RetryLogger(logger)
+    query_log = QueryLog(SLOW_QUERY_MS, SLOW_QUERY_LOG or None, logger,
+                         EXPLAIN_TTL)
     client = None   # cloudant.client.Cloudant
     database = None # cloudant.database.CloudantDatabase
+    clients = []    # every client, including the shards' ones
+    shards = []     # the shard databases when sharded (see SHARDS)
+    executor = None # runs the scatter-gather queries across shards
+    replicas = {}   # id() of a primary database -> its replica database
+    replica_down_until = {} # id() of a primary -> time its replica may be
+                            # retried (shards on several hosts may share a
+                            # database name)
+    _local = threading.local() # read-your-writes pin of the current thread
+    natural_keys = NATURAL_KEYS
+    partitioned = False # set by init_db from the database properties
+    restock_listeners = [] # called with the restock crossing of a write
+    missing = NegativeCache(NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_SIZE)
+    write_version = 0 # changed by every write of this process
 
     def __init__(self, product_id=None,
                  quantity=None, restock_level=None,
@@ -71,45 +210,83 @@ class Inventory():
         self.condition = condition
         self.available = available
 
+    @DB_DURATION.time(operation='create')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
+           tries=RETRY_COUNT, logger=retry_logger)
     def create(self):
         """
         Creates a new Inventory in the database
         """
-        if self.product_id is None:
-            raise DataValidationError('product_id is not set')
-        if self.quantity is None:
-            raise DataValidationError('quantity is not set')
-        if self.restock_level is None:
-            raise DataValidationError('restock_level is not set')
-        if self.condition is None or (self.condition != "new" and self.condition != "open_box" and self.condition != "used"):
-            raise DataValidationError('condition is not set to new/open_box/used')
+        self.validate()
+        data = self.serialize()
+        if Inventory.natural_keys:
+            data['_id'] = Inventory.natural_key(self.product_id,
+                                                self.condition)
+        elif Inventory.partitioned or Inventory.shards:
+            data['_id'] = Inventory.partitioned_id(self.product_id)
+        database = Inventory.database_for(self.product_id)
         try:
             Inventory.logger.info("Create an new inventory")
-            document = self.database.create_document(self.serialize())
+            document = database.create_document(
+                data, throw_on_exists=Inventory.natural_keys)
+        except CloudantDatabaseException:
+            raise DuplicateKeyError('Inventory {} already exists'
+                                    .format(data['_id']))
         except HTTPError as err:
             Inventory.logger.warning('Create failed: %s', err)
             return
         if document.exists():
             self.id = document['_id']
+            Inventory.missing.discard(self.id)
+            Inventory.wrote()
+            Inventory.notify_restock(None, document)
+
+    def validate(self):
+        """ Checks that the Inventory can be created """
+        if self.product_id is None:
+            raise DataValidationError('product_id is not set')
+        if self.quantity is None:
+            raise DataValidationError('quantity is not set')
+        if self.restock_level is None:
+            raise DataValidationError('restock_level is not set')
+        if self.condition not in CONDITIONS:
+            raise DataValidationError('condition is not set to '
+                                      'new/open_box/used')
 
+    @DB_DURATION.time(operation='update')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
+           tries=RETRY_COUNT, logger=retry_logger)
     def update(self):
-        """ Updates an Inventory in the database """
-        if self.id:
-            Inventory.logger.info("Update an inventory: {%s}", self.id)
+        """
+        Updates an Inventory in the database
+        With natural keys, a partitioned database or shards, changing the
+        product_id (or condition) moves the document to its new id
+        """
+        if self.id and self._key_moved():
+            Inventory.logger.info("Move an inventory: {%s}", self.id)
+            old = Inventory()
+            old.id = self.id
+            self.id = None
             try:
-                document = self.database[self.id]
-            except KeyError:
-                document = None
+                self.create()
+            except DuplicateKeyError:
+                self.id = old.id
+                raise
+            old.delete()
+        elif self.id:
+            Inventory.logger.info("Update an inventory: {%s}", self.id)
+            database = Inventory.database_for_id(self.id)
+            document = None if database is None else \
+                Inventory.fetch(database, self.id)
             if document:
+                previous = dict(document)
                 document.update(self.serialize())
                 document.save()
+                Inventory.wrote()
+                Inventory.notify_restock(previous, document)
 
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
+           tries=RETRY_COUNT, logger=retry_logger)
     def save(self):
         """
         Saves an Inventory to DB
@@ -119,6 +296,54 @@ class Inventory():
         else:
             self.create()
 
+    @staticmethod
+    def restock_crossing(previous, current):
+        """
+        Returns 'below' when a write takes the quantity of a document
+        under its restock level, 'above' when it takes it back to or over
+        it, and None otherwise. previous is None for a new document
+        """
+        def needs_restock(doc):
+            return doc is not None and \
+                doc.get('quantity') < doc.get('restock_level')
+        try:
+            before, after = needs_restock(previous), needs_restock(current)
+        except TypeError:  # a quantity or restock level is missing
+            return None
+        if before == after:
+            return None
+        return 'below' if after else 'above'
+
+    @classmethod
+    def notify_restock(cls, previous, current):
+        """ Calls the restock listeners if a write crossed the level """
+        if not cls.restock_listeners:
+            return
+        crossing = cls.restock_crossing(previous, current)
+        if crossing is None:
+            return
+        event = {'id': '{}:{}'.format(current['_id'], current['_rev']),
+                 'crossing': crossing, 'inventory_id': current['_id'],
+                 'product_id': current['product_id'],
+                 'condition': current['condition'],
+                 'quantity': current['quantity'],
+                 'restock_level': current['restock_level']}
+        for listener in cls.restock_listeners:
+            try:
+                listener(event)
+            except Exception:  # pylint: disable=broad-except
+                # a listener never fails the write
+                cls.logger.exception('Restock listener failed')
+
+    def _key_moved(self):
+        """ Returns True when the id no longer matches product/condition """
+        if Inventory.natural_keys:
+            return self.id != Inventory.natural_key(self.product_id,
+                                                    self.condition)
+        if Inventory.partitioned or Inventory.shards:
+            return self.id.split(':', 1)[0] != str(self.product_id)
+        return False
+
     def serialize(self):
         """ Serializes an Inventory into a dictionary """
         inventory = {
@@ -132,6 +357,8 @@ class Inventory():
             inventory['_id'] = self.id
         return inventory
 
+    @traced('deserialize')
+    @phase('deserialize')
     def deserialize(self, data):
         """
         Deserializes a Inventory from a dictionary
@@ -168,46 +395,544 @@ class Inventory():
 
         return self
 
+    @DB_DURATION.time(operation='delete')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
+           tries=RETRY_COUNT, logger=retry_logger)
     def delete(self):
         """ Deletes an Inventory from the database """
-        if self.id:
-            try:
-                document = self.database[self.id]
-            except KeyError:
-                document = None
+        database = Inventory.database_for_id(self.id) if self.id else None
+        if database is not None:
+            document = Inventory.fetch(database, self.id)
             if document:
                 document.delete()
+                Inventory.wrote()
 
 ######################################################################
 #  S T A T I C   D A T A B S E   M E T H O D S
 ######################################################################
+    @staticmethod
+    def fetch(database, inventory_id):
+        """
+        Returns the stored Document of an id, None when it doesn't exist.
+        database[inventory_id] would answer from the documents the client
+        cached, which the bulk writes, the other workers and the writes
+        to a replica's primary leave stale
+        """
+        document = Document(database, inventory_id)
+        try:
+            document.fetch()
+        except HTTPError as error:
+            if error.response is not None and \
+                    error.response.status_code == 404:
+                return None
+            raise
+        return document
+
     @classmethod
     def connect(cls,adapter=Replay429Adapter(retries=10, initialBackoff=0.01)):
         """ Connect to the server """
-        cls.client.connect()
+        for client in cls.clients:
+            client.connect()
 
     @classmethod
     def disconnect(cls):
         """ Disconnect from the server """
-        cls.client.disconnect()
+        for client in cls.clients:
+            client.disconnect()
 
     @classmethod
     def remove_all(cls):
         """ Removes all documents from the database (use for testing)  """
-        for document in cls.database:
-            document.delete()
+        for database in cls.databases():
+            for document in database:
+                document.delete()
+            database.clear()
+        cls.write_version += 1
+
+    @classmethod
+    def databases(cls):
+        """ Returns every database the Inventory are stored in """
+        return cls.shards or [cls.database]
+
+    @classmethod
+    def database_for(cls, product_id):
+        """ Returns the database that holds the Inventory of product_id """
+        if not cls.shards:
+            return cls.database
+        digest = zlib.crc32(str(product_id).encode('utf8'))
+        return cls.shards[digest % len(cls.shards)]
+
+    @classmethod
+    def database_for_id(cls, inventory_id):
+        """
+        Returns the database that holds an Inventory id
+        Sharded ids are prefixed by their product_id; None is returned
+        for an id that cannot belong to any shard
+        """
+        if not cls.shards:
+            return cls.database
+        product_id, sep, _ = inventory_id.partition(':')
+        if not sep or not product_id.lstrip('-').isdigit():
+            return None
+        return cls.database_for(int(product_id))
+
+    @classmethod
+    def wrote(cls):
+        """
+        Records a write of this thread: changes write_version and pins
+        the thread's reads to the primary
+        """
+        cls.write_version += 1
+        cls.pin_primary()
+
+    @classmethod
+    def pin_primary(cls, until=None):
+        """
+        Sends this thread's reads to the primary until the given time
+        (by default READ_YOUR_WRITES seconds from now, after a write)
+        """
+        if until is None:
+            until = time.time() + READ_YOUR_WRITES
+        cls._local.primary_until = max(until, cls.primary_until())
+
+    @classmethod
+    def primary_until(cls):
+        """ Returns the time this thread's reads are pinned to the primary """
+        return getattr(cls._local, 'primary_until', 0)
 
     @classmethod
+    def unpin_primary(cls):
+        """ Lets this thread read from the replicas again """
+        cls._local.primary_until = 0
+
+    @classmethod
+    def read(cls, func, database, pinned=None):
+        """
+        Calls func with the replica of database, or with database itself
+        when there is no healthy replica or the reads are pinned to the
+        primary. A replica that fails is skipped for REPLICA_RETRY_INTERVAL
+        seconds and the read is retried on the primary
+        """
+        if pinned is None:
+            pinned = cls.primary_until() > time.time()
+        replica = cls.replica_of(database)
+        if pinned or replica is None or \
+                cls.replica_down_until.get(id(database), 0) > time.time():
+            return func(database)
+        try:
+            return func(replica)
+        except RequestException as error:
+            response = getattr(error, 'response', None)
+            if response is not None and response.status_code < 500:
+                raise
+            cls.logger.warning('Replica of [%s] failed, reading from the '
+                               'primary: %s', database.database_name, error)
+            cls.replica_down_until[id(database)] = \
+                time.time() + REPLICA_RETRY_INTERVAL
+            return func(database)
+
+    @classmethod
+    def replica_of(cls, database):
+        """ Returns the read replica of a database, or None """
+        return cls.replicas.get(id(database))
+
+    @classmethod
+    def scatter_read(cls, func, databases=None):
+        """ Reads with func from every database (or replica) concurrently """
+        pinned = cls.primary_until() > time.time()
+        return cls.scatter(lambda database: cls.read(func, database, pinned),
+                           databases)
+
+    @classmethod
+    def scatter(cls, func, items=None):
+        """
+        Calls func on every database (or item) concurrently
+        Returns the results in the same order
+        """
+        items = cls.databases() if items is None else list(items)
+        if cls.executor is None or len(items) < 2:
+            return [func(item) for item in items]
+        # run each call in a copy of the caller's context (request timings)
+        contexts = [contextvars.copy_context() for _ in items]
+        return list(cls.executor.map(
+            lambda context, item: context.run(func, item), contexts, items))
+
+    @staticmethod
+    def natural_key(product_id, condition):
+        """ Returns the natural-key document id of a product and condition """
+        return '{}:{}'.format(product_id, condition)
+
+    @staticmethod
+    def partitioned_id(product_id):
+        """ Returns a new document id in the partition of product_id """
+        return '{}:{}'.format(product_id, uuid.uuid4().hex)
+
+    @classmethod
+    @reads.coalesce('find_by_key_range')
+    @DB_DURATION.time(operation='find_by_key_range')
+    def find_by_key_range(cls, product_id):
+        """ Returns every Inventory whose id is prefixed by product_id """
+        prefix = cls.natural_key(product_id, '')
+
+        def fetch(database):
+            if cls.partitioned:
+                return database.partitioned_all_docs(
+                    str(product_id), include_docs=True).get('rows', [])
+            return database.all_docs(startkey=prefix,
+                                     endkey=prefix + '\ufff0',
+                                     include_docs=True).get('rows', [])
+        rows = cls.read(fetch, cls.database_for(product_id))
+        return [Inventory().deserialize(row['doc']) for row in rows]
+
+    @classmethod
+    def migrate_natural_keys(cls, merge=False, batch_size=500):
+        """
+        Rewrites every document under its <product_id>:<condition> id
+        Documents sharing a natural key are duplicates: the first one wins
+        and the others are left untouched, unless merge is True in which
+        case their quantities are added to the winner and they are removed.
+        Returns a dict of statistics
+        """
+        cls._check_unsharded()
+        cls.logger.info('Migrating documents to natural keys ...')
+        stats = {'migrated': 0, 'unchanged': 0, 'merged': 0,
+                 'duplicates': []}
+        keyed = {}
+        legacy = []
+        for doc in cls.database:
+            if doc['_id'].startswith('_design/'):
+                continue
+            key = cls.natural_key(doc['product_id'], doc['condition'])
+            if doc['_id'] == key:
+                keyed[key] = dict(doc)
+                stats['unchanged'] += 1
+            else:
+                legacy.append(dict(doc))
+        writes = {}
+        deletes = []
+        for doc in legacy:
+            key = cls.natural_key(doc['product_id'], doc['condition'])
+            winner = writes.get(key) or keyed.get(key)
+            if winner is None:
+                winner = {k: v for k, v in doc.items()
+                          if not k.startswith('_')}
+                winner['_id'] = key
+                stats['migrated'] += 1
+            elif merge:
+                winner['quantity'] += doc['quantity']
+                winner['restock_level'] = max(winner['restock_level'],
+                                              doc['restock_level'])
+                winner['available'] = winner['available'] or \
+                                       doc['available']
+                stats['merged'] += 1
+            else:
+                stats['duplicates'].append(doc['_id'])
+                continue
+            writes[key] = winner
+            deletes.append({'_id': doc['_id'], '_rev': doc['_rev'],
+                            '_deleted': True})
+        # write the new documents before removing the old ones
+        cls.bulk_save(cls.database, list(writes.values()), batch_size)
+        cls.bulk_save(cls.database, deletes, batch_size)
+        cls.database.clear()
+        return stats
+
+    @classmethod
+    def migrate_partitioned(cls, target_dbname, batch_size=500):
+        """
+        Copies every document into a new database partitioned by product_id
+        Ids that are not already prefixed by their product_id (natural keys
+        are) become <product_id>:<old id>. Documents already copied are
+        skipped, so an interrupted migration can simply be run again.
+        Returns the number of documents written
+        """
+        cls._check_unsharded()
+        cls.logger.info('Copying documents to partitioned [%s] ...',
+                        target_dbname)
+        try:
+            target = cls.client[target_dbname]
+        except KeyError:
+            target = cls.client.create_database(target_dbname,
+                                                partitioned=True)
+        if not target.metadata().get('props', {}).get('partitioned'):
+            raise DataValidationError('Database [{}] is not partitioned'
+                                      .format(target_dbname))
+        docs = []
+        for doc in cls.database:
+            if doc['_id'].startswith('_design/'):
+                continue
+            data = {k: v for k, v in doc.items() if not k.startswith('_')}
+            prefix = '{}:'.format(doc['product_id'])
+            data['_id'] = doc['_id'] if doc['_id'].startswith(prefix) \
+                else prefix + doc['_id']
+            docs.append(data)
+        return cls.bulk_save(target, docs, batch_size, skip_conflicts=True)
+
+    @classmethod
+    def _check_unsharded(cls):
+        """ Migrations rewrite a single database """
+        if cls.shards:
+            raise DataValidationError('Migrations need an unsharded database')
+
+    @classmethod
+    @DB_DURATION.time(operation='bulk_save')
+    def bulk_save(cls, database, docs, batch_size=500, skip_conflicts=False):
+        """
+        Writes documents with _bulk_docs in batches of batch_size
+        Returns the number of documents written
+        """
+        written = 0
+        for start in range(0, len(docs), batch_size):
+            for result in database.bulk_docs(docs[start:start + batch_size]):
+                if 'error' not in result:
+                    cls.missing.discard(result['id'])
+                    written += 1
+                elif not (skip_conflicts and result['error'] == 'conflict'):
+                    raise DataValidationError('Bulk write of {} failed: {}'
+                                              .format(result.get('id'),
+                                                      result['error']))
+        cls.write_version += 1
+        return written
+
+    @classmethod
+    @DB_DURATION.time(operation='import')
+    def import_batch(cls, inventories, upsert=False):
+        """
+        Writes a batch of validated Inventory with one _bulk_docs request
+        per database. With upsert, documents are written under their
+        natural key and replace the Inventory already stored there.
+        Returns (created, updated, errors) where errors is a list of
+        (position in inventories, message)
+        """
+        groups = {}
+        for position, inventory in enumerate(inventories):
+            data = inventory.serialize()
+            if upsert or cls.natural_keys:
+                data['_id'] = cls.natural_key(inventory.product_id,
+                                              inventory.condition)
+            elif cls.partitioned or cls.shards:
+                data['_id'] = cls.partitioned_id(inventory.product_id)
+            else:
+                data['_id'] = uuid.uuid4().hex
+            database = cls.database_for(inventory.product_id)
+            groups.setdefault(id(database), (database, []))[1] \
+                .append((position, data))
+        created, updated, errors = 0, 0, []
+        for database, items in groups.values():
+            previous = {}
+            if upsert:
+                # the stored documents, to report the restock crossings
+                rows = database.all_docs(
+                    keys=[data['_id'] for _, data in items],
+                    include_docs=bool(cls.restock_listeners)) \
+                    .get('rows', [])
+                revs = {row['id']: row['value']['rev'] for row in rows
+                        if 'value' in row and
+                        not row['value'].get('deleted')}
+                previous = {row['id']: row['doc'] for row in rows
+                            if row.get('doc') and row['id'] in revs}
+                for _, data in items:
+                    if data['_id'] in revs:
+                        data['_rev'] = revs[data['_id']]
+            results = database.bulk_docs([data for _, data in items])
+            for (position, data), result in zip(items, results):
+                if 'error' not in result:
+                    cls.missing.discard(data['_id'])
+                    if '_rev' in data:
+                        updated += 1
+                    else:
+                        created += 1
+                    cls.notify_restock(previous.get(data['_id']),
+                                       dict(data, _rev=result['rev']))
+                elif result['error'] == 'conflict' and '_rev' not in data:
+                    errors.append((position, 'Inventory {} already exists'
+                                   .format(data['_id'])))
+                else:
+                    errors.append((position, '{}: {}'.format(
+                        result['error'], result.get('reason', ''))))
+        if created or updated:
+            cls.wrote()
+        return created, updated, errors
+
+    @classmethod
+    def update_seqs(cls):
+        """ Returns the current update sequence of every database """
+        return [str(database.metadata()['update_seq'])
+                for database in cls.databases()]
+
+    @classmethod
+    def read_seqs(cls):
+        """
+        Returns the update sequence of the database every read goes to:
+        the replica, unless it is down or the reads are pinned
+        """
+        return [str(cls.read(lambda db: db.metadata()['update_seq'],
+                             database))
+                for database in cls.databases()]
+
+    @classmethod
+    def export_docs(cls, after=None, page_size=None):
+        """
+        Returns an iterator over every Inventory document, database by
+        database in _id order, that reads one _all_docs page at a time.
+        It starts after the document id after, to resume an interrupted
+        export
+        """
+        page_size = page_size or EXPORT_PAGE_SIZE
+        databases = cls.databases()
+        first = 0
+        if after is not None:
+            database = cls.database_for_id(after)
+            if database is None:
+                raise DataValidationError('Invalid export position {}'
+                                          .format(after))
+            first = [index for index, candidate in enumerate(databases)
+                     if candidate is database][0]
+
+        def docs():
+            for index in range(first, len(databases)):
+                params = {'include_docs': True, 'limit': page_size}
+                if index == first and after is not None:
+                    # the smallest id after it, which holds even when the
+                    # document is gone
+                    params['startkey'] = after + '\u0000'
+                while True:
+                    rows = cls._export_page(databases[index], params)
+                    for row in rows:
+                        if row.get('doc') and \
+                                not row['id'].startswith('_design/'):
+                            yield row['doc']
+                    if len(rows) < page_size:
+                        break
+                    params['startkey'] = rows[-1]['id'] + '\u0000'
+        return docs()
+
+    @classmethod
+    @DB_DURATION.time(operation='export')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
+           tries=RETRY_COUNT, logger=retry_logger)
+    def _export_page(cls, database, params):
+        """
+        Returns a page of _all_docs rows of the primary database, which the
+        update sequence of the export comes from: a replica may not have
+        all the changes before it yet
+        """
+        return database.all_docs(**params).get('rows', [])
+
+    @classmethod
+    def export_changes(cls, since, page_size=None):
+        """
+        Returns an iterator of (document, since) over every Inventory
+        changed after the update sequences since (one per database), that
+        reads one _changes page at a time. A deleted Inventory is
+        {"_id": ..., "_deleted": true}. The since of a document, comma
+        separated, is where an export interrupted after it resumes
+        """
+        page_size = page_size or EXPORT_PAGE_SIZE
+        databases = cls.databases()
+        if len(since) != len(databases):
+            raise DataValidationError('since needs {} comma separated '
+                                      'sequences'.format(len(databases)))
+        seqs = [str(seq) for seq in since]
+
+        def changes():
+            for index, database in enumerate(databases):
+                while True:
+                    page = cls._changes_page(database, seqs[index],
+                                             page_size)
+                    for row in page['results']:
+                        seqs[index] = str(row['seq'])
+                        if row['id'].startswith('_design/'):
+                            continue
+                        if row.get('deleted'):
+                            doc = {'_id': row['id'], '_deleted': True}
+                        else:
+                            doc = row['doc']
+                            cls.missing.discard(row['id'])
+                        yield doc, ','.join(seqs)
+                    seqs[index] = str(page['last_seq'])
+                    if len(page['results']) < page_size:
+                        break
+        return changes()
+
+    @staticmethod
+    @DB_DURATION.time(operation='changes')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
+           tries=RETRY_COUNT, logger=retry_logger)
+    def _changes_page(database, since, limit, longpoll=False, timeout=None):
+        """
+        Returns a page of the _changes feed of the primary database. With
+        longpoll, waits up to timeout seconds for a change after since
+        """
+        params = {'since': since, 'limit': limit, 'include_docs': 'true'}
+        if longpoll:
+            params.update(feed='longpoll', timeout=int(timeout * 1000))
+        response = database.r_session.get(
+            database.database_url + '/_changes', params=params)
+        if response.status_code == 400:
+            raise DataValidationError('Invalid since {}'.format(since))
+        response.raise_for_status()
+        return response.json()
+
+    @classmethod
+    def changes(cls, since=None, limit=100, longpoll=False, timeout=25.0):
+        """
+        Returns the changes after the update sequences since (one per
+        database, or one for all of them; "0" by default and "now" for
+        the current one) as (changes, last_seq, pending). A change is a
+        dict of seq, id, rev, deleted and the changed inventory (None when
+        deleted); seq and last_seq are comma separated sequences, one per
+        database. With longpoll, waits up to timeout seconds for a change
+        """
+        databases = cls.databases()
+        seqs = [str(seq) for seq in (since or ['0'])]
+        if len(seqs) == 1:
+            seqs = seqs * len(databases)
+        if len(seqs) != len(databases):
+            raise DataValidationError('since needs {} comma separated '
+                                      'sequences'.format(len(databases)))
+        # a single database waits in CouchDB, shards are polled
+        wait = longpoll and len(databases) == 1
+        deadline = time.monotonic() + timeout
+        while True:
+            results, pending = [], 0
+            for index, database in enumerate(databases):
+                if len(results) >= limit:
+                    break
+                page = cls._changes_page(database, seqs[index],
+                                         limit - len(results), wait, timeout)
+                for row in page['results']:
+                    seqs[index] = str(row['seq'])
+                    if row['id'].startswith('_design/'):
+                        continue
+                    deleted = bool(row.get('deleted'))
+                    if not deleted:
+                        cls.missing.discard(row['id'])
+                    results.append({
+                        'seq': ','.join(seqs), 'id': row['id'],
+                        'rev': row['changes'][0]['rev'], 'deleted': deleted,
+                        'inventory': None if deleted else
+                                     Inventory().deserialize(row['doc'])})
+                seqs[index] = str(page['last_seq'])
+                pending += page.get('pending', 0)
+            remaining = deadline - time.monotonic()
+            if results or not longpoll or wait or remaining <= 0:
+                return results, ','.join(seqs), pending
+            time.sleep(min(CHANGES_POLL_INTERVAL, remaining))
+
+    @classmethod
+    @DB_DURATION.time(operation='all')
     def all(cls):
         """ Query that returns all Inventory """
-        results = []
-        for doc in cls.database:
-            inventory = Inventory().deserialize(doc)
-            inventory.id = doc['_id']
-            results.append(inventory)
-        return results
+        def read(database):
+            results = []
+            for doc in database:
+                inventory = Inventory().deserialize(doc)
+                inventory.id = doc['_id']
+                results.append(inventory)
+            return results
+        return list(heapq.merge(*cls.scatter_read(read),
+                                key=lambda inventory: inventory.id))
 
 ######################################################################
 #  F I N D E R   M E T H O D S
@@ -216,42 +941,169 @@ class Inventory():
     @classmethod
     def find(cls, inventory_id):
         """ Find an Inventory by id """
+        if inventory_id in cls.missing:
+            return None
+        generation = cls.missing.generation()
+        inventory = cls._find(inventory_id)
+        if inventory is None:
+            cls.missing.add(inventory_id, generation)
+        return inventory
+
+    @classmethod
+    @reads.coalesce('find')
+    @DB_DURATION.time(operation='find')
+    def _find(cls, inventory_id):
+        """ Reads an Inventory by id, None when it doesn't exist """
         cls.logger.info('Processing lookup for id %s ...',
                         inventory_id)
-        try:
-            document = cls.database[inventory_id]
-            return Inventory().deserialize(document)
-        except KeyError:
+        database = cls.database_for_id(inventory_id)
+        if database is None:
             return None
+        document = cls.read(lambda db: cls.fetch(db, inventory_id),
+                            database)
+        if document is None:
+            return None
+        return Inventory().deserialize(document)
 
     @classmethod
+    @reads.coalesce('find_by')
+    @DB_DURATION.time(operation='find_by')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
-    def find_by(cls, **kwargs):
-        """ Find records using selector """
-        query = Query(cls.database, selector=kwargs)
-        results = []
-        for doc in query.result:
-            inventory = Inventory()
-            inventory.deserialize(doc)
-            results.append(inventory)
+           tries=RETRY_COUNT, logger=retry_logger)
+    def find_by(cls, partition_key=None, **kwargs):
+        """
+        Find records using selector
+        Given a partition_key the query only runs against that partition.
+        When sharded, a query for a single product_id runs on its shard and
+        any other query is sent to every shard concurrently
+        """
+        product_id = kwargs.get('product_id')
+        if partition_key is not None:
+            databases = [cls.database_for(partition_key)]
+        elif isinstance(product_id, int):
+            databases = [cls.database_for(product_id)]
+        else:
+            databases = cls.databases()
+
+        def run(database):
+            if partition_key is None:
+                query = Query(database, selector=kwargs)
+            else:
+                query = Query(database, selector=kwargs,
+                              partition_key=str(partition_key))
+            started = time.perf_counter()
+            docs, stats = cls._run_query(database, query)
+            cls.query_log.record(kwargs, time.perf_counter() - started,
+                                 stats, partition_key,
+                                 explain=lambda: cls._explain_query(database,
+                                                                    query))
+            results = []
+            for doc in docs:
+                inventory = Inventory()
+                inventory.deserialize(doc)
+                results.append(inventory)
+            return results
+        return [inventory for results in cls.scatter_read(run, databases)
+                for inventory in results]
+
+
+    @staticmethod
+    def _run_query(database, query):
+        """
+        Runs a Mango query page by page, following the bookmark
+        Returns the documents and the summed execution_stats
+        """
+        session = database.r_session
+        body = {'selector': query['selector'], 'limit': QUERY_PAGE_SIZE,
+                'execution_stats': True}
+        docs, stats = [], {}
+        while True:
+            response = session.post(query.url, headers={
+                'Content-Type': 'application/json'}, data=json.dumps(body))
+            response.raise_for_status()
+            page = response.json()
+            docs.extend(page['docs'])
+            for key, value in page.get('execution_stats', {}).items():
+                stats[key] = stats.get(key, 0) + value
+            if len(page['docs']) < QUERY_PAGE_SIZE or not page.get('bookmark'):
+                return docs, stats
+            body['bookmark'] = page['bookmark']
+
+    @staticmethod
+    def _explain_query(database, query):
+        """ Returns the index CouchDB uses for a Mango query """
+        response = database.r_session.post(
+            query.url[:-len('_find')] + '_explain',
+            headers={'Content-Type': 'application/json'},
+            data=json.dumps({'selector': query['selector']}))
+        response.raise_for_status()
+        index = response.json()['index']
+        return {'name': index.get('name'), 'ddoc': index.get('ddoc'),
+                'type': index.get('type'),
+                'fields': index.get('def', {}).get('fields')}
+
+    @classmethod
+    @DB_DURATION.time(operation='find_many')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
+           tries=RETRY_COUNT, logger=retry_logger)
+    def find_many(cls, inventory_ids):
+        """ Find several Inventory by id with a single _all_docs request
+        Args:
+            inventory_ids (list): the ids of the Inventory you want to fetch
+        Returns:
+            a dict keyed by id, in request order, holding the Inventory
+            or None when the id does not exist (or was deleted)
+        """
+        cls.logger.info('Processing lookup for %d ids ...',
+                        len(inventory_ids))
+        results = dict.fromkeys(inventory_ids)
+        groups = {}
+        for inventory_id in results:
+            database = cls.database_for_id(inventory_id)
+            if database is not None:
+                groups.setdefault(id(database),
+                                  (database, []))[1].append(inventory_id)
+
+        pinned = cls.primary_until() > time.time()
+
+        def fetch(group):
+            database, keys = group
+            return cls.read(lambda db: db.all_docs(
+                keys=keys, include_docs=True).get('rows', []),
+                            database, pinned)
+        for rows in cls.scatter(fetch, groups.values()):
+            for row in rows:
+                if row.get('doc'):
+                    results[row['key']] = Inventory().deserialize(row['doc'])
         return results
 
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
+           tries=RETRY_COUNT, logger=retry_logger)
+    def find_by_product_ids(cls, product_ids):
+        """ Find all the Inventory of several products with one query
+        Args:
+            product_ids (list): the product_ids of the Inventory you
+            want to match
+        """
+        return cls.find_by(product_id={'$in': list(product_ids)})
 
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
+           tries=RETRY_COUNT, logger=retry_logger)
     def find_by_product_id(cls, product_id):
         """ Find an Inventory by product_id
             Args:
             product_id (int): the product_id of the Inventory you
             want to match
         """
+        if cls.natural_keys or cls.partitioned or cls.shards:
+            return cls.find_by_key_range(product_id)
         return cls.find_by(product_id=product_id)
 
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
+           tries=RETRY_COUNT, logger=retry_logger)
     def find_by_availability(cls, available):
         """ Find an Inventory by availability
         Args:
@@ -262,7 +1114,7 @@ class Inventory():
 
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
+           tries=RETRY_COUNT, logger=retry_logger)
     def find_by_availability_with_pid(cls, available, pid):
         """ Find an Inventory by availability and product_id
         Args:
@@ -271,11 +1123,17 @@ class Inventory():
             product_id (int): the product_id of the Inventory you
             want to match
         """
+        if cls.natural_keys:
+            return [inventory for inventory in cls.find_by_key_range(pid)
+                    if inventory.available == available]
+        if cls.partitioned:
+            return cls.find_by(partition_key=pid, available=available,
+                               product_id=pid)
         return cls.find_by(available=available, product_id=pid)
 
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
+           tries=RETRY_COUNT, logger=retry_logger)
     def find_by_condition(cls, condition):
         """ Find an Inventory by condition
         Args:
@@ -286,7 +1144,7 @@ class Inventory():
 
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
+           tries=RETRY_COUNT, logger=retry_logger)
     def find_by_condition_with_pid(cls, condition, pid):
         """ Find an Inventory by condition and product_id
         Args:
@@ -295,11 +1153,19 @@ class Inventory():
             product_id (int): the product_id of the Inventory you
             want to match
         """
+        if cls.natural_keys:
+            key = cls.natural_key(pid, condition)
+            return [inventory for inventory in cls.find_many([key]).values()
+                    if inventory]
+        if cls.partitioned:
+            return cls.find_by(partition_key=pid, condition=condition,
+                               product_id=pid)
         return cls.find_by(condition=condition, product_id=pid)
 
     @classmethod
+    @DB_DURATION.time(operation='find_by_restock')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
+           tries=RETRY_COUNT, logger=retry_logger)
     def find_by_restock(cls, restock):
         """ Returns all of the Inventory that quantity lower than their\
             restock level
@@ -308,20 +1174,23 @@ class Inventory():
             if false than return normal list all
         """
         cls.logger.info('Processing quantity < restock_level query ...')
-        results = []
-        for doc in cls.database:
-            inventory = Inventory().deserialize(doc)
-            if restock is True:
-                if inventory.quantity < inventory.restock_level:
-                    results.append(inventory)
-            else:
-                if inventory.quantity >= inventory.restock_level:
-                    results.append(inventory)
-        return results
+        def read(database):
+            results = []
+            for doc in database:
+                inventory = Inventory().deserialize(doc)
+                if restock is True:
+                    if inventory.quantity < inventory.restock_level:
+                        results.append(inventory)
+                else:
+                    if inventory.quantity >= inventory.restock_level:
+                        results.append(inventory)
+            return results
+        return list(heapq.merge(*cls.scatter_read(read),
+                                key=lambda inventory: inventory.id))
 
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
-           tries=RETRY_COUNT, logger=logger)
+           tries=RETRY_COUNT, logger=retry_logger)
     def find_by_restock_level(cls, restock_level):
         """ Returns all of the Inventory that restock level = {restock_level}
         Args:
@@ -335,9 +1204,16 @@ class Inventory():
 #  C L O U D A N T   D A T A B A S E   C O N N E C T I O N
 ############################################################
     @staticmethod
-    def init_db(dbname='asd'):
+    def init_db(dbname='asd', partitioned=PARTITIONED, shards=SHARDS,
+                replica_url=REPLICA_URL):
         """
         Initialized Coundant database connection
+        A missing database is created partitioned by product_id when
+        partitioned is True; an existing one keeps its own setting.
+        With shards the Inventory are spread over several databases
+        named <dbname>-<n> unless the shard says otherwise.
+        With a replica_url (or a replica_url per shard) reads are sent
+        to the database of the same name on that server
         """
         opts = {}
         # Try and get VCAP from the environment
@@ -374,30 +1250,107 @@ class Inventory():
                                           'Check that app is bound to \
                                           a Cloudant service.')
 
+        Inventory.client = Inventory._connect(opts)
+        Inventory.clients = [Inventory.client]
+        Inventory.shards = []
+        if Inventory.executor is not None:
+            Inventory.executor.shutdown(wait=False)
+            Inventory.executor = None
+
+        Inventory.missing.clear()
+        shard_opts = Inventory._shard_options(shards, opts, dbname)
+        if not shard_opts:
+            Inventory.database = Inventory._open_database(
+                Inventory.client, dbname, partitioned)
+        else:
+            clients = {opts['url']: Inventory.client}
+            for shard in shard_opts:
+                if shard['url'] not in clients:
+                    clients[shard['url']] = Inventory._connect(shard)
+                Inventory.shards.append(Inventory._open_database(
+                    clients[shard['url']], shard['dbname'], partitioned))
+            Inventory.clients = list(clients.values())
+            Inventory.database = Inventory.shards[0]
+            Inventory.executor = ThreadPoolExecutor(
+                max_workers=SCATTER_THREADS * len(Inventory.shards))
+        Inventory.partitioned = all(
+            database.metadata().get('props', {}).get('partitioned')
+            for database in Inventory.databases())
+
+        # Open the read replicas
+        Inventory.replicas = {}
+        Inventory.replica_down_until = {}
+        replica_opts = shard_opts or [dict(opts, replica_url=replica_url)]
+        replica_clients = {}
+        for database, shard in zip(Inventory.databases(), replica_opts):
+            url = shard.get('replica_url')
+            if not url:
+                continue
+            try:
+                if url not in replica_clients:
+                    replica_clients[url] = Inventory._connect(
+                        dict(shard, url=url, timeout=REPLICA_TIMEOUT))
+                Inventory.replicas[id(database)] = \
+                    replica_clients[url][database.database_name]
+            except (KeyError, RequestException) as error:
+                Inventory.logger.warning('Replica of [%s] unavailable at %s: '
+                                         '%s', database.database_name, url,
+                                         error)
+        Inventory.clients.extend(replica_clients.values())
+
+    @staticmethod
+    def _shard_options(shards, opts, dbname):
+        """
+        Returns the connection options of every shard
+        shards is a number of databases on the same server, or a JSON list
+        of dicts overriding url, username, password and dbname per shard
+        """
+        if not shards:
+            return []
+        if isinstance(shards, str):
+            shards = json.loads(shards)
+        if isinstance(shards, int):
+            shards = [{}] * shards
+        shard_opts = []
+        for number, shard in enumerate(shards):
+            shard_opt = dict(opts, dbname='{}-{}'.format(dbname, number))
+            shard_opt.update(shard)
+            shard_opts.append(shard_opt)
+        return shard_opts
+
+    @staticmethod
+    def _connect(opts):
+        """ Returns a client connected to the Cloudant server in opts """
         Inventory.logger.info('Cloudant Endpoint: %s', opts['url'])
         try:
             if ADMIN_PARTY:
                 Inventory.logger.info('Running in Admin Party Mode...')
-            Inventory.client = Cloudant(
+            return Cloudant(
                 opts['username'],
                 opts['password'],
                 url=opts['url'],
                 connect=True,
                 auto_renew=True,
                 admin_party=ADMIN_PARTY,
-                adapter=Replay429Adapter(retries=10, initialBackoff=0.1)
+                timeout=opts.get('timeout'),
+                adapter=MeteredReplay429Adapter(retries=10,
+                                                initialBackoff=0.1)
             )
         except ConnectionError:
             raise ConnectionError('Cloudant service \
                                           could not be reached')
 
-        # Create database if it doesn't exist
+    @staticmethod
+    def _open_database(client, dbname, partitioned):
+        """ Returns the database dbname, creating it if it doesn't exist """
         try:
-            Inventory.database = Inventory.client[dbname]
+            database = client[dbname]
         except KeyError:
             # Create a database using an initialized client
-            Inventory.database = Inventory.client.create_database(dbname)
+            database = client.create_database(dbname,
+                                              partitioned=partitioned)
         # check for success
-        if not Inventory.database.exists():
+        if not database.exists():
             raise ConnectionError('Database [{}] could not \
                                           be obtained'.format(dbname))
+        return database
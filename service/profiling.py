@@ -0,0 +1,181 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+On-demand request profiling
+WSGI middleware that profiles a single request when it carries the
+X-Profile header with the configured secret. Every other request goes
+straight through to the app.
+
+Headers
+-------
+X-Profile: <secret>            profile this request
+X-Profile-Format: pstats       cProfile, report sorted by cumulative time
+X-Profile-Format: collapsed    sampling profiler, one "a;b;c count" line
+                               per stack (flamegraph.pl / speedscope)
+
+Without a directory the profile replaces the response body (the app's
+status is returned in X-Profiled-Status). With a directory the response
+is left alone and the file name is returned in X-Profile-File.
+
+Streamed responses (no Content-Length, like the exports and the event
+streams) are passed through unprofiled with an X-Profile-Skipped header:
+profiling them would hold the body until the stream ends.
+"""
+import io
+import os
+import sys
+import hmac
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+
+FORMATS = ('pstats', 'collapsed')
+
+class SamplingProfiler():
+    """ Samples the stack of one thread from a background thread """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = None
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def enable(self):
+        """ Starts sampling the calling thread """
+        self._thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self._run, daemon=True)
+        self._sampler.start()
+
+    def disable(self):
+        """ Stops sampling """
+        self._stopped.set()
+        self._sampler.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            # pylint: disable=protected-access
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(
+                    frame.f_globals.get('__name__', code.co_filename),
+                    code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """ Returns the samples in the collapsed stack format """
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in self.stacks.most_common())
+
+def is_streamed(captured):
+    """ True when the response started has a body of unknown length """
+    if 'status' not in captured or \
+            captured['status'][:3] in ('204', '304'):
+        return False
+    return not any(name.lower() == 'content-length'
+                   for name, _ in captured['headers'])
+
+class ProfilerMiddleware():
+    """ Profiles the requests that present the secret """
+
+    def __init__(self, app, secret, directory=None, limit=60,
+                 interval=0.005):
+        self.app = app
+        self.secret = secret
+        self.directory = directory
+        self.limit = limit
+        self.interval = interval
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, environ, start_response):
+        token = environ.get('HTTP_X_PROFILE')
+        if not self.secret or not token or \
+                not hmac.compare_digest(token, self.secret):
+            return self.app(environ, start_response)
+
+        output = environ.get('HTTP_X_PROFILE_FORMAT', 'pstats').lower()
+        if output not in FORMATS:
+            start_response('400 BAD REQUEST',
+                           [('Content-Type', 'text/plain')])
+            return [b'X-Profile-Format must be one of: pstats, collapsed\n']
+        profiler = SamplingProfiler(self.interval) if output == 'collapsed' \
+            else cProfile.Profile()
+
+        captured = {}
+        def catching_start_response(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+            return lambda data: captured.setdefault('body', []).append(data)
+
+        started = time.time()
+        profiler.enable()
+        try:
+            app_iter = self.app(environ, catching_start_response)
+            streamed = is_streamed(captured)
+            if not streamed:
+                try:
+                    body = captured.pop('body', []) + list(app_iter)
+                finally:
+                    if hasattr(app_iter, 'close'):
+                        app_iter.close()
+        finally:
+            profiler.disable()
+        elapsed = time.time() - started
+
+        if streamed:
+            headers = captured['headers'] + [
+                ('X-Profile-Skipped', 'streamed response')]
+            write = start_response(captured['status'], headers,
+                                   captured['exc_info'])
+            for data in captured.pop('body', []):
+                write(data)
+            return app_iter
+
+        if self.directory:
+            path = environ.get('PATH_INFO', '').strip('/').replace('/', '.')
+            filename = os.path.join(self.directory, '{}.{}.{:.0f}ms.{:.0f}.{}'
+                                    .format(environ['REQUEST_METHOD'],
+                                            path or 'root', elapsed * 1000.0,
+                                            started * 1000.0, output))
+            if output == 'collapsed':
+                with open(filename, 'w') as stream:
+                    stream.write(profiler.collapsed())
+            else:
+                profiler.dump_stats(filename)
+            headers = captured['headers'] + [('X-Profile-File', filename)]
+            start_response(captured['status'], headers, captured['exc_info'])
+            return body
+
+        if output == 'collapsed':
+            report = profiler.collapsed()
+        else:
+            stream = io.StringIO()
+            stats = pstats.Stats(profiler, stream=stream)
+            stats.sort_stats('cumulative').print_stats(self.limit)
+            report = stream.getvalue()
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('X-Profiled-Status', captured['status']),
+            ('X-Profile-Duration', '{:.3f}'.format(elapsed * 1000.0))])
+        return [report.encode('utf-8')]
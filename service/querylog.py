@@ -0,0 +1,254 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Slow query log and index advisor for the Mango queries of the model
+
+Every query is counted in a frequency table keyed by the shape of its
+selector (the fields and operators, values left out). Queries slower than
+the threshold are logged with the index CouchDB picked, the
+execution_stats of the query and the totals of its shape in the table, and
+appended to a JSON lines file that the recommend-indexes command reads back.
+"""
+import json
+import time
+import uuid
+import threading
+
+RANGE_OPERATORS = ('$gt', '$gte', '$lt', '$lte')
+# a query reading more than this many documents per result is not covered
+WASTE_RATIO = 2.0
+
+def selector_shape(selector):
+    """ Returns the selector with every value replaced by "?" """
+    if isinstance(selector, dict):
+        return {key: selector_shape(value)
+                for key, value in selector.items()}
+    if isinstance(selector, list) and selector and \
+            all(isinstance(item, dict) for item in selector):
+        return [selector_shape(item) for item in selector]
+    return '?'
+
+def shape_key(selector):
+    """ Returns the shape of a selector as a stable string """
+    return json.dumps(selector_shape(selector), sort_keys=True)
+
+def index_fields(selector):
+    """
+    Returns the fields a json index needs to cover the selector:
+    equality fields first, then $in, then the range fields. Fields under
+    $or, $nor and $not can't be served by a json index and are left out
+    """
+    equality, members, ranges = [], [], []
+
+    def visit(clause, prefix=''):
+        for key, value in clause.items():
+            if key == '$and':
+                for item in value:
+                    visit(item, prefix)
+                continue
+            if key.startswith('$'):
+                continue
+            field = prefix + key
+            if not isinstance(value, dict):
+                equality.append(field)
+            elif not any(op.startswith('$') for op in value):
+                visit(value, field + '.')
+            elif '$eq' in value:
+                equality.append(field)
+            elif '$in' in value:
+                members.append(field)
+            elif any(op in value for op in RANGE_OPERATORS):
+                ranges.append(field)
+
+    visit(selector)
+    fields = []
+    for field in equality + members + ranges:
+        if field not in fields and field != '_id':
+            fields.append(field)
+    return fields
+
+def index_name(fields):
+    """ Returns the name the advisor gives to an index on fields """
+    return 'idx-' + '-'.join(field.replace('.', '_') for field in fields)
+
+class QueryLog():
+    """ Frequency table of the selectors run and log of the slow ones """
+
+    def __init__(self, threshold_ms=100.0, path=None, logger=None,
+                 explain_ttl=300.0):
+        self.threshold = threshold_ms / 1000.0
+        self.path = path
+        self.logger = logger
+        self.explain_ttl = explain_ttl
+        # tells the tables of the processes appending to one file apart
+        self.log_id = uuid.uuid4().hex
+        self.table = {}
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def record(self, selector, seconds, stats=None, partition=None,
+               explain=None):
+        """
+        Counts a query and logs it when it is slow. explain is called
+        (once per selector shape every explain_ttl seconds) to find the
+        index the query used
+        """
+        stats = stats or {}
+        key = shape_key(selector)
+        slow = seconds >= self.threshold
+        index = None
+        if slow and explain is not None:
+            now = time.monotonic()
+            with self._lock:
+                index, expires = self._indexes.get(key, (None, 0))
+            if index is None or expires <= now:
+                try:
+                    index = explain()
+                except Exception as error:  # pylint: disable=broad-except
+                    index = {'name': 'unknown', 'error': str(error)}
+                with self._lock:
+                    self._indexes[key] = (index, now + self.explain_ttl)
+        entry = self.add(key, selector, seconds, stats, slow, index,
+                         partition is not None)
+        if not slow:
+            return
+        record = {'time': time.time(), 'selector': selector, 'shape': key,
+                  'partition': partition, 'duration_ms':
+                  round(seconds * 1000.0, 3), 'index': index,
+                  'execution_stats': stats, 'log': self.log_id,
+                  'count': entry['count'],
+                  'total_ms': round(entry['seconds'] * 1000.0, 3)}
+        line = json.dumps(record, sort_keys=True, default=str)
+        if self.logger is not None:
+            self.logger.warning('Slow query: %s', line)
+        if self.path:
+            with self._lock:
+                with open(self.path, 'a') as stream:
+                    stream.write(line + '\n')
+
+    def add(self, key, selector, seconds, stats, slow=False, index=None,
+            partitioned=False):
+        """ Adds a query to the frequency table, returns its entry """
+        with self._lock:
+            entry = self.table.get(key)
+            if entry is None:
+                entry = self.table[key] = {
+                    'shape': key, 'selector': selector, 'count': 0,
+                    'slow': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                    'docs_examined': 0, 'results_returned': 0,
+                    'index': None, 'partitioned': partitioned}
+            entry['count'] += 1
+            entry['slow'] += 1 if slow else 0
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['docs_examined'] += stats.get('total_docs_examined', 0)
+            entry['results_returned'] += stats.get('results_returned', 0)
+            if index is not None:
+                entry['index'] = index
+            return dict(entry)
+
+    def top(self, limit=10):
+        """ Returns the selectors that took the most time in total """
+        with self._lock:
+            entries = [dict(entry) for entry in self.table.values()]
+        entries.sort(key=lambda entry: entry['seconds'], reverse=True)
+        return entries[:limit]
+
+    def forget_indexes(self):
+        """ Explains every shape again, e.g. once indexes were created """
+        with self._lock:
+            self._indexes = {}
+
+    def reset(self):
+        """ Clears the frequency table """
+        with self._lock:
+            self.table = {}
+            self._indexes = {}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Rebuilds the table of the slow queries from a log file. The count
+        and seconds of a shape are those of every query of it (fast ones
+        too) as of the last slow one, summed over the logging processes
+        """
+        log = cls(threshold_ms=0)
+        totals = {}
+        with open(path) as stream:
+            for line in stream:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                log.add(record['shape'], record['selector'],
+                        record['duration_ms'] / 1000.0,
+                        record.get('execution_stats') or {}, True,
+                        record.get('index'),
+                        record.get('partition') is not None)
+                if 'log' in record and 'total_ms' in record:
+                    totals[(record['log'], record['shape'])] = \
+                        (record['count'], record['total_ms'] / 1000.0)
+        frequency = {}
+        for (_, key), (count, seconds) in totals.items():
+            total = frequency.setdefault(key, [0, 0.0])
+            total[0] += count
+            total[1] += seconds
+        for key, (count, seconds) in frequency.items():
+            entry = log.table[key]
+            entry['count'] = max(entry['count'], count)
+            entry['seconds'] = max(entry['seconds'], seconds)
+        return log
+
+def _defined_fields(index):
+    """ Returns the field names of an index definition """
+    return [list(field)[0] if isinstance(field, dict) else field
+            for field in index.get('def', {}).get('fields', [])]
+
+def recommend_indexes(entries, existing=(), limit=5):
+    """
+    Returns the indexes that would cover the most expensive queries, as
+    dicts of name, fields, partitioned and the cost of the queries, ranked
+    by the total time of the queries (how often times how slow). A
+    query is covered when an existing index has its fields, or when the
+    index it used reads at most WASTE_RATIO documents per result
+    """
+    defined = [_defined_fields(index) for index in existing]
+    recommendations = {}
+    for entry in entries:
+        fields = index_fields(entry['selector'])
+        if not fields or fields in defined:
+            continue
+        used = entry.get('index') or {}
+        examined = entry['docs_examined']
+        returned = max(entry['results_returned'], 1)
+        if used.get('name') not in (None, '_all_docs', 'unknown') and \
+                examined <= returned * WASTE_RATIO:
+            continue
+        key = (tuple(fields), entry.get('partitioned', False))
+        recommendation = recommendations.setdefault(key, {
+            'name': index_name(fields), 'fields': fields,
+            'partitioned': entry.get('partitioned', False), 'queries': 0,
+            'slow': 0, 'seconds': 0.0, 'docs_examined': 0, 'results_returned': 0,
+            'selectors': []})
+        recommendation['queries'] += entry['count']
+        recommendation['slow'] += entry['slow']
+        recommendation['seconds'] += entry['seconds']
+        recommendation['docs_examined'] += examined
+        recommendation['results_returned'] += entry['results_returned']
+        recommendation['selectors'].append(entry['shape'])
+    ranked = sorted(recommendations.values(),
+                    key=lambda item: (item['seconds'], item['docs_examined']),
+                    reverse=True)
+    return ranked[:limit]
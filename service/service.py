@@ -25,16 +25,52 @@ POST /inventory #6
 PUT /inventory/{inventory-id} #7
 DELETE /inventory/{inventory-id} #8
 PUT /inventory/{product-id}/disable to disable the product #25
+POST /inventory/import to load NDJSON or CSV in bulk
+GET /inventory/export to stream all (or the changed) inventory
+GET /inventory/changes?since={seq}&feed=longpoll changes feed
+GET /inventory/events Server-Sent Events of the changes
+POST /inventory/_lookup to fetch a batch of inventory by ids / product ids
 DELETE /inventory/reset
+GET /metrics Prometheus metrics
+GET /debug/memory memory usage per endpoint (admin)
+POST /debug/memory/snapshot tracemalloc snapshot and diff (admin)
+GET /assets/{path} hashed, precompressed static assets
 
 """
 
+import os
 import sys
+import hmac
+import json
+import time
+import signal
 import logging
-from flask import jsonify, request, url_for, make_response, abort
+import threading
+import functools
+import mimetypes
+from flask import jsonify, request, url_for, make_response, abort, g, \
+    safe_join, send_from_directory, stream_with_context
 from flask_api import status    # HTTP Status Codes
 from flask_restplus import Api, Resource, fields, reqparse, inputs
-from service.models import Inventory, DataValidationError
+from flask_restplus.utils import merge, unpack
+from service.models import Inventory, DataValidationError, \
+    DuplicateKeyError, READ_YOUR_WRITES
+from service.metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE, \
+    HTTP_DURATION, HTTP_IN_FLIGHT, HTTP_RESPONSES, start_timings, \
+    stop_timings, record_phase
+from service.tracing import Tracer, JsonLinesExporter, record_span
+from service.memprofile import MemoryProfiler
+from service.compression import EXTENSIONS, compress, compressible, \
+    load_manifest, negotiate, rewrite_links
+from service.encoding import ModelEncoder, stdlib_representation
+from service.exporter import COLUMNS, CHANGE_COLUMNS, chunked, \
+    csv_lines, export_row, ndjson_lines
+from service.importer import Importer, decode_lines, parse_csv, \
+    parse_ndjson
+from service.logs import configure_json_logging, parse_rates
+from service.events import Subscription, hub, stream
+from service.webhooks import WebhookDispatcher
+from service.cache import ResponseCache
 
 # Import Flask application
 from . import app
@@ -45,7 +81,36 @@ from . import app
 @app.route('/')
 def index():
     """ Root URL response """
-    return app.send_static_file('index.html')
+    manifest = load_manifest(app.config['ASSETS_DIR'])
+    if not manifest:
+        return app.send_static_file('index.html')
+    # link the built assets, and revalidate the page to pick up new ones
+    with app.open_resource('static/index.html') as stream:
+        html = rewrite_links(stream.read().decode('utf8'), manifest)
+    response = make_response(html, status.HTTP_200_OK)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+######################################################################
+# GET STATIC ASSETS (built by flask build-assets)
+######################################################################
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    """ Serves a hashed asset, precompressed if the client accepts it """
+    directory = app.config['ASSETS_DIR']
+    available = [encoding for encoding in EXTENSIONS if os.path.isfile(
+        safe_join(directory, filename + EXTENSIONS[encoding]))]
+    encoding = negotiate(request.accept_encodings, available)
+    response = send_from_directory(
+        directory, filename + EXTENSIONS.get(encoding, ''),
+        mimetype=mimetypes.guess_type(filename)[0])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if available:
+        response.vary.add('Accept-Encoding')
+    # the name changes with the content
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 ######################################################################
 # GET HEALTH CHECK
@@ -106,6 +171,31 @@ create_model = api.model('Inventory', {
                                 of the Inventory.')
 })
 
+lookup_model = api.model('InventoryLookup', {
+    'ids': fields.List(fields.String,
+                       description='The ids of the Inventory to fetch'),
+    'product_ids': fields.List(fields.Integer,
+                               description='Also fetch every Inventory \
+                               of these product ids')
+})
+
+change_model = api.model('InventoryChange', {
+    'seq': fields.String(description='The since to resume after this \
+                         change'),
+    'id': fields.String(description='The id of the changed Inventory'),
+    'deleted': fields.Boolean(description='True if the Inventory was \
+                              deleted'),
+    'inventory': fields.Nested(inventory_model, allow_null=True,
+                               description='The Inventory after the \
+                               change (null when deleted)')
+})
+
+changes_model = api.model('InventoryChanges', {
+    'results': fields.List(fields.Nested(change_model)),
+    'last_seq': fields.String(description='The since of the next request'),
+    'pending': fields.Integer(description='Changes left after these')
+})
+
 # query string arguments
 inventory_args = reqparse.RequestParser()
 inventory_args.add_argument('product-id', type=int,
@@ -124,9 +214,115 @@ inventory_args.add_argument('restock', type=inputs.boolean,
                             required=False, location='args', \
                             help='List Inventory by need restock or not')
 
+def timed_marshal(marshaller):
+    """
+    Applies an @api.marshal_* decorator and records the time it spends
+    outside of the handler as the marshal phase and span of the request
+    """
+    def decorator(func):
+        handler_time = threading.local()
+
+        @functools.wraps(func)
+        def handler(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                handler_time.seconds = time.perf_counter() - started
+        marshalled = marshaller(handler)
+
+        @functools.wraps(marshalled)
+        def view(*args, **kwargs):
+            handler_time.seconds = 0.0
+            started = time.perf_counter()
+            try:
+                return marshalled(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - started - handler_time.seconds
+                record_phase('marshal', seconds)
+                record_span('marshal', time.time() - seconds, seconds)
+        return view
+    return decorator
+
+def fast_marshal(model, as_list=False, code=status.HTTP_200_OK,
+                 description=None):
+    """
+    Documents the response like @api.marshal_with, for handlers that
+    return Inventory objects, and encodes them straight to JSON bytes
+    with ModelEncoder. Falls back to marshal() when FAST_JSON is off, the
+    JSON representation has settings or the request sends a fields mask
+    """
+    encoder = ModelEncoder(model, {'_id': 'id'})
+
+    def decorator(func):
+        @functools.wraps(func)
+        def view(*args, **kwargs):
+            data, status_code, headers = unpack(func(*args, **kwargs))
+            mask = request.headers.get(app.config['RESTPLUS_MASK_HEADER'])
+            if mask or not app.config['FAST_JSON'] or \
+                    not stdlib_representation(app):
+                return encoder.marshal(data, mask), status_code, headers
+            response = app.response_class(encoder.encode(data), status_code,
+                                          content_type='application/json')
+            response.headers.extend(headers or {})
+            return response
+        view.__apidoc__ = merge(getattr(func, '__apidoc__', {}), {
+            'responses': {code: (description, [model] if as_list
+                                 else model)},
+            '__mask__': True})
+        return view
+    return decorator
+
+collection_cache = ResponseCache(
+    app.config['RESPONSE_CACHE_BYTES'],
+    lambda: Inventory.write_version, lambda: Inventory.read_seqs(),
+    seq_interval=app.config['RESPONSE_CACHE_SEQ_INTERVAL'])
+
+def cached_collection(func):
+    """
+    Serves the JSON bodies of a collection GET from collection_cache,
+    keyed by the parsed query arguments. The reads pinned to the primary
+    and the requests with a fields mask go to the handler
+    """
+    @functools.wraps(func)
+    def view(*args, **kwargs):
+        if not collection_cache.max_bytes or \
+                request.headers.get(app.config['RESTPLUS_MASK_HEADER']) or \
+                Inventory.primary_until() > time.time():
+            return func(*args, **kwargs)
+        # "available=TRUE" and "available=true" are the same query, an
+        # unknown argument makes another one
+        key = (tuple(sorted(inventory_args.parse_args().items())),
+               len(request.args))
+        version = collection_cache.version()
+        body = collection_cache.get(key, version)
+        if body is not None:
+            return app.response_class(body, status.HTTP_200_OK,
+                                      content_type='application/json',
+                                      headers={'X-Cache': 'HIT'})
+        response = func(*args, **kwargs)
+        # only the bodies encoded by fast_marshal can be kept
+        if isinstance(response, app.response_class) and \
+                response.status_code == status.HTTP_200_OK:
+            collection_cache.put(key, version, response.get_data())
+            response.headers['X-Cache'] = 'MISS'
+        return response
+    return view
+
 ######################################################################
 # Error Handlers
 ######################################################################
+@api.errorhandler(DuplicateKeyError)
+def duplicate_key_error(error):
+    """ Handles natural keys that already exist """
+    message = str(error)
+    app.logger.error(message)
+    return {
+        'status_code': status.HTTP_409_CONFLICT,
+        'error': 'Conflict',
+        'message': message
+    }, status.HTTP_409_CONFLICT
+
 @api.errorhandler(DataValidationError)
 def request_validation_error(error):
     """ Handles Value Errors from bad data """
@@ -156,7 +352,7 @@ class InventoryResource(Resource):
     #------------------------------------------------------------------
     @api.doc('get_inventory')
     @api.response(404, 'Inventory not found')
-    @api.marshal_with(inventory_model)
+    @timed_marshal(fast_marshal(inventory_model))
     def get(self, inventory_id):
         """
         Retrieve a single Inventory
@@ -168,7 +364,7 @@ class InventoryResource(Resource):
             api.abort(status.HTTP_404_NOT_FOUND,
                       "Inventory with id '{}' was not \
                       found.".format(inventory_id))
-        return inventory.serialize(), status.HTTP_200_OK
+        return inventory, status.HTTP_200_OK
 
     #------------------------------------------------------------------
     # DELETE AN INVENTORY
@@ -194,8 +390,9 @@ class InventoryResource(Resource):
     @api.doc('update_inventory')
     @api.response(404, 'Inventory not found')
     @api.response(400, 'The posted Inventory data was not valid')
+    @api.response(409, 'An Inventory with that natural key already exists')
     @api.expect(inventory_model)
-    @api.marshal_with(inventory_model)
+    @timed_marshal(fast_marshal(inventory_model))
     def put(self, inventory_id):
         """
         Update an Inventory
@@ -212,7 +409,7 @@ class InventoryResource(Resource):
         inventory.deserialize(request.get_json())
         inventory.id = inventory_id
         inventory.save()
-        return inventory.serialize(), status.HTTP_200_OK
+        return inventory, status.HTTP_200_OK
 
 ######################################################################
 # PATH: /inventory
@@ -226,8 +423,10 @@ class InventoryCollection(Resource):
     @api.doc('create_inventory')
     @api.expect(create_model)
     @api.response(400, 'The posted data was not valid')
+    @api.response(409, 'An Inventory with that natural key already exists')
     @api.response(201, 'Inventory created successfully')
-    @api.marshal_with(inventory_model, code=201)
+    @timed_marshal(fast_marshal(inventory_model,
+                                code=status.HTTP_201_CREATED))
     def post(self):
         """
         Creates an Inventory
@@ -242,7 +441,7 @@ class InventoryCollection(Resource):
         inventory.save()
         location_url = api.url_for(InventoryResource,
                                    inventory_id=inventory.id, _external=True)
-        return inventory.serialize(), status.HTTP_201_CREATED, \
+        return inventory, status.HTTP_201_CREATED, \
         {'Location': location_url}
 
     #------------------------------------------------------------------
@@ -257,7 +456,8 @@ class InventoryCollection(Resource):
     # GET request to /inventory?condition={condition}&product-id={product-id}
     @api.doc('list_inventory')
     @api.expect(inventory_args, validate=True)
-    @api.marshal_list_with(inventory_model)
+    @cached_collection
+    @timed_marshal(fast_marshal(inventory_model, as_list=True))
     def get(self):
         """ Returns all of the inventory """
         app.logger.info('Request for inventory list')
@@ -316,7 +516,235 @@ class InventoryCollection(Resource):
                 api.abort(400, message_invalid_fields)
         else:
             api.abort(400, message_invalid_fields)
-        results = [e.serialize() for e in inventories]
+        return inventories, status.HTTP_200_OK
+
+######################################################################
+# PATH: /inventory/import
+######################################################################
+IMPORT_FORMATS = {'application/x-ndjson': parse_ndjson,
+                  'application/jsonl': parse_ndjson, 'text/csv': parse_csv}
+
+@api.route('/inventory/import')
+class InventoryImportResource(Resource):
+    """ Loads Inventory in bulk from a streamed NDJSON or CSV body """
+    @api.doc('import_inventory', params={
+        'upsert': 'Replace the Inventory with the same product_id and '
+                  'condition (needs NATURAL_KEYS)'})
+    @api.response(200, 'Import summary, with the errors of each line')
+    @api.response(400, 'The import was not valid')
+    @api.response(415, 'The body is not NDJSON or CSV')
+    def post(self):
+        """
+        Import Inventory
+        This endpoint reads Inventory from the body, one JSON object per
+        line (application/x-ndjson) or a CSV file whose header names the
+        fields (text/csv), and writes them in batches as it goes. Lines
+        that are not valid are reported in the summary and skipped.
+        """
+        parse = IMPORT_FORMATS.get(request.mimetype)
+        if parse is None:
+            abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                  'Content-Type must be {}'.format(
+                      ' or '.join(IMPORT_FORMATS)))
+        upsert = request.args.get('upsert', False, type=inputs.boolean)
+        app.logger.info('Request to import inventory (%s)', request.mimetype)
+        importer = Importer(upsert)
+        summary = importer.run(parse(decode_lines(request.stream)))
+        app.logger.info('Imported %d lines: %d created, %d updated, '
+                        '%d failed', summary['lines'], summary['created'],
+                        summary['updated'], summary['failed'])
+        return summary, status.HTTP_200_OK
+
+######################################################################
+# PATH: /inventory/export
+######################################################################
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+@api.route('/inventory/export')
+class InventoryExportResource(Resource):
+    """ Streams every Inventory, or the ones changed since a sequence """
+    @api.doc('export_inventory', params={
+        'format': 'ndjson (default) or csv',
+        'after': 'Resume a full export after this _id',
+        'since': 'Only export the Inventory changed since this update '
+                 'sequence (X-Update-Seq of a previous export, or the '
+                 '_seq of the last row received to resume)'})
+    @api.response(400, 'The export parameters were not valid')
+    def get(self):
+        """
+        Export Inventory
+        This endpoint streams every Inventory as NDJSON or CSV straight
+        from the database, page by page. Its X-Update-Seq header is the
+        since of the next incremental export
+        """
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            abort(status.HTTP_400_BAD_REQUEST, 'format must be {}'.format(
+                ' or '.join(EXPORT_FORMATS)))
+        since = request.args.get('since')
+        after = request.args.get('after')
+        if since and after:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  'since and after can\'t be combined')
+        app.logger.info('Request to export inventory (%s)', export_format)
+        update_seqs = Inventory.update_seqs()
+        if since:
+            rows = (export_row(doc, seq) for doc, seq
+                    in Inventory.export_changes(since.split(',')))
+            columns = CHANGE_COLUMNS
+        else:
+            rows = (export_row(doc) for doc in Inventory.export_docs(after))
+            columns = COLUMNS
+        lines = ndjson_lines(rows) if export_format == 'ndjson' \
+            else csv_lines(rows, columns)
+        response = app.response_class(stream_with_context(chunked(lines)),
+                                      mimetype=EXPORT_FORMATS[export_format])
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=inventory.{}'.format(export_format)
+        response.headers['X-Update-Seq'] = ','.join(update_seqs)
+        return response
+
+######################################################################
+# PATH: /inventory/changes
+######################################################################
+CHANGES_MAX_LIMIT = 1000
+# below the 30s gunicorn worker timeout
+CHANGES_MAX_TIMEOUT = 25.0
+
+changes_args = reqparse.RequestParser()
+changes_args.add_argument('since', type=str, location='args',
+                          help='Update sequence to start after (0 for '
+                          'every change, now for the new ones only)')
+changes_args.add_argument('limit', type=int, default=100, location='args',
+                          help='Maximum number of changes')
+changes_args.add_argument('feed', type=str, default='normal',
+                          choices=('normal', 'longpoll'), location='args',
+                          help='longpoll waits for a change')
+changes_args.add_argument('timeout', type=float, default=CHANGES_MAX_TIMEOUT,
+                          location='args',
+                          help='Seconds a longpoll waits at most')
+
+@api.route('/inventory/changes')
+class InventoryChangesResource(Resource):
+    """ The changes feed of the Inventory, for incremental sync """
+    @api.doc('inventory_changes')
+    @api.expect(changes_args, validate=True)
+    @api.response(400, 'The changes parameters were not valid')
+    @api.marshal_with(changes_model)
+    def get(self):
+        """
+        List the changes of Inventory
+        This endpoint returns the Inventory created, updated or deleted
+        after the since sequence, oldest first, and the last_seq to pass
+        as since to get the next ones
+        """
+        args = changes_args.parse_args()
+        limit = min(max(args['limit'], 1), CHANGES_MAX_LIMIT)
+        timeout = min(max(args['timeout'], 0), CHANGES_MAX_TIMEOUT)
+        app.logger.info('Request for inventory changes since %s',
+                        args['since'])
+        since = args['since'].split(',') if args['since'] else None
+        changes, last_seq, pending = Inventory.changes(
+            since, limit, args['feed'] == 'longpoll', timeout)
+        for change in changes:
+            if change['inventory'] is not None:
+                change['inventory'] = change['inventory'].serialize()
+        return {'results': changes, 'last_seq': last_seq,
+                'pending': pending}, status.HTTP_200_OK
+
+######################################################################
+# PATH: /inventory/events
+######################################################################
+events_args = reqparse.RequestParser()
+events_args.add_argument('product-id', type=int, location='args',
+                         help='Only the events of a product id')
+events_args.add_argument('restock', type=inputs.boolean, location='args',
+                         help='Only the events of the Inventory that need '
+                         'restock (or not)')
+
+event_streams = threading.BoundedSemaphore(app.config['EVENTS_MAX_STREAMS'])
+
+@api.route('/inventory/events')
+class InventoryEventsResource(Resource):
+    """ Pushes the changes of the Inventory as Server-Sent Events """
+    @api.doc('inventory_events', produces=['text/event-stream'])
+    @api.expect(events_args, validate=True)
+    @api.response(503, 'Too many event streams are open')
+    def get(self):
+        """
+        Stream the events of Inventory
+        This endpoint pushes a create, update, delete or disable event
+        with the Inventory (null when deleted) for every change, as
+        text/event-stream. The events of an Inventory that stopped
+        matching the filters are sent too, so it can be removed
+        """
+        args = events_args.parse_args()
+        app.logger.info('Request for inventory events')
+        if not event_streams.acquire(blocking=False):
+            app.logger.warning('Too many event streams open')
+            abort(status.HTTP_503_SERVICE_UNAVAILABLE,
+                  'Too many event streams, try again later')
+        subscription = Subscription(args['product-id'], args['restock'])
+        lines = stream(hub, subscription,
+                       request.headers.get('Last-Event-ID'),
+                       heartbeat=app.config['EVENTS_HEARTBEAT'],
+                       duration=app.config['EVENTS_DURATION'])
+        response = app.response_class(stream_with_context(lines),
+                                      mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # no buffering in a proxy in front
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.call_on_close(event_streams.release)
+        return response
+
+######################################################################
+# PATH: /inventory/_lookup
+######################################################################
+@api.route('/inventory/_lookup')
+class InventoryLookupResource(Resource):
+    """ Fetches a batch of Inventory in as few database requests as can be """
+    @api.doc('lookup_inventory')
+    @api.expect(lookup_model)
+    @api.response(400, 'The posted lookup was not valid')
+    def post(self):
+        """
+        Lookup a batch of Inventory
+        This endpoint returns the Inventory of every id posted, in order,
+        using a single database request. Ids that do not exist are reported
+        inline as {"_id": ..., "error": "not_found"}. Inventory matching any
+        of the posted product_ids are appended after them.
+        """
+        app.logger.info('Request to lookup a batch of inventory')
+        check_content_type('application/json')
+        payload = api.payload or {}
+        if not isinstance(payload, dict):
+            raise DataValidationError('Invalid lookup: the body must be an '
+                                      'object')
+        ids = payload.get('ids') or []
+        product_ids = payload.get('product_ids') or []
+        if not isinstance(ids, list) or \
+                not all(isinstance(i, str) for i in ids):
+            raise DataValidationError('Invalid lookup: ids must be a list '
+                                      'of strings')
+        if not isinstance(product_ids, list) or \
+                not all(type(pid) is int for pid in product_ids):
+            raise DataValidationError('Invalid lookup: product_ids must be '
+                                      'a list of integers')
+        results = []
+        found = Inventory.find_many(ids)
+        # every id posted, repeated ones included
+        for inventory_id in ids:
+            inventory = found[inventory_id]
+            if inventory:
+                results.append(inventory.serialize())
+            else:
+                results.append({'_id': inventory_id, 'error': 'not_found'})
+        if product_ids:
+            seen = set(ids)
+            for inventory in Inventory.find_by_product_ids(product_ids):
+                if inventory.id not in seen:
+                    seen.add(inventory.id)
+                    results.append(inventory.serialize())
         return results, status.HTTP_200_OK
 
 ######################################################################
@@ -355,6 +783,213 @@ def reset_inventory():
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 
+######################################################################
+# GET METRICS
+######################################################################
+@app.route('/metrics')
+def metrics():
+    """ Prometheus metrics of the service """
+    return make_response(REGISTRY.render(), status.HTTP_200_OK,
+                         {'Content-Type': METRICS_CONTENT_TYPE})
+
+######################################################################
+# MEMORY PROFILING
+######################################################################
+memory_profiler = MemoryProfiler(frames=app.config['MEMORY_PROFILE_FRAMES'])
+
+def check_admin():
+    """ Aborts unless the request presents the profiling secret """
+    secret = app.config['PROFILE_SECRET']
+    if not secret:
+        abort(status.HTTP_404_NOT_FOUND)
+    if not hmac.compare_digest(request.headers.get('X-Profile', ''), secret):
+        abort(status.HTTP_403_FORBIDDEN)
+
+@app.route('/debug/memory')
+def memory_usage():
+    """ RSS, traced memory and the memory used by each endpoint """
+    check_admin()
+    report = memory_profiler.usage()
+    report['endpoints'] = memory_profiler.endpoint_report()
+    return make_response(jsonify(report), status.HTTP_200_OK)
+
+@app.route('/debug/memory/snapshot', methods=['POST'])
+def memory_snapshot():
+    """ Takes a tracemalloc snapshot and diffs it with the previous one """
+    check_admin()
+    limit = request.args.get('limit', 20, type=int)
+    group_by = request.args.get('group-by', 'lineno')
+    if group_by not in ('lineno', 'filename', 'traceback'):
+        abort(status.HTTP_400_BAD_REQUEST,
+              'group-by must be lineno, filename or traceback')
+    report = memory_profiler.snapshot(limit, group_by)
+    report['endpoints'] = memory_profiler.endpoint_report()
+    return make_response(jsonify(report), status.HTTP_200_OK)
+
+@app.before_request
+def start_memory_tracking():
+    """ Notes the memory in use when the request starts """
+    if app.config['MEMORY_PROFILE']:
+        g.memory_started = memory_profiler.request_started()
+
+@app.teardown_request
+def finish_memory_tracking(_error=None):
+    """ Records the memory the request used against its endpoint """
+    started = g.pop('memory_started', None)
+    if started is not None:
+        memory_profiler.request_finished(
+            '{} {}'.format(request.method, request.endpoint or 'unmatched'),
+            started)
+
+def log_memory_snapshot(*_args):
+    """ Signal handler logging a snapshot diff from a background thread """
+    def report():
+        app.logger.warning('Memory snapshot: %s', json.dumps(
+            memory_profiler.snapshot(limit=10), sort_keys=True))
+    threading.Thread(target=report, daemon=True).start()
+
+if app.config['MEMORY_PROFILE']:
+    memory_profiler.start()
+    try:
+        signal.signal(getattr(signal, app.config['MEMORY_PROFILE_SIGNAL']),
+                      log_memory_snapshot)
+    except (AttributeError, ValueError) as error:
+        app.logger.warning('No memory snapshot signal handler: %s', error)
+
+@app.before_request
+def start_request_metrics():
+    """ Counts the request as in flight and starts its timer """
+    g.request_started = time.perf_counter()
+    HTTP_IN_FLIGHT.inc()
+
+@app.after_request
+def record_request_metrics(response):
+    """ Records the duration and status of the request """
+    started = g.get('request_started')
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        HTTP_DURATION.observe(time.perf_counter() - started,
+                              endpoint=endpoint, method=request.method)
+        HTTP_RESPONSES.inc(endpoint=endpoint, method=request.method,
+                           status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(_error=None):
+    """ The request is no longer in flight """
+    if g.pop('request_started', None) is not None:
+        HTTP_IN_FLIGHT.dec()
+    stop_timings()
+
+######################################################################
+# RESTOCK WEBHOOKS
+######################################################################
+webhooks = WebhookDispatcher(
+    app.config['WEBHOOK_URLS'],
+    batch_size=app.config['WEBHOOK_BATCH_SIZE'],
+    batch_interval=app.config['WEBHOOK_BATCH_INTERVAL'],
+    max_attempts=app.config['WEBHOOK_MAX_ATTEMPTS'],
+    secret=app.config['WEBHOOK_SECRET'])
+if webhooks.urls:
+    Inventory.restock_listeners.append(webhooks.send)
+
+######################################################################
+# TRACING
+######################################################################
+tracer = Tracer(JsonLinesExporter(app.config['TRACE_FILE'])
+                if app.config['TRACE_FILE'] else None,
+                sample_rate=app.config['TRACE_SAMPLE_RATE'])
+
+@app.before_request
+def start_trace():
+    """ Opens the root span of a sampled request """
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    root = tracer.start_trace('{} {}'.format(request.method, rule),
+                              request.headers.get('traceparent'),
+                              {'http.method': request.method,
+                               'http.route': rule,
+                               'http.target': request.full_path})
+    if root is not None:
+        g.trace_span = root.__enter__()
+
+@app.after_request
+def record_trace_status(response):
+    """ Adds the response status to the root span """
+    root = g.get('trace_span')
+    if root is not None:
+        root.set('http.status_code', response.status_code)
+    return response
+
+@app.teardown_request
+def finish_trace(error=None):
+    """ Closes the root span and exports the trace """
+    root = g.pop('trace_span', None)
+    if root is not None:
+        root.__exit__(type(error) if error else None, error, None)
+        tracer.finish(root)
+
+######################################################################
+# SERVER-TIMING
+######################################################################
+@app.before_request
+def start_server_timing():
+    """ Collects the phase timings of the request when enabled """
+    if app.config['SERVER_TIMING']:
+        start_timings()
+
+@app.after_request
+def add_server_timing(response):
+    """ Returns the phase timings in a Server-Timing header """
+    timings = stop_timings()
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.header()
+    return response
+
+######################################################################
+# COMPRESSION
+######################################################################
+@app.after_request
+def compress_response(response):
+    """ Compresses large responses with the encoding the client prefers """
+    if not app.config['COMPRESS'] or \
+            not compressible(response, app.config['COMPRESS_MIN_SIZE']):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.accept_encodings)
+    if encoding is not None:
+        level = app.config['COMPRESS_BROTLI_QUALITY' if encoding == 'br'
+                           else 'COMPRESS_LEVEL']
+        response.set_data(compress(response.get_data(), encoding, level))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+######################################################################
+# READ-YOUR-WRITES
+######################################################################
+READ_PRIMARY_COOKIE = 'read-primary-until'
+
+@app.before_request
+def pin_reads_after_writes():
+    """ Reads from the primary while the client's last write is recent """
+    Inventory.unpin_primary()
+    try:
+        until = float(request.cookies.get(READ_PRIMARY_COOKIE, 0))
+    except ValueError:
+        until = 0
+    # the cookie comes from the client: it can't pin for longer than a write
+    until = min(until, time.time() + READ_YOUR_WRITES)
+    if until > time.time():
+        Inventory.pin_primary(until)
+
+@app.after_request
+def remember_writes(response):
+    """ Tells the client how long its reads should stay on the primary """
+    until = Inventory.primary_until()
+    if Inventory.replicas and until > time.time():
+        response.set_cookie(READ_PRIMARY_COOKIE, '{:.3f}'.format(until),
+                            expires=until, httponly=True)
+    return response
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
@@ -368,7 +1003,16 @@ def check_content_type(content_type):
 
 def initialize_logging(log_level=logging.INFO):
     """ Initialized the default logging to STDOUT """
-    if not app.debug:
+    if not app.debug and app.config.get('LOG_FORMAT') == 'json':
+        # JSON lines written by a background thread, see service/logs.py
+        configure_json_logging(
+            [logging.getLogger(), app.logger], log_level, sys.stdout,
+            parse_rates(app.config.get('LOG_SAMPLING')),
+            parse_rates(app.config.get('LOG_RATE_LIMIT')),
+            app.config.get('LOG_QUEUE_SIZE', 10000))
+        app.logger.propagate = False
+        app.logger.info('Logging handler established')
+    elif not app.debug:
         # Set up default logging for submodules to use STDOUT
         # datefmt='%m/%d/%Y %I:%M:%S %p'
         fmt = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
@@ -0,0 +1,117 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Single-flight coalescing of identical reads
+When a thread asks for a read that another thread of the worker is
+already running with the same arguments, it waits for that call and
+shares its result (or exception) instead of sending its own request.
+The inventory_db_reads_total counter tells the calls that ran (leader)
+from the ones that were coalesced (follower), and the
+inventory_db_reads_coalesced_ratio gauge holds the share of the latter.
+"""
+import functools
+import json
+import threading
+
+from service.metrics import Counter, Gauge
+
+DB_READS = Counter('inventory_db_reads_total',
+                   'Model reads that ran (leader) or shared an identical '
+                   'read in flight (follower)', ('operation', 'flight'))
+DB_READS_COALESCED = Gauge('inventory_db_reads_coalesced_ratio',
+                           'Share of the model reads that were coalesced',
+                           ('operation',))
+
+def count(operation, leader):
+    """ Counts a read and updates the coalescing ratio of its operation """
+    DB_READS.inc(operation=operation,
+                 flight='leader' if leader else 'follower')
+    DB_READS_COALESCED.set(coalescing_ratio(operation), operation=operation)
+
+def coalescing_ratio(operation):
+    """ Returns the share of the reads of an operation that were coalesced """
+    leaders = DB_READS.value(operation=operation, flight='leader')
+    followers = DB_READS.value(operation=operation, flight='follower')
+    total = leaders + followers
+    return followers / total if total else 0.0
+
+class _Call():
+    """ A read in flight """
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.error = None
+
+class SingleFlight():
+    """ Shares the identical calls in flight between threads """
+
+    def __init__(self, copy=None, bypass=None, enabled=True):
+        self.copy = copy or (lambda result: result)
+        self.bypass = bypass
+        self.enabled = enabled
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, operation=''):
+        """ Returns func(), or the result of the call of key in flight """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+        count(operation, leader)
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            # the callers may change what they get
+            return self.copy(call.result)
+        try:
+            result = func()
+            with self._lock:
+                del self._calls[key]
+            if call.followers:
+                # a copy the leader can't change before the followers
+                # copy it in turn
+                call.result = self.copy(result)
+            return result
+        except BaseException as error:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.error = error
+            raise
+        finally:
+            call.done.set()
+
+    def coalesce(self, operation):
+        """
+        Decorates a classmethod so that the concurrent calls with the same
+        arguments share one call
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(cls, *args, **kwargs):
+                if not self.enabled or (self.bypass and self.bypass()):
+                    count(operation, True)
+                    return func(cls, *args, **kwargs)
+                key = (operation, json.dumps([args, kwargs],
+                                             sort_keys=True, default=str))
+                return self.do(key, lambda: func(cls, *args, **kwargs),
+                               operation)
+            return wrapper
+        return decorator
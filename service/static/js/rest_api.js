@@ -35,6 +35,160 @@ $(function () {
         $("#flash_message").append(message);
     }
 
+    // ****************************************
+    //  L I V E   T A B L E
+    // ****************************************
+
+    // The filters of the rendered table ({} for every inventory, null
+    // when none is rendered) and the event stream keeping it current
+    var view = null;
+    var events = null;
+
+    // The fields compared by each filter of GET /inventory
+    var FILTERS = {
+        "product-id": "product_id",
+        "quantity": "quantity",
+        "condition": "condition",
+        "available": "available",
+        "restock-level": "restock_level"
+    };
+
+    function inventory_row(inventory) {
+        return "<tr data-id=\""+inventory._id+"\"><td>"+inventory._id+"</td><td>"+inventory.product_id+"</td><td>"+inventory.quantity+"</td><td>"+inventory.restock_level+"</td><td>"+inventory.condition+"</td><td>"+inventory.available+"</td></tr>";
+    }
+
+    // Renders the results of a query and follows its changes
+    function render_table(res, filters) {
+        $("#search_results").empty();
+        var table = '<table class="table-striped"><thead><tr>'
+        table += '<th class="col-md-3 text-center">ID</th>'
+        table += '<th class="col-md-2 text-center">Product Id</th>'
+        table += '<th class="col-md-1 text-center">Quantity</th>'
+        table += '<th class="col-md-2 text-center">Restock Level</th>'
+        table += '<th class="col-md-2 text-center">Condition</th>'
+        table += '<th class="col-md-2 text-center">Availability</th></tr>'
+        table += '</thead><tbody>'
+        for(var i = 0; i < res.length; i++) {
+            table += inventory_row(res[i]);
+        }
+        table += '</tbody></table>'
+        $("#search_results").append(table);
+        follow_events(filters)
+    }
+
+    // Empties the results and stops following their changes
+    function close_table() {
+        $("#search_results").empty();
+        view = null;
+        if (events) {
+            events.close();
+            events = null;
+        }
+    }
+
+    // Re-fetches the results after a write, unless events update them
+    function refresh_table() {
+        if (!events || events.readyState === EventSource.CLOSED) {
+            list_all_inventories()
+        }
+    }
+
+    // Parses "name=value&..." into an object of filters
+    function parse_query(queryString) {
+        var filters = {};
+        var pairs = queryString.split("&");
+        for (var i = 0; i < pairs.length; i++) {
+            var pair = pairs[i].split("=");
+            if (pair[0]) {
+                filters[pair[0]] = pair[1];
+            }
+        }
+        return filters;
+    }
+
+    // True if an inventory belongs in the rendered table
+    function matches_view(inventory) {
+        for (var name in view) {
+            if (name == "restock") {
+                var restock = inventory.quantity < inventory.restock_level;
+                if (String(restock) != view[name]) {
+                    return false;
+                }
+            } else if (String(inventory[FILTERS[name]]) != view[name]) {
+                return false;
+            }
+        }
+        return true;
+    }
+
+    // Subscribes to the events of the inventory the table can show
+    function follow_events(filters) {
+        view = filters;
+        if (events) {
+            events.close();
+            events = null;
+        }
+        if (!window.EventSource) {
+            return;
+        }
+        var params = [];
+        if (filters["product-id"] !== undefined) {
+            params.push("product-id=" + filters["product-id"]);
+        }
+        if (filters["restock"] !== undefined) {
+            params.push("restock=" + filters["restock"]);
+        }
+        events = new EventSource("/inventory/events" + (params.length > 0 ? "?" + params.join("&") : ""));
+        ["create", "update", "disable", "delete"].forEach(function(type) {
+            events.addEventListener(type, apply_event);
+        });
+        // a refused stream (503 when the server has too many open) is not
+        // retried: go back to fetching the table after each write
+        var source = events;
+        source.onerror = function() {
+            if (source.readyState === EventSource.CLOSED && events === source) {
+                events = null;
+                list_all_inventories();
+            }
+        };
+        // too many changes were missed: fetch the table again
+        events.addEventListener("reset", function() {
+            var query = $.param(view);
+            $.ajax({
+                type: "GET",
+                url: "/inventory" + (query.length > 0 ? "?" + query : ""),
+                contentType: "application/json",
+                data: ''
+            }).done(function(res){
+                render_table(res, view)
+            });
+        });
+    }
+
+    // Adds, replaces or removes the row of the changed inventory
+    function apply_event(event) {
+        var change = JSON.parse(event.data);
+        var rows = $("#search_results tbody tr");
+        var row = rows.filter(function() {
+            return $(this).attr("data-id") == change._id;
+        });
+        if (!change.inventory || !matches_view(change.inventory)) {
+            row.remove();
+        } else if (row.length > 0) {
+            row.replaceWith(inventory_row(change.inventory));
+        } else {
+            // keep the rows in _id order, like the responses
+            var next = rows.filter(function() {
+                return $(this).attr("data-id") > change._id;
+            }).first();
+            if (next.length > 0) {
+                next.before(inventory_row(change.inventory));
+            } else {
+                $("#search_results tbody").append(inventory_row(change.inventory));
+            }
+        }
+    }
+
     function list_all_inventories() {
         var ajax = $.ajax({
             type: "GET",
@@ -44,21 +198,7 @@ $(function () {
         })
 
         ajax.done(function(res){
-            $("#search_results").empty();
-            var table = '<table class="table-striped"><thead><tr>'
-            table += '<th class="col-md-3 text-center">ID</th>'
-            table += '<th class="col-md-2 text-center">Product Id</th>'
-            table += '<th class="col-md-1 text-center">Quantity</th>'
-            table += '<th class="col-md-2 text-center">Restock Level</th>'
-            table += '<th class="col-md-2 text-center">Condition</th>'
-            table += '<th class="col-md-2 text-center">Availability</th></tr>'
-            table += '</thead><tbody>'
-            for(var i = 0; i < res.length; i++) {
-                var inventory = res[i];
-                table += "<tr><td>"+inventory._id+"</td><td>"+inventory.product_id+"</td><td>"+inventory.quantity+"</td><td>"+inventory.restock_level+"</td><td>"+inventory.condition+"</td><td>"+inventory.available+"</td></tr>";
-            }
-            table += '</tbody></table>'
-            $("#search_results").append(table);
+            render_table(res, {})
         });
 
         ajax.fail(function(res){
@@ -95,7 +235,7 @@ $(function () {
         ajax.done(function(res){
             update_form_data(res)
             flash_message("Success")
-            list_all_inventories()
+            refresh_table()
         });
 
         ajax.fail(function(res){
@@ -136,7 +276,7 @@ $(function () {
         ajax.done(function(res){
             update_form_data(res)
             flash_message("Inventory "+ inventory_id +" has been Updated!")
-            list_all_inventories()
+            refresh_table()
         });
 
         ajax.fail(function(res){
@@ -165,7 +305,7 @@ $(function () {
             ajax.done(function(res){
                 update_form_data(res)
                 flash_message("Product " + product_id +" has been Disabled!")
-                list_all_inventories()
+                refresh_table()
             });
 
             ajax.fail(function(res){
@@ -186,21 +326,7 @@ $(function () {
                 data: ''
             })
             ajax.done(function(res){
-                $("#search_results").empty();
-                var table = '<table class="table-striped"><thead><tr>'
-                table += '<th class="col-md-3 text-center">ID</th>'
-                table += '<th class="col-md-2 text-center">Product Id</th>'
-                table += '<th class="col-md-1 text-center">Quantity</th>'
-                table += '<th class="col-md-2 text-center">Restock Level</th>'
-                table += '<th class="col-md-2 text-center">Condition</th>'
-                table += '<th class="col-md-2 text-center">Availability</th></tr>'
-                table += '</thead><tbody>'
-                for(var i = 0; i < res.length; i++) {
-                    var inventory = res[i];
-                    table += "<tr><td>"+inventory._id+"</td><td>"+inventory.product_id+"</td><td>"+inventory.quantity+"</td><td>"+inventory.restock_level+"</td><td>"+inventory.condition+"</td><td>"+inventory.available+"</td></tr>";
-                }
-                table += '</tbody></table>'
-                $("#search_results").append(table);
+                render_table(res, {"restock": "true"})
                 flash_message('GET /inventory?restock=true Success!')
             });
 
@@ -215,7 +341,7 @@ $(function () {
     // ****************************************
 
     $("#retrieve-btn").click(function () {
-        $("#search_results").empty();
+        close_table();
         var inventory_id = $("#inventory_id").val();
 
         if(!inventory_id.trim().length) {
@@ -262,7 +388,7 @@ $(function () {
             ajax.done(function(res){
                 clear_form_data()
                 flash_message("Inventory "+ inventory_id +" has been Deleted!")
-                list_all_inventories()
+                refresh_table()
             });
 
             ajax.fail(function(res){
@@ -346,27 +472,12 @@ $(function () {
             })
 
             ajax.done(function(res){
-                $("#search_results").empty();
-                var table = '<table class="table-striped"><thead><tr>'
-                table += '<th class="col-md-3 text-center">ID</th>'
-                table += '<th class="col-md-2 text-center">Product Id</th>'
-                table += '<th class="col-md-1 text-center">Quantity</th>'
-                table += '<th class="col-md-2 text-center">Restock Level</th>'
-                table += '<th class="col-md-2 text-center">Condition</th>'
-                table += '<th class="col-md-2 text-center">Availability</th></tr>'
-                table += '</thead><tbody>'
-                for(var i = 0; i < res.length; i++) {
-                    var inventory = res[i];
-                    table += "<tr><td>"+inventory._id+"</td><td>"+inventory.product_id+"</td><td>"+inventory.quantity+"</td><td>"+inventory.restock_level+"</td><td>"+inventory.condition+"</td><td>"+inventory.available+"</td></tr>";
-                }
-
-                table += '</tbody></table>'
-                $("#search_results").append(table)
+                render_table(res, parse_query(queryString))
                 flash_message('GET /inventory' + (queryString.length > 0 ? '?'+ queryString :'') +' Success! <br>')
             });
 
             ajax.fail(function(res){
-                $("#search_results").empty()
+                close_table()
                 clear_form_data()
                 flash_message(res.responseJSON.message + '<br> Only accept following search request:<br>'+ 'GET /inventory?product-id={product-id}<br>GET /inventory?available={isAvailable}<br>GET /inventory?available={isAvailable}&product-id={product-id}<br>GET /inventory?restock-level={restock-level-value}<br>GET /inventory?condition={condition}<br>GET /inventory?condition={condition}&product-id={product-id}<br>')
             });
@@ -377,7 +488,7 @@ $(function () {
     });
 
     function invalidSearch(queryString) {
-        $("#search_results").empty()
+        close_table()
         clear_form_data()
         flash_message('GET /inventory?' + queryString + ' Failed! <br> Only accept following search request:<br>'+ 'GET /inventory?product-id={product-id}<br>GET /inventory?available={isAvailable}<br>GET /inventory?available={isAvailable}&product-id={product-id}<br>GET /inventory?restock-level={restock-level-value}<br>GET /inventory?condition={condition}<br>GET /inventory?condition={condition}&product-id={product-id}<br>')
     }
@@ -0,0 +1,224 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Request tracing for the Inventory service
+Each sampled request is a trace: a root span for the Flask request with
+child spans for the CouchDB calls, deserialization and marshalling. The
+spans of a trace are written together, one JSON object per line, when the
+request ends.
+
+A W3C traceparent header on the request continues the caller's trace and
+its sampled flag decides whether the request is traced.
+"""
+import os
+import json
+import time
+import random
+import threading
+import functools
+import contextvars
+
+_CURRENT = contextvars.ContextVar('inventory_span', default=None)
+
+def _new_id(size):
+    """ Returns a random non-zero id of size bytes as hex """
+    return '{:0{}x}'.format(random.getrandbits(size * 8) or 1, size * 2)
+
+def parse_traceparent(header):
+    """ Returns (trace_id, parent_id, sampled) or None if invalid """
+    parts = (header or '').strip().lower().split('-')
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == 'ff':
+        return None
+    version, trace_id, parent_id, flags = parts[:4]
+    if version == '00' and len(parts) != 4:
+        return None
+    try:
+        if len(trace_id) != 32 or len(parent_id) != 16 or len(flags) != 2 \
+                or not int(trace_id, 16) or not int(parent_id, 16):
+            return None
+        return trace_id, parent_id, bool(int(flags, 16) & 1)
+    except ValueError:
+        return None
+
+class Span():
+    """ A timed operation of a trace """
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.error = None
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.duration = None
+        self._token = None
+
+    def set(self, key, value):
+        """ Sets an attribute of the span """
+        self.attributes[key] = value
+
+    def event(self, name, **attributes):
+        """ Records a point in time event on the span """
+        self.events.append({'name': name, 'time': time.time(),
+                            'attributes': attributes})
+
+    def traceparent(self):
+        """ Returns the traceparent header identifying this span """
+        return '00-{}-{}-01'.format(self.trace.trace_id, self.span_id)
+
+    def end(self):
+        """ Ends the span and hands it to its trace """
+        if self.duration is None:
+            self.duration = time.perf_counter() - self._started
+            self.trace.add(self)
+
+    def __enter__(self):
+        self._token = _CURRENT.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, _tb):
+        if exc is not None:
+            self.error = '{}: {}'.format(exc_type.__name__, exc)
+        _CURRENT.reset(self._token)
+        self.end()
+        return False
+
+    def to_dict(self):
+        """ Returns the span as written by the exporter """
+        return {'trace_id': self.trace.trace_id, 'span_id': self.span_id,
+                'parent_id': self.parent_id, 'name': self.name,
+                'start': self.start,
+                'duration_ms': round(self.duration * 1000.0, 3),
+                'attributes': self.attributes, 'events': self.events,
+                'error': self.error}
+
+class _Trace():
+    """ The finished spans of one trace, exported together """
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, finished):
+        """ Adds a finished span """
+        with self._lock:
+            self.spans.append(finished)
+
+    def drain(self):
+        """ Returns the finished spans and forgets them """
+        with self._lock:
+            spans, self.spans = self.spans, []
+        return spans
+
+class JsonLinesExporter():
+    """ Appends spans to a file, one JSON object per line """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def export(self, spans):
+        """ Writes a batch of spans """
+        lines = ''.join(json.dumps(item.to_dict(), default=str) + '\n'
+                        for item in spans)
+        with self._lock:
+            with open(self.path, 'a') as stream:
+                stream.write(lines)
+
+class Tracer():
+    """ Starts traces for the sampled requests and exports them """
+
+    def __init__(self, exporter=None, sample_rate=1.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def start_trace(self, name, traceparent=None, attributes=None):
+        """
+        Returns the root span of a new trace, or None when the request is
+        not sampled. The caller enters it and calls finish() at the end
+        """
+        if self.exporter is None:
+            return None
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id = _new_id(16), None
+            sampled = random.random() < self.sample_rate
+        if not sampled:
+            return None
+        return Span(_Trace(trace_id), name, parent_id, attributes)
+
+    def finish(self, root):
+        """ Ends the root span and exports every span of its trace """
+        root.end()
+        self.exporter.export(root.trace.drain())
+
+def current_span():
+    """ Returns the active span of the current request or None """
+    return _CURRENT.get()
+
+class _NoSpan():
+    """ Stands in for a span when the request is not traced """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, key, value):
+        """ Ignores the attribute """
+
+    def event(self, name, **attributes):
+        """ Ignores the event """
+
+_NO_SPAN = _NoSpan()
+
+def span(name, **attributes):
+    """ Returns a child span of the active span (a no-op if untraced) """
+    parent = _CURRENT.get()
+    if parent is None:
+        return _NO_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+def record_span(name, start, duration, **attributes):
+    """ Records a child span that was timed by the caller """
+    parent = _CURRENT.get()
+    if parent is None:
+        return
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    child.start = start
+    child.duration = duration
+    parent.trace.add(child)
+
+def traced(name):
+    """ Decorator running a function in a child span """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _CURRENT.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
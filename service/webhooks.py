@@ -0,0 +1,155 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Restock webhooks
+The writes of Inventory report the items whose quantity crosses below
+their restock level or back above it (see Inventory.notify_restock). The
+dispatcher queues these events and a background thread POSTs them in
+batches to every configured URL, retrying with backoff, so a write never
+waits on a receiver. Every event has an id, the Inventory id and the
+revision written, which is sent once per process and lets the receivers
+drop the ones they have already seen.
+"""
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import threading
+import time
+import requests
+
+from service.metrics import Counter
+
+WEBHOOK_EVENTS = Counter('inventory_webhook_events_total',
+                         'Restock events by outcome (queued, duplicate, '
+                         'dropped, delivered, failed)', ('outcome',))
+
+logger = logging.getLogger(__name__)
+
+def sign(secret, body):
+    """ Returns the X-Inventory-Signature of a body """
+    return 'sha256=' + hmac.new(secret.encode('utf8'), body,
+                                hashlib.sha256).hexdigest()
+
+class WebhookDispatcher():
+    """ Delivers the restock events to the webhook URLs in batches """
+
+    def __init__(self, urls=(), batch_size=100, batch_interval=1.0,
+                 max_attempts=5, retry_delay=1.0, timeout=5.0,
+                 queue_size=10000, dedup_size=10000, secret=None):
+        self.urls = list(urls)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.dedup_size = dedup_size
+        self.secret = secret
+        self.session = requests.Session()
+        self._events = queue.Queue(queue_size)
+        self._seen = collections.OrderedDict()  # recent event ids
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def send(self, event):
+        """ Queues an event, unless it was already queued """
+        with self._lock:
+            if event['id'] in self._seen:
+                WEBHOOK_EVENTS.inc(outcome='duplicate')
+                return
+            self._seen[event['id']] = True
+            if len(self._seen) > self.dedup_size:
+                self._seen.popitem(last=False)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='inventory-webhooks',
+                                                daemon=True)
+                self._thread.start()
+        try:
+            self._events.put_nowait(event)
+        except queue.Full:
+            WEBHOOK_EVENTS.inc(outcome='dropped')
+            logger.warning('Webhook queue full, dropped event %s',
+                           event['id'])
+            return
+        WEBHOOK_EVENTS.inc(outcome='queued')
+
+    def flush(self, timeout=None):
+        """ Waits until the queued events are delivered or failed """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._events.all_tasks_done:
+            while self._events.unfinished_tasks:
+                remaining = None if deadline is None else \
+                    deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._events.all_tasks_done.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            batch = [self._events.get()]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._events.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.deliver(batch)
+            finally:
+                for _ in batch:
+                    self._events.task_done()
+
+    def deliver(self, batch):
+        """ POSTs a batch of events to every URL """
+        body = json.dumps({'events': batch}).encode('utf8')
+        headers = {'Content-Type': 'application/json'}
+        if self.secret:
+            headers['X-Inventory-Signature'] = sign(self.secret, body)
+        for url in self.urls:
+            if self._post(url, body, headers):
+                WEBHOOK_EVENTS.inc(len(batch), outcome='delivered')
+            else:
+                WEBHOOK_EVENTS.inc(len(batch), outcome='failed')
+                logger.error('Webhook %s: %d events not delivered', url,
+                             len(batch))
+
+    def _post(self, url, body, headers):
+        """ POSTs a body, retrying errors with backoff """
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                response = self.session.post(url, data=body,
+                                             headers=headers,
+                                             timeout=self.timeout)
+            except requests.RequestException as error:
+                logger.warning('Webhook %s failed: %s', url, error)
+                continue
+            if response.status_code < 300:
+                return True
+            logger.warning('Webhook %s returned %s', url,
+                           response.status_code)
+            # a client error other than 408 and 429 won't get better
+            if 400 <= response.status_code < 500 and \
+                    response.status_code not in (408, 429):
+                return False
+        return False
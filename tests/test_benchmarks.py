@@ -0,0 +1,109 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Test cases for the benchmark helpers
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from service.models import Inventory
+from benchmarks.load_test import percentile
+from benchmarks.generate_data import Settings, generate_batch, load, \
+    parse_weights
+from benchmarks.microbench import BENCHMARKS, compare, parse_size, run
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestBenchmarks(unittest.TestCase):
+    """ Test Cases for the benchmark helpers """
+
+    def test_percentile(self):
+        """ Compute nearest-rank percentiles """
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_parse_size(self):
+        """ Parse dataset sizes """
+        self.assertEqual(parse_size('1k'), 1000)
+        self.assertEqual(parse_size('1M'), 1000000)
+        self.assertEqual(parse_size('250'), 250)
+
+    def test_run(self):
+        """ Run every microbenchmark on a tiny dataset """
+        results = run(['20'], min_time=0)
+        self.assertEqual(sorted(results),
+                         sorted('{}[20]'.format(name) for name in BENCHMARKS))
+        for stats in results.values():
+            self.assertGreaterEqual(stats['rounds'], 5)
+            self.assertLessEqual(stats['min'], stats['median'])
+
+    def test_compare(self):
+        """ Flag the benchmarks slower than the baseline """
+        baseline = {'all[1k]': {'median': 1.0},
+                    'serialize[1k]': {'median': 1.0}}
+        results = {'all[1k]': {'median': 1.2},
+                   'serialize[1k]': {'median': 1.05},
+                   'deserialize[1k]': {'median': 1.0}}
+        rows, regressions = compare(results, baseline, threshold=10)
+        self.assertEqual(regressions, ['all[1k]'])
+        self.assertEqual(rows[1], ('deserialize[1k]', None, 1.0, None))
+        self.assertAlmostEqual(rows[0][3], 20.0)
+
+    def test_generate_batch(self):
+        """ Generate reproducible rows with the configured skew """
+        settings = Settings(rows=5000, products=100, product_skew=1.2,
+                            conditions=parse_weights('new=1,used=0'),
+                            available=0.5, restock_ratio=0.2, seed=7,
+                            batch_size=2000)
+        self.assertEqual(settings.batches, 3)
+        docs = generate_batch(settings, 1)
+        self.assertEqual(docs, generate_batch(settings, 1))
+        self.assertNotEqual(docs, generate_batch(settings, 0))
+        self.assertEqual(len(generate_batch(settings, 2)), 1000)
+        self.assertEqual({doc['condition'] for doc in docs}, {'new'})
+        restock = sum(doc['quantity'] < doc['restock_level'] for doc in docs)
+        self.assertAlmostEqual(restock / len(docs), 0.2, delta=0.05)
+        first = sum(doc['product_id'] == 1 for doc in docs)
+        last = sum(doc['product_id'] == 100 for doc in docs)
+        self.assertGreater(first, 10 * max(last, 1))
+        self.assertTrue(all(1 <= doc['product_id'] <= 100 for doc in docs))
+
+        keyed = generate_batch(settings, 0, natural_keys=True)
+        self.assertEqual([doc['_id'] for doc in keyed[:4]],
+                         ['1:new', '1:open_box', '1:used', '2:new'])
+        prefixed = generate_batch(settings, 0, prefixed=True)
+        self.assertTrue(all(doc['_id'].startswith(
+            '{}:'.format(doc['product_id'])) for doc in prefixed))
+
+    def test_load(self):
+        """ Bulk load generated rows into CouchDB """
+        Inventory.init_db('test')
+        Inventory.remove_all()
+        report = load('test', Settings(rows=250, products=20, seed=3,
+                                       batch_size=100))
+        self.assertEqual((report['rows'], report['written'],
+                          report['batches']), (250, 250, 3))
+        self.assertEqual(len(Inventory.all()), 250)
+        # reloading the same seed conflicts on every id
+        report = load('test', Settings(rows=250, products=20, seed=3,
+                                       batch_size=100))
+        self.assertEqual(report['conflicts'], 250)
+        Inventory.remove_all()
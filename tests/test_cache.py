@@ -0,0 +1,117 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Test cases for the in-process caches
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from service.cache import NegativeCache, ResponseCache
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestNegativeCache(unittest.TestCase):
+    """ Test Cases for NegativeCache """
+
+    def setUp(self):
+        self.now = 100.0
+        self.cache = NegativeCache(ttl=5, size=2, clock=lambda: self.now)
+
+    def test_ttl(self):
+        """ Forget the missing ids after the ttl """
+        self.cache.add('a')
+        self.assertIn('a', self.cache)
+        self.now += 5
+        self.assertNotIn('a', self.cache)
+        self.assertEqual(len(self.cache), 0)
+        NegativeCache(ttl=0).add('a')
+
+    def test_bound(self):
+        """ Keep the size most recent ids """
+        for key in 'abc':
+            self.cache.add(key)
+        self.assertNotIn('a', self.cache)
+        self.assertIn('b', self.cache)
+        self.assertIn('c', self.cache)
+
+    def test_invalidation(self):
+        """ Forget created ids, ignore lookups older than a creation """
+        self.cache.add('a')
+        self.cache.discard('a')
+        self.assertNotIn('a', self.cache)
+        generation = self.cache.generation()
+        self.cache.discard('b')
+        self.cache.add('b', generation)
+        self.assertNotIn('b', self.cache)
+        self.cache.add('b', self.cache.generation())
+        self.assertIn('b', self.cache)
+        self.cache.clear()
+        self.assertNotIn('b', self.cache)
+
+class TestResponseCache(unittest.TestCase):
+    """ Test Cases for ResponseCache """
+
+    def setUp(self):
+        self.now = 100.0
+        self.writes = 0
+        self.seqs = ['1-a']
+        self.cache = ResponseCache(40, lambda: self.writes,
+                                   lambda: self.seqs, seq_interval=1,
+                                   clock=lambda: self.now)
+
+    def test_hit(self):
+        """ Serve a body computed at the same version """
+        version = self.cache.version()
+        self.assertIsNone(self.cache.get('a', version))
+        self.cache.put('a', version, b'[1]')
+        self.assertEqual(self.cache.get('a', self.cache.version()), b'[1]')
+        self.assertEqual(self.cache.stats['hit'], 1)
+        self.assertEqual(self.cache.stats['miss'], 1)
+
+    def test_versions(self):
+        """ Drop the bodies of a previous version """
+        version = self.cache.version()
+        self.cache.put('a', version, b'[1]')
+        self.writes += 1
+        self.assertIsNone(self.cache.get('a', self.cache.version()))
+        self.assertEqual(self.cache.stats['evicted_stale'], 1)
+        # a body computed before the write is not kept
+        self.cache.put('a', version, b'[1]')
+        self.assertEqual(len(self.cache), 0)
+        # the update sequences are read at most every seq_interval
+        version = self.cache.version()
+        self.cache.put('a', version, b'[2]')
+        self.seqs = ['2-b']
+        self.assertEqual(self.cache.version(), version)
+        self.now += 1
+        self.assertNotEqual(self.cache.version(), version)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_bound(self):
+        """ Evict the least recently used bodies past max_bytes """
+        version = self.cache.version()
+        for key in 'abcd':
+            self.cache.put(key, version, b'x' * 10)
+        self.cache.get('a', version)
+        self.cache.put('e', version, b'x' * 10)
+        self.assertIsNotNone(self.cache.get('a', version))
+        self.assertIsNone(self.cache.get('b', version))
+        self.assertEqual(self.cache.stats['evicted_size'], 1)
+        # a body over a quarter of max_bytes is not kept
+        self.cache.put('f', version, b'x' * 11)
+        self.assertIsNone(self.cache.get('f', version))
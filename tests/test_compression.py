@@ -0,0 +1,83 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Test cases for response compression and the static assets
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+from service import compression
+from service.compression import build_assets, compress, load_manifest, \
+    negotiate, rewrite_links
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+def accept(header):
+    """ Parses an Accept-Encoding header like the request does """
+    return parse_accept_header(header, Accept)
+
+class TestCompression(unittest.TestCase):
+    """ Test Cases for compression """
+
+    def test_negotiate(self):
+        """ Pick the encoding the client prefers """
+        with patch.object(compression, 'brotli', object()):
+            self.assertEqual(negotiate(accept('gzip, deflate, br')), 'br')
+            self.assertEqual(negotiate(accept('gzip, br;q=0.5')), 'gzip')
+            self.assertEqual(negotiate(accept('*')), 'br')
+        with patch.object(compression, 'brotli', None):
+            self.assertEqual(negotiate(accept('gzip, deflate, br')), 'gzip')
+        self.assertIsNone(negotiate(accept('deflate')))
+        self.assertIsNone(negotiate(accept('gzip;q=0')))
+        self.assertIsNone(negotiate(accept('gzip'), []))
+
+    def test_compress(self):
+        """ gzip the same input to the same output """
+        data = b'{"quantity": 1}' * 100
+        self.assertEqual(gzip.decompress(compress(data, 'gzip', 6)), data)
+        self.assertEqual(compress(data, 'gzip', 9), compress(data, 'gzip', 9))
+
+    def test_build_assets(self):
+        """ Build hashed and precompressed assets """
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        os.makedirs(os.path.join(source, 'js'))
+        with open(os.path.join(source, 'js', 'app.js'), 'w') as stream:
+            stream.write('var inventory = [];\n' * 50)
+        with open(os.path.join(source, 'index.html'), 'w') as stream:
+            stream.write('<script src="static/js/app.js"></script>')
+        target = os.path.join(source, 'dist')
+        self.assertEqual(load_manifest(target), {})
+        manifest = build_assets(source, target)
+        self.assertRegex(manifest['js/app.js'], r'^js/app\.[0-9a-f]{12}\.js$')
+        self.assertEqual(list(manifest), ['js/app.js'])
+        self.assertTrue(os.path.isfile(os.path.join(
+            target, manifest['js/app.js'] + '.gz')))
+        # building again skips the built assets and gives the same names
+        self.assertEqual(build_assets(source, target), manifest)
+        self.assertEqual(load_manifest(target), manifest)
+        self.assertEqual(
+            rewrite_links('<script src="static/js/app.js">', manifest),
+            '<script src="assets/{}">'.format(manifest['js/app.js']))
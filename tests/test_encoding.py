@@ -0,0 +1,83 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Test cases for the fast JSON encoder
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import json
+import unittest
+from flask_restplus import marshal
+from service import app
+from service.encoding import ModelEncoder, stdlib_representation
+from service.models import Inventory
+from service.service import inventory_model
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestEncoding(unittest.TestCase):
+    """ Test Cases for ModelEncoder """
+
+    def setUp(self):
+        self.encoder = ModelEncoder(inventory_model, {'_id': 'id'})
+
+    def assert_same(self, data):
+        """ Asserts the encoder matches marshal() and json.dumps """
+        if isinstance(data, list):
+            expected = [marshal(inventory.serialize(), inventory_model)
+                        for inventory in data]
+        else:
+            expected = marshal(data.serialize(), inventory_model)
+        self.assertEqual(self.encoder.encode(data),
+                         (json.dumps(expected) + '\n').encode('ascii'))
+
+    def test_encode(self):
+        """ Encode Inventory like the marshalled responses """
+        inventory = Inventory(12, 5, 2, 'new', True)
+        inventory.id = 'abc'
+        self.assert_same(inventory)
+        self.assert_same([inventory, Inventory(1, 0, 0, 'used', False)])
+        self.assert_same([])
+        self.assertEqual(self.encoder.encode(inventory),
+                         b'{"_id": "abc", "product_id": 12, "quantity": 5, '
+                         b'"restock_level": 2, "condition": "new", '
+                         b'"available": true}\n')
+
+    def test_encode_unusual_values(self):
+        """ Encode escapes, missing values and other types """
+        inventory = Inventory(7, None, 3, 'néuf "\\\n', None)
+        inventory.id = '7:café'
+        self.assert_same(inventory)
+        # go through marshal(): True is 1 in an integer field, 2 is a
+        # string in a string field and "true" is true in a boolean one
+        inventory = Inventory(True, 4, 3, 2, 'true')
+        self.assert_same(inventory)
+        self.assertIn(b'"product_id": 1', self.encoder.encode(inventory))
+
+    def test_marshal_mask(self):
+        """ Marshal with a fields mask """
+        inventory = Inventory(12, 5, 2, 'new', True)
+        self.assertEqual(self.encoder.marshal([inventory], '{quantity}'),
+                         [{'quantity': 5}])
+
+    def test_stdlib_representation(self):
+        """ Only the plain json.dumps representation is reproduced """
+        self.assertTrue(stdlib_representation(app))
+        app.config['RESTPLUS_JSON'] = {'indent': 2}
+        self.addCleanup(app.config.pop, 'RESTPLUS_JSON')
+        self.assertFalse(stdlib_representation(app))
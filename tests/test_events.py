@@ -0,0 +1,137 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Test cases for the Server-Sent Events of the Inventory changes
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import json
+import unittest
+from unittest.mock import patch
+from service.events import ChangeHub, Subscription, make_event, stream
+from service.models import Inventory
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+def change(seq, quantity=5, rev='2-a', available=True, product_id=1):
+    """ Returns a change of the Inventory with id 'a' """
+    inventory = Inventory(product_id, quantity, 3, 'new', available)
+    inventory.id = 'a'
+    return {'seq': seq, 'id': 'a', 'rev': rev, 'deleted': False,
+            'inventory': inventory}
+
+def deletion(seq):
+    """ Returns the deletion of the Inventory with id 'a' """
+    return {'seq': seq, 'id': 'a', 'rev': '3-b', 'deleted': True,
+            'inventory': None}
+
+class TestEvents(unittest.TestCase):
+    """ Test Cases for the change hub and the event streams """
+
+    def setUp(self):
+        self.hub = ChangeHub()
+        # followed from sequence 7, without a feed thread
+        self.hub._thread = True
+        self.hub.since = ['7']
+
+    def test_event_types(self):
+        """ Tell creations, updates, disables and deletions apart """
+        self.assertEqual(make_event(change('1', rev='1-a'))['type'],
+                         'create')
+        self.assertEqual(make_event(change('2'))['type'], 'update')
+        previous = (1, False, True)
+        self.assertEqual(make_event(change('3', available=False),
+                                    previous)['type'], 'disable')
+        self.assertEqual(make_event(change('3', available=False))['type'],
+                         'update')
+        event = make_event(deletion('4'), previous)
+        self.assertEqual(event['type'], 'delete')
+        self.assertEqual(event['data'], {'_id': 'a', 'inventory': None})
+
+    def test_filters(self):
+        """ Send the changes in and out of the filters """
+        restock = Subscription(restock=True)
+        product = Subscription(product_id=2)
+        # quantity 1 < restock level 3
+        event = make_event(change('1', quantity=1))
+        self.assertTrue(restock.wants(event))
+        self.assertFalse(product.wants(make_event(change('1', rev='1-a'))))
+        # back above the restock level: sent once to remove it
+        event = make_event(change('2'), (1, True, True))
+        self.assertTrue(restock.wants(event))
+        event = make_event(change('3', quantity=6), (1, False, True))
+        self.assertFalse(restock.wants(event))
+        # moved to another product
+        event = make_event(change('4', product_id=2), (1, False, True))
+        self.assertTrue(product.wants(event))
+        self.assertFalse(product.wants(make_event(deletion('5'),
+                                                  (1, False, True))))
+
+    def test_remember(self):
+        """ The hub keeps a bounded state of the Inventory it has seen """
+        self.hub.state_size = 1
+        self.assertIsNone(self.hub._remember(change('1', rev='1-a')))
+        self.assertEqual(self.hub._remember(change('2', available=False)),
+                         (1, False, True))
+        self.assertEqual(self.hub._remember(deletion('3')),
+                         (1, False, False))
+        self.assertIsNone(self.hub._remember(deletion('4')))
+
+    def test_stream(self):
+        """ Stream the queued events with the position of the hub """
+        subscription = Subscription()
+        lines = stream(self.hub, subscription, heartbeat=0.01,
+                       duration=0.05)
+        self.assertEqual(next(lines), 'retry: 1000\nid: 7\n\n')
+        self.assertEqual(self.hub.subscribers(), 1)
+        self.hub.publish(make_event(change('8', rev='1-a')))
+        event = next(lines).splitlines()
+        self.assertEqual(event[:2], ['id: 8', 'event: create'])
+        self.assertEqual(json.loads(event[2][6:])['inventory']['quantity'],
+                         5)
+        self.assertEqual(next(lines), 'id: 7\n: keep-alive\n\n')
+        lines.close()
+        self.assertEqual(self.hub.subscribers(), 0)
+
+    def test_stream_overflow(self):
+        """ Reset the clients that fall behind """
+        subscription = Subscription(size=1)
+        lines = stream(self.hub, subscription)
+        next(lines)
+        self.hub.publish(make_event(change('8')))
+        self.hub.publish(make_event(change('9')))
+        self.assertEqual(self.hub.subscribers(), 0)
+        self.assertEqual(list(lines)[-1], 'event: reset\ndata: {}\n\n')
+
+    @patch.object(Inventory, 'changes')
+    def test_replay(self, changes):
+        """ Replay the changes after Last-Event-ID once """
+        changes.return_value = [change('8', rev='1-a')], '8', 0
+        subscription = Subscription()
+        lines = stream(self.hub, subscription, last_event_id='7',
+                       duration=0.05)
+        next(lines)
+        self.hub.publish(make_event(change('8', rev='1-a')))
+        body = list(lines)
+        changes.assert_called_once_with(['7'], 1000)
+        self.assertEqual(len([line for line in body
+                              if 'event: create' in line]), 1)
+        changes.return_value = [change('8')], '8', 1
+        lines = stream(self.hub, Subscription(), last_event_id='7',
+                       duration=0)
+        self.assertIn('event: reset\n', list(lines)[1])
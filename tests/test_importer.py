@@ -0,0 +1,92 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Test cases for the bulk importer
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import io
+import unittest
+from unittest.mock import patch
+from service.importer import Importer, decode_lines, parse_csv, \
+    parse_ndjson
+from service.models import Inventory
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+def rows(count, condition='new'):
+    """ Returns count NDJSON rows of different products """
+    return ''.join('{{"product_id": {}, "quantity": 1, "restock_level": 1, '
+                   '"condition": "{}", "available": true}}\n'
+                   .format(number, condition) for number in range(count))
+
+class TestImporter(unittest.TestCase):
+    """ Test Cases for Importer """
+
+    def setUp(self):
+        patcher = patch.object(Inventory, 'import_batch',
+                               side_effect=self.write)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.batches = []
+
+    def write(self, inventories, upsert):
+        """ Stands in for Inventory.import_batch """
+        self.batches.append([inventory.product_id
+                             for inventory in inventories])
+        return len(inventories), 0, [(0, 'conflict')] if upsert else []
+
+    def test_batches(self):
+        """ Write the rows in batches as they are read """
+        stream = io.BytesIO(rows(5).encode('utf8'))
+        summary = Importer(batch_size=2).run(
+            parse_ndjson(decode_lines(stream)))
+        self.assertEqual(self.batches, [[0, 1], [2, 3], [4]])
+        self.assertEqual(summary['created'], 5)
+        self.assertEqual(summary['errors'], [])
+
+    def test_repeated_natural_key(self):
+        """ Flush the batch when a row repeats one of its keys """
+        Inventory.natural_keys = True
+        self.addCleanup(setattr, Inventory, 'natural_keys', False)
+        body = rows(2) + rows(1) + rows(1, 'used')
+        summary = Importer(upsert=True).run(parse_ndjson(body.splitlines()))
+        self.assertEqual(self.batches, [[0, 1], [0, 0]])
+        self.assertEqual(summary['errors'], [
+            {'line': 1, 'error': 'conflict'},
+            {'line': 3, 'error': 'conflict'}])
+
+    def test_max_errors(self):
+        """ Keep the first errors only """
+        summary = Importer(max_errors=2).run(
+            parse_ndjson(['[]', 'null', '{', rows(1)]))
+        self.assertEqual(summary['failed'], 3)
+        self.assertEqual(len(summary['errors']), 2)
+        self.assertTrue(summary['errors_truncated'])
+        self.assertEqual(summary['created'], 1)
+
+    def test_parse_csv(self):
+        """ Convert the CSV columns """
+        lines = ['product_id,quantity,restock_level,condition,available,x',
+                 '1,2,3,new,Yes,ignored', '1,2,3,new,']
+        parsed = list(parse_csv(lines))
+        self.assertEqual(parsed[0], (2, {
+            'product_id': 1, 'quantity': 2, 'restock_level': 3,
+            'condition': 'new', 'available': True}))
+        self.assertEqual(parsed[1][0], 3)
+        self.assertIn('available must be', str(parsed[1][1]))
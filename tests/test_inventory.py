@@ -21,9 +21,42 @@ Test cases can be run with:
 
 import unittest
 import os
+import time
+import threading
+import shutil
+import tempfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import Mock, patch
+import requests
+from requests.exceptions import ConnectionError as RequestsConnectionError
 from werkzeug.exceptions import NotFound
-from service.models import Inventory, DataValidationError
+from service.models import Inventory, DataValidationError, \
+    DuplicateKeyError, MeteredReplay429Adapter, REPLICA_TIMEOUT
+from service.metrics import start_timings, stop_timings
+from service.tracing import Tracer
+from service.querylog import QueryLog
 from service import app
+from benchmarks.couchdb_standin import CouchDBStandin
+
+class SlowBodyHandler(BaseHTTPRequestHandler):
+    """ Sends the headers at once and a large body a chunk at a time """
+    chunks = 5
+    delay = 0.05
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Streams 5 chunks of 64 KiB, pausing before each """
+        chunk = b'x' * 65536
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(chunk) * self.chunks))
+        self.end_headers()
+        self.wfile.flush()
+        for _ in range(self.chunks):
+            time.sleep(self.delay)
+            self.wfile.write(chunk)
+            self.wfile.flush()
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """ Keeps the test output quiet """
 
 ######################################################################
 #  T E S T   C A S E S
@@ -428,3 +461,424 @@ class TestInventory(unittest.TestCase):
         self.assertEqual(res.condition, inventory.condition)
         self.assertEqual(res.available, inventory.available)
         self.assertEqual(res.id, inventory.id)
+
+    def test_find_many(self):
+        """ Find several Inventory by id in one request """
+        first = Inventory(product_id=1, quantity=100, restock_level=50,
+                          condition="new", available=False)
+        first.save()
+        second = Inventory(product_id=2, quantity=21, restock_level=20,
+                           condition="used", available=True)
+        second.save()
+        second.delete()
+        res = Inventory.find_many([second.id, 'nonexist', first.id])
+        self.assertEqual(list(res), [second.id, 'nonexist', first.id])
+        self.assertIsNone(res[second.id])
+        self.assertIsNone(res['nonexist'])
+        self.assertEqual(res[first.id].id, first.id)
+        self.assertEqual(res[first.id].quantity, 100)
+        self.assertEqual(Inventory.find_many([]), {})
+
+    @patch('service.models.QUERY_PAGE_SIZE', 2)
+    def test_slow_query_log(self):
+        """ Log slow queries and recommend indexes for them """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'slow.jsonl')
+        query_log = QueryLog(threshold_ms=0, path=path)
+        with patch.object(Inventory, 'query_log', query_log):
+            for product_id in range(3):
+                Inventory(product_id=product_id, quantity=10,
+                          restock_level=5, condition='new',
+                          available=True).save()
+            self.assertEqual(len(Inventory.find_by(condition='new')), 3)
+            self.assertEqual(Inventory.find_by(condition='used'), [])
+            self.assertEqual(len(Inventory.find_by_product_ids([1, 2])), 2)
+        entries = query_log.top()
+        self.assertEqual(len(entries), 2)
+        entry = [item for item in entries if 'condition' in item['shape']][0]
+        self.assertEqual(entry['count'], 2)
+        self.assertEqual(entry['results_returned'], 3)
+        self.assertGreaterEqual(entry['docs_examined'], 3)
+        self.assertEqual(entry['index']['name'], '_all_docs')
+
+        result = app.test_cli_runner().invoke(args=[
+            'recommend-indexes', '--dbname', 'test', '--log', path,
+            '--create'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("idx-condition: fields ['condition']", result.output)
+        self.assertIn('2 queries (2 slow)', result.output)
+        self.assertIn("idx-product_id: fields ['product_id']",
+                      result.output)
+        for name in ('idx-condition', 'idx-product_id'):
+            self.addCleanup(Inventory.database.delete_query_index,
+                            name, 'json', name)
+        query_log.reset()
+        with patch.object(Inventory, 'query_log', query_log):
+            Inventory.find_by(condition='new')
+        self.assertEqual(query_log.top()[0]['index']['name'],
+                         'idx-condition')
+
+    def test_find_by_product_ids(self):
+        """ Find the Inventory of several products """
+        for pid in range(1, 4):
+            Inventory(product_id=pid, quantity=10, restock_level=5,
+                      condition="new", available=True).save()
+        inventory = Inventory.find_by_product_ids([1, 3])
+        self.assertEqual(sorted(i.product_id for i in inventory), [1, 3])
+
+    def test_natural_keys(self):
+        """ Create, find and move Inventory keyed by product/condition """
+        Inventory.natural_keys = True
+        self.addCleanup(setattr, Inventory, 'natural_keys', False)
+        inventory = Inventory(product_id=1, quantity=10, restock_level=5,
+                              condition="new", available=True)
+        inventory.save()
+        self.assertEqual(inventory.id, '1:new')
+        Inventory(product_id=1, quantity=3, restock_level=5,
+                  condition="used", available=False).save()
+        Inventory(product_id=11, quantity=3, restock_level=5,
+                  condition="used", available=True).save()
+        with self.assertRaises(DuplicateKeyError):
+            Inventory(product_id=1, quantity=1, restock_level=1,
+                      condition="new", available=True).save()
+        self.assertEqual(len(Inventory.find_by_product_id(1)), 2)
+        found = Inventory.find_by_condition_with_pid('used', 1)
+        self.assertEqual([i.id for i in found], ['1:used'])
+        found = Inventory.find_by_availability_with_pid(True, 1)
+        self.assertEqual([i.id for i in found], ['1:new'])
+        # changing the condition moves the document
+        inventory.condition = 'open_box'
+        inventory.save()
+        self.assertEqual(inventory.id, '1:open_box')
+        self.assertIsNone(Inventory.find('1:new'))
+        inventory.condition = 'used'
+        with self.assertRaises(DuplicateKeyError):
+            inventory.save()
+        self.assertEqual(inventory.id, '1:open_box')
+
+    def test_migrate_natural_keys(self):
+        """ Migrate random ids to natural keys """
+        Inventory(product_id=1, quantity=10, restock_level=5,
+                  condition="new", available=False).save()
+        Inventory(product_id=1, quantity=4, restock_level=8,
+                  condition="new", available=True).save()
+        Inventory(product_id=2, quantity=3, restock_level=5,
+                  condition="used", available=False).save()
+        stats = Inventory.migrate_natural_keys()
+        self.assertEqual(stats['migrated'], 2)
+        self.assertEqual(len(stats['duplicates']), 1)
+        self.assertEqual(len(Inventory.all()), 3)
+        stats = Inventory.migrate_natural_keys(merge=True)
+        self.assertEqual(stats['merged'], 1)
+        self.assertEqual(stats['unchanged'], 2)
+        inventory = Inventory.all()
+        self.assertEqual(sorted(i.id for i in inventory),
+                         ['1:new', '2:used'])
+        merged = Inventory.find('1:new')
+        self.assertEqual(merged.quantity, 14)
+        self.assertEqual(merged.restock_level, 8)
+        self.assertEqual(merged.available, True)
+
+    def test_partitioned_database(self):
+        """ Create and find Inventory in a database partitioned by product """
+        Inventory.init_db("test-partitioned", partitioned=True)
+        Inventory.remove_all()
+        self.assertTrue(Inventory.partitioned)
+        inventory = Inventory(product_id=1, quantity=10, restock_level=5,
+                              condition="new", available=True)
+        inventory.save()
+        self.assertTrue(inventory.id.startswith('1:'))
+        Inventory(product_id=1, quantity=3, restock_level=5,
+                  condition="used", available=False).save()
+        Inventory(product_id=2, quantity=3, restock_level=5,
+                  condition="used", available=True).save()
+        self.assertEqual(len(Inventory.find_by_product_id(1)), 2)
+        found = Inventory.find_by_condition_with_pid('used', 1)
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0].quantity, 3)
+        found = Inventory.find_by_availability_with_pid(True, 1)
+        self.assertEqual([i.id for i in found], [inventory.id])
+        # changing the product moves the document to its partition
+        inventory.product_id = 2
+        inventory.save()
+        self.assertTrue(inventory.id.startswith('2:'))
+        self.assertEqual(len(Inventory.find_by_product_id(1)), 1)
+        self.assertEqual(len(Inventory.find_by_product_id(2)), 2)
+        self.assertEqual(len(Inventory.all()), 3)
+
+    def test_migrate_partitioned(self):
+        """ Copy an unpartitioned database into a partitioned one """
+        if "test-partitioned-copy" in Inventory.client.all_dbs():
+            Inventory.client.delete_database("test-partitioned-copy")
+        Inventory(product_id=1, quantity=10, restock_level=5,
+                  condition="new", available=True).save()
+        Inventory(product_id=2, quantity=3, restock_level=5,
+                  condition="used", available=False).save()
+        self.assertFalse(Inventory.partitioned)
+        self.assertEqual(Inventory.migrate_partitioned(
+            "test-partitioned-copy"), 2)
+        self.assertEqual(Inventory.migrate_partitioned(
+            "test-partitioned-copy"), 0)
+        Inventory.init_db("test-partitioned-copy")
+        self.assertTrue(Inventory.partitioned)
+        found = Inventory.find_by_product_id(2)
+        self.assertEqual(len(found), 1)
+        self.assertTrue(found[0].id.startswith('2:'))
+
+    def test_sharded_databases(self):
+        """ Spread Inventory over several databases by product_id """
+        Inventory.init_db("test-shard", shards=3)
+        self.addCleanup(Inventory.init_db, "test")
+        Inventory.remove_all()
+        self.assertEqual(len(Inventory.shards), 3)
+        for pid in range(1, 7):
+            Inventory(product_id=pid, quantity=pid, restock_level=4,
+                      condition="new", available=pid % 2 == 0).save()
+        inventory = Inventory(product_id=1, quantity=10, restock_level=5,
+                              condition="used", available=True)
+        inventory.save()
+        self.assertTrue(inventory.id.startswith('1:'))
+        home = Inventory.database_for(1)
+        self.assertIn(inventory.id, home)
+        others = [shard for shard in Inventory.shards if shard is not home]
+        self.assertFalse(any(inventory.id in shard for shard in others))
+        # single-shard and scatter-gather reads
+        self.assertEqual(len(Inventory.find_by_product_id(1)), 2)
+        self.assertEqual(len(Inventory.find_by_condition_with_pid('used', 1)),
+                         1)
+        self.assertEqual(len(Inventory.find_by_condition('new')), 6)
+        self.assertEqual(len(Inventory.find_by_restock(True)), 3)
+        every = Inventory.all()
+        self.assertEqual(len(every), 7)
+        self.assertEqual([i.id for i in every], sorted(i.id for i in every))
+        self.assertEqual(Inventory.find(inventory.id).quantity, 10)
+        self.assertIsNone(Inventory.find('not-sharded'))
+        found = Inventory.find_many([inventory.id, 'not-sharded'])
+        self.assertEqual(found[inventory.id].quantity, 10)
+        self.assertIsNone(found['not-sharded'])
+        # moving to another product moves to its shard
+        inventory.product_id = 2
+        inventory.save()
+        self.assertIn(inventory.id, Inventory.database_for(2))
+        self.assertEqual(len(Inventory.find_by_product_id(1)), 1)
+        inventory.delete()
+        self.assertEqual(len(Inventory.all()), 6)
+
+    def test_shards_sharing_dbname(self):
+        """ Tell apart shards with the same database name on two hosts """
+        other = CouchDBStandin(('127.0.0.1', 0))
+        other.start()
+        self.addCleanup(other.server_close)
+        self.addCleanup(other.shutdown)
+        Inventory.init_db("test-same", shards=[
+            {'dbname': 'test-same',
+             'replica_url': Inventory.client.server_url},
+            {'url': other.url, 'dbname': 'test-same',
+             'replica_url': other.url}])
+        self.addCleanup(Inventory.init_db, "test")
+        Inventory.remove_all()
+        first, second = Inventory.shards
+        self.assertEqual(first.database_name, second.database_name)
+        self.assertIsNot(Inventory.replica_of(first),
+                         Inventory.replica_of(second))
+        created, updated, errors = Inventory.import_batch(
+            [Inventory(pid, pid, 5, 'new', True) for pid in range(1, 9)])
+        self.assertEqual((created, updated, errors), (8, 0, []))
+        ids = [inventory.id for inventory in Inventory.all()]
+        self.assertEqual(len(ids), 8)
+        # both shards hold some of them
+        self.assertTrue(any(key in first for key in ids))
+        self.assertTrue(any(key in second for key in ids))
+        found = Inventory.find_many(ids)
+        self.assertTrue(all(found[key] is not None for key in ids))
+
+    def test_read_replica(self):
+        """ Read from a replica, fail over to and pin the primary """
+        Inventory.init_db("test", replica_url=Inventory.client.server_url)
+        self.addCleanup(Inventory.init_db, "test")
+        self.addCleanup(Inventory.unpin_primary)
+        replica = Inventory.replica_of(Inventory.database)
+        self.assertIsNotNone(replica)
+        self.assertIsNot(replica, Inventory.database)
+        # a replica that hangs times out and fails over too
+        self.assertEqual(replica.r_session._timeout, REPLICA_TIMEOUT)
+        Inventory(product_id=1, quantity=10, restock_level=5,
+                  condition="new", available=True).save()
+        # a write pins this thread's reads to the primary
+        self.assertGreater(Inventory.primary_until(), time.time())
+        with patch.object(replica, 'all_docs') as replica_read:
+            self.assertEqual(len(Inventory.all()), 1)
+            replica_read.assert_not_called()
+        # exports read the primary, which their update sequence comes from
+        Inventory.unpin_primary()
+        with patch.object(replica, 'all_docs') as replica_read:
+            self.assertEqual(len(list(Inventory.export_docs())), 1)
+            replica_read.assert_not_called()
+        # unpinned reads go to the replica, and fail over when it is down
+        Inventory.unpin_primary()
+        with patch.object(replica, 'all_docs',
+                          side_effect=RequestsConnectionError('down')) \
+                as replica_read:
+            self.assertEqual(len(Inventory.all()), 1)
+            self.assertEqual(replica_read.call_count, 1)
+            self.assertGreater(
+                Inventory.replica_down_until[id(Inventory.database)],
+                time.time())
+            self.assertEqual(len(Inventory.find_by_condition('new')), 1)
+            self.assertEqual(replica_read.call_count, 1)
+        Inventory.replica_down_until.clear()
+        self.assertEqual(len(Inventory.all()), 1)
+        # the replica reads see the writes once the pin expires
+        inventory = Inventory.find_by_product_id(1)[0]
+        inventory.quantity = 99
+        inventory.update()
+        Inventory.unpin_primary()
+        self.assertEqual(Inventory.find(inventory.id).quantity, 99)
+        self.assertEqual(Inventory.all()[0].quantity, 99)
+
+    def test_restock_crossing(self):
+        """ Report the writes that cross the restock level """
+        crossing = Inventory.restock_crossing
+        self.assertEqual(crossing(None, {'quantity': 1,
+                                         'restock_level': 5}), 'below')
+        self.assertIsNone(crossing(None, {'quantity': 5,
+                                          'restock_level': 5}))
+        self.assertEqual(crossing({'quantity': 1, 'restock_level': 5},
+                                  {'quantity': 1, 'restock_level': 1}),
+                         'above')
+        self.assertIsNone(crossing({'quantity': 1, 'restock_level': 5},
+                                   {'quantity': 2, 'restock_level': 5}))
+        self.assertIsNone(crossing({}, {'quantity': 1, 'restock_level': 5}))
+        events = []
+        self.addCleanup(setattr, Inventory, 'restock_listeners', [])
+        Inventory.restock_listeners = [events.append]
+        inventory = Inventory(product_id=1, quantity=10, restock_level=5,
+                              condition="new", available=True)
+        inventory.create()
+        self.assertEqual(events, [])
+        inventory.quantity = 4
+        inventory.update()
+        inventory.quantity = 3
+        inventory.update()
+        inventory.restock_level = 3
+        inventory.update()
+        self.assertEqual([(event['crossing'], event['quantity'])
+                          for event in events], [('below', 4), ('above', 3)])
+        self.assertEqual(events[0]['inventory_id'], inventory.id)
+        self.assertNotEqual(events[0]['id'], events[1]['id'])
+        # upserts compare with the stored documents
+        Inventory.natural_keys = True
+        self.addCleanup(setattr, Inventory, 'natural_keys', False)
+        Inventory.import_batch([Inventory(2, 1, 5, 'new', True)], True)
+        Inventory.import_batch([Inventory(2, 9, 5, 'new', True)], True)
+        self.assertEqual([event['crossing'] for event in events[2:]],
+                         ['below', 'above'])
+        # a failing listener doesn't fail the write
+        Inventory.restock_listeners = [Mock(side_effect=ValueError)]
+        inventory.quantity = 0
+        inventory.update()
+        self.assertEqual(Inventory.find(inventory.id).quantity, 0)
+
+    def test_coalesced_reads(self):
+        """ Concurrent identical finds share one database read """
+        inventory = Inventory(product_id=1, quantity=10, restock_level=5,
+                              condition="new", available=True)
+        inventory.create()
+        Inventory.unpin_primary()
+        release = threading.Event()
+        read = Inventory.read
+
+        def slow_read(*args):
+            release.wait(5)
+            return read(*args)
+        results = []
+        with patch.object(Inventory, 'read', side_effect=slow_read) \
+                as reads:
+            threads = [threading.Thread(target=lambda: results.append(
+                Inventory.find(inventory.id))) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+            self.assertEqual(reads.call_count, 1)
+        self.assertEqual([result.quantity for result in results],
+                         [10, 10, 10])
+        self.assertEqual(len({id(result) for result in results}), 3)
+
+    def test_negative_cache(self):
+        """ Answer the lookups of missing ids from the negative cache """
+        Inventory.natural_keys = True
+        self.addCleanup(setattr, Inventory, 'natural_keys', False)
+        with patch.object(Inventory, 'read', side_effect=Inventory.read) \
+                as reads:
+            self.assertIsNone(Inventory.find('1:new'))
+            self.assertIsNone(Inventory.find('1:new'))
+            self.assertEqual(reads.call_count, 1)
+            # creating the id invalidates it
+            Inventory(product_id=1, quantity=10, restock_level=5,
+                      condition="new", available=True).create()
+            self.assertEqual(Inventory.find('1:new').quantity, 10)
+            # and so does the changes feed
+            self.assertIsNone(Inventory.find('2:new'))
+            since = Inventory.update_seqs()
+            Inventory.database.create_document({
+                '_id': '2:new', 'product_id': 2, 'quantity': 3,
+                'restock_level': 1, 'condition': 'new', 'available': True})
+            self.assertIsNone(Inventory.find('2:new'))
+            Inventory.changes(since)
+            self.assertEqual(Inventory.find('2:new').quantity, 3)
+
+    def test_export_deleted_cursor(self):
+        """ Page the export past documents deleted under it """
+        Inventory.natural_keys = True
+        self.addCleanup(setattr, Inventory, 'natural_keys', False)
+        for pid in range(1, 6):
+            Inventory(product_id=pid, quantity=pid, restock_level=1,
+                      condition="new", available=True).create()
+        docs = Inventory.export_docs(page_size=2)
+        exported = [next(docs)['_id'], next(docs)['_id']]
+        # the last document of the page is gone when the next one is read
+        Inventory.find('2:new').delete()
+        exported.extend(doc['_id'] for doc in docs)
+        self.assertEqual(exported, ['1:new', '2:new', '3:new', '4:new',
+                                    '5:new'])
+        # and so is the document an export resumes after
+        Inventory.find('3:new').delete()
+        self.assertEqual([doc['_id'] for doc in
+                          Inventory.export_docs(after='3:new', page_size=2)],
+                         ['4:new', '5:new'])
+
+    def test_db_timing_includes_body(self):
+        """ Time a CouchDB call until its whole body is read """
+        server = HTTPServer(('127.0.0.1', 0), SlowBodyHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        session = requests.Session()
+        self.addCleanup(session.close)
+        url = 'http://127.0.0.1:{}'.format(server.server_port)
+        session.mount(url, MeteredReplay429Adapter(retries=0))
+        exporter = Mock()
+        tracer = Tracer(exporter)
+        root = tracer.start_trace('GET /inventory')
+        start_timings()
+        with root:
+            started = time.perf_counter()
+            response = session.get(url + '/big')
+            elapsed = time.perf_counter() - started
+        timings = stop_timings()
+        tracer.finish(root)
+        self.assertEqual(len(response.content), 5 * 65536)
+        body = SlowBodyHandler.chunks * SlowBodyHandler.delay
+        self.assertGreaterEqual(timings.durations['db'], body)
+        self.assertLessEqual(timings.durations['db'], elapsed)
+        call = exporter.export.call_args[0][0][0]
+        self.assertEqual(call.name, 'couchdb GET')
+        self.assertGreaterEqual(call.duration, body)
+        # a streamed body is the caller's to read
+        start_timings()
+        with session.get(url + '/big', stream=True) as response:
+            self.assertLess(stop_timings().durations['db'], body)
@@ -0,0 +1,134 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Test cases for structured logging
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import io
+import json
+import logging
+import queue
+import sys
+import unittest
+from unittest.mock import MagicMock
+from service import logs
+from service.logs import JsonFormatter, SamplingFilter, LazyQueueHandler, \
+    configure_json_logging, parse_rates, LOG_DROPPED
+from service.tracing import Tracer
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+def make_record(name='flask.app', level=logging.INFO, msg='hello %s',
+                args=('world',), **extra):
+    """ Returns a LogRecord as logger name would make it """
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+class TestLogs(unittest.TestCase):
+    """ Test Cases for the JSON logging """
+
+    def test_parse_rates(self):
+        """ Parse per logger rates """
+        self.assertEqual(parse_rates('flask.app=0.1, werkzeug=0'),
+                         {'flask.app': 0.1, 'werkzeug': 0.0})
+        self.assertEqual(parse_rates(None), {})
+        self.assertEqual(parse_rates('service=5', int), {'service': 5})
+
+    def test_json_formatter(self):
+        """ Format records as JSON objects """
+        record = make_record(product_id=7)
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry['message'], 'hello world')
+        self.assertEqual(entry['level'], 'INFO')
+        self.assertEqual(entry['logger'], 'flask.app')
+        self.assertEqual(entry['product_id'], 7)
+        self.assertTrue(entry['time'].endswith('Z'))
+        self.assertNotIn('exception', entry)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = make_record(level=logging.ERROR)
+            record.exc_info = sys.exc_info()
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertIn('ValueError: boom', entry['exception'])
+
+    def test_sampling(self):
+        """ Sample the INFO records of a logger and its children """
+        log_filter = SamplingFilter({'flask': 0.0, 'flask.app': 1.0,
+                                     'werkzeug': 0.0})
+        self.assertTrue(log_filter.filter(make_record('flask.app')))
+        self.assertFalse(log_filter.filter(make_record('flask.other')))
+        before = LOG_DROPPED.value(logger='werkzeug', reason='sampled')
+        self.assertFalse(log_filter.filter(make_record('werkzeug')))
+        self.assertEqual(LOG_DROPPED.value(logger='werkzeug',
+                                           reason='sampled'), before + 1)
+        self.assertTrue(log_filter.filter(make_record('service')))
+        # warnings are never sampled
+        self.assertTrue(log_filter.filter(make_record(
+            'werkzeug', logging.WARNING)))
+
+    def test_rate_limit(self):
+        """ Rate limit the INFO records of a logger """
+        clock = MagicMock(return_value=100.0)
+        log_filter = SamplingFilter(rate_limits={'flask.app': 2},
+                                    clock=clock)
+        kept = [log_filter.filter(make_record()) for _ in range(4)]
+        self.assertEqual(kept, [True, True, False, False])
+        self.assertTrue(log_filter.filter(make_record('service')))
+        clock.return_value = 100.5
+        self.assertTrue(log_filter.filter(make_record()))
+        self.assertFalse(log_filter.filter(make_record()))
+
+    def test_lazy_queue_handler(self):
+        """ Queue records unformatted and drop them when full """
+        records = queue.Queue(1)
+        handler = LazyQueueHandler(records)
+        tracer = Tracer(MagicMock())
+        root = tracer.start_trace('GET /inventory')
+        with root:
+            handler.handle(make_record())
+        record = records.get_nowait()
+        self.assertEqual(record.args, ('world',))
+        self.assertEqual(record.trace_id, root.trace.trace_id)
+        handler.handle(make_record())
+        before = LOG_DROPPED.value(logger='flask.app', reason='queue_full')
+        handler.handle(make_record())
+        self.assertEqual(LOG_DROPPED.value(logger='flask.app',
+                                           reason='queue_full'), before + 1)
+
+    def test_configure_json_logging(self):
+        """ Write JSON lines from the listener thread """
+        stream = io.StringIO()
+        logger = logging.getLogger('test_logs')
+        handler = configure_json_logging(
+            [logger], logging.INFO, stream,
+            sample_rates={'test_logs.hot': 0.0})
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(logs.stop_listener)
+        logger.propagate = False
+        logger.info('created %s', 'inventory', extra={'product_id': 1})
+        logging.getLogger('test_logs.hot').info('not written')
+        logger.debug('below the level')
+        logs.stop_listener()
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        entry = json.loads(lines[0])
+        self.assertEqual(entry['message'], 'created inventory')
+        self.assertEqual(entry['product_id'], 1)
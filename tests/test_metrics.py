@@ -0,0 +1,112 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the metrics registry
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import logging
+import unittest
+from unittest.mock import MagicMock
+from service.metrics import Registry, Counter, Gauge, Histogram, \
+    RetryLogger, DB_RETRIES, phase, start_timings, stop_timings
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for the metrics registry """
+
+    def setUp(self):
+        """ Runs before each test """
+        self.registry = Registry()
+
+    def test_counter(self):
+        """ Count by label set """
+        counter = Counter('hits_total', 'Hits', labels=('path',),
+                          registry=self.registry)
+        counter.inc(path='/a')
+        counter.inc(2, path='/a')
+        counter.inc(path='/b"')
+        self.assertEqual(counter.value(path='/a'), 3)
+        text = self.registry.render()
+        self.assertIn('# TYPE hits_total counter', text)
+        self.assertIn('hits_total{path="/a"} 3', text)
+        self.assertIn('hits_total{path="/b\\""} 1', text)
+
+    def test_gauge(self):
+        """ Move a gauge up and down """
+        gauge = Gauge('in_flight', 'In flight', registry=self.registry)
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(gauge.value(), 1)
+        self.assertIn('in_flight 1\n', self.registry.render())
+        gauge.set(0.5)
+        self.assertIn('in_flight 0.5\n', self.registry.render())
+
+    def test_histogram(self):
+        """ Observe values into cumulative buckets """
+        histogram = Histogram('latency_seconds', 'Latency', labels=('op',),
+                              buckets=(0.1, 1), registry=self.registry)
+        histogram.observe(0.05, op='find')
+        histogram.observe(0.5, op='find')
+        histogram.observe(5, op='find')
+        self.assertEqual(histogram.value(op='find'), (3, 5.55))
+        text = self.registry.render()
+        self.assertIn('latency_seconds_bucket{op="find",le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{op="find",le="1"} 2', text)
+        self.assertIn('latency_seconds_bucket{op="find",le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count{op="find"} 3', text)
+
+        @histogram.time(op='timed')
+        def timed():
+            return 'done'
+        self.assertEqual(timed(), 'done')
+        with histogram.time(op='timed'):
+            pass
+        self.assertEqual(histogram.value(op='timed')[0], 2)
+        self.registry.reset()
+        self.assertEqual(histogram.value(op='find'), (0, 0.0))
+
+    def test_retry_logger(self):
+        """ Count the retries logged by the retry decorators """
+        logger = MagicMock(spec=logging.Logger)
+        error = MagicMock()
+        error.response.status_code = 503
+        before = DB_RETRIES.value(status=503)
+        RetryLogger(logger).warning('%s, retrying in %s seconds...', error, 1)
+        self.assertEqual(DB_RETRIES.value(status=503), before + 1)
+        logger.warning.assert_called_once()
+
+    def test_phase_timings(self):
+        """ Collect per-request phase timings for Server-Timing """
+        @phase('db')
+        def query():
+            return 'rows'
+        self.assertEqual(query(), 'rows')
+        self.assertIsNone(stop_timings())
+        start_timings()
+        query()
+        query()
+        with phase('marshal'):
+            pass
+        timings = stop_timings()
+        self.assertEqual(timings.counts, {'db': 2, 'marshal': 1})
+        header = timings.header()
+        self.assertRegex(header, r'^db;dur=[0-9.]+, marshal;dur=[0-9.]+, '
+                                 r'db-calls;desc="2", total;dur=[0-9.]+$')
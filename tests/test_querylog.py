@@ -0,0 +1,139 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Test cases for the slow query log and index advisor
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from service.querylog import QueryLog, shape_key, index_fields, \
+    recommend_indexes
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestQueryLog(unittest.TestCase):
+    """ Test Cases for the slow query log """
+
+    def test_selector_shape(self):
+        """ Group selectors by their fields and operators """
+        self.assertEqual(shape_key({'product_id': 1, 'condition': 'new'}),
+                         shape_key({'condition': 'used', 'product_id': 7}))
+        self.assertEqual(shape_key({'product_id': {'$in': [1, 2]}}),
+                         '{"product_id": {"$in": "?"}}')
+        self.assertNotEqual(shape_key({'product_id': 1}),
+                            shape_key({'product_id': {'$gt': 1}}))
+
+    def test_index_fields(self):
+        """ Order index fields as equality, $in, then range """
+        self.assertEqual(index_fields({
+            'quantity': {'$lt': 5}, 'product_id': {'$in': [1]},
+            'condition': 'new', '_id': {'$gt': None}}),
+                         ['condition', 'product_id', 'quantity'])
+        self.assertEqual(index_fields({'$and': [{'available': True},
+                                                {'address': {'city': 'x'}}],
+                                       '$or': [{'condition': 'new'}]}),
+                         ['available', 'address.city'])
+        self.assertEqual(index_fields({}), [])
+
+    def test_record(self):
+        """ Count every query, log the slow ones with their index """
+        logger = MagicMock(spec=logging.Logger)
+        explain = MagicMock(return_value={'name': '_all_docs'})
+        query_log = QueryLog(threshold_ms=50, logger=logger)
+        stats = {'total_docs_examined': 10, 'results_returned': 1}
+        query_log.record({'condition': 'new'}, 0.01, stats, explain=explain)
+        logger.warning.assert_not_called()
+        query_log.record({'condition': 'used'}, 0.2, stats, explain=explain)
+        query_log.record({'condition': 'new'}, 0.3, stats, explain=explain)
+        self.assertEqual(logger.warning.call_count, 2)
+        explain.assert_called_once()
+        entry, = query_log.top()
+        self.assertEqual((entry['count'], entry['slow']), (3, 2))
+        self.assertEqual(entry['docs_examined'], 30)
+        self.assertAlmostEqual(entry['seconds'], 0.51)
+        self.assertEqual(entry['index'], {'name': '_all_docs'})
+
+    def test_recommend_indexes(self):
+        """ Recommend indexes for the queries that scan """
+        query_log = QueryLog(threshold_ms=0)
+        query_log.record({'condition': 'new'}, 0.5,
+                         {'total_docs_examined': 1000,
+                          'results_returned': 10},
+                         explain=lambda: {'name': '_all_docs'})
+        query_log.record({'product_id': 1}, 0.1,
+                         {'total_docs_examined': 5, 'results_returned': 5},
+                         explain=lambda: {'name': 'idx-product_id'})
+        query_log.record({'available': True, 'restock_level': {'$lt': 5}},
+                         0.2, {'total_docs_examined': 100,
+                               'results_returned': 1},
+                         explain=lambda: {'name': 'idx-available'})
+        recommended = recommend_indexes(query_log.top())
+        self.assertEqual([index['name'] for index in recommended],
+                         ['idx-condition', 'idx-available-restock_level'])
+        self.assertEqual(recommended[0]['docs_examined'], 1000)
+        existing = [{'name': 'c', 'def': {'fields': [{'condition': 'asc'}]}}]
+        recommended = recommend_indexes(query_log.top(), existing, limit=1)
+        self.assertEqual([index['fields'] for index in recommended],
+                         [['available', 'restock_level']])
+
+    def test_explain_ttl(self):
+        """ Explain a shape again once its index is stale """
+        explain = MagicMock(return_value={'name': '_all_docs'})
+        query_log = QueryLog(threshold_ms=0)
+        query_log.record({'condition': 'new'}, 0.1, explain=explain)
+        query_log.record({'condition': 'new'}, 0.1, explain=explain)
+        self.assertEqual(explain.call_count, 1)
+        query_log.forget_indexes()
+        explain.return_value = {'name': 'idx-condition'}
+        query_log.record({'condition': 'new'}, 0.1, explain=explain)
+        self.assertEqual(explain.call_count, 2)
+        self.assertEqual(query_log.top()[0]['index'],
+                         {'name': 'idx-condition'})
+        query_log = QueryLog(threshold_ms=0, explain_ttl=0)
+        query_log.record({'condition': 'new'}, 0.1, explain=explain)
+        query_log.record({'condition': 'new'}, 0.1, explain=explain)
+        self.assertEqual(explain.call_count, 4)
+
+    def test_load_frequency(self):
+        """ Rank the logged shapes by the time of all their queries """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'slow.jsonl')
+        scan = {'total_docs_examined': 100, 'results_returned': 1}
+        # two processes append to the same log
+        first = QueryLog(threshold_ms=150, path=path)
+        second = QueryLog(threshold_ms=150, path=path)
+        for _ in range(20):
+            first.record({'condition': 'new'}, 0.04, scan)
+        first.record({'condition': 'new'}, 0.2, scan)
+        second.record({'condition': 'new'}, 0.2, scan)
+        second.record({'product_id': 1}, 0.5, scan)
+        log = QueryLog.load(path)
+        entry = [item for item in log.top() if 'condition' in item['shape']][0]
+        self.assertEqual((entry['count'], entry['slow']), (22, 2))
+        self.assertAlmostEqual(entry['seconds'], 1.2)
+        recommended = recommend_indexes(log.top())
+        self.assertEqual([index['name'] for index in recommended],
+                         ['idx-condition', 'idx-product_id'])
+        self.assertEqual((recommended[0]['queries'], recommended[0]['slow']),
+                         (22, 2))
@@ -24,11 +24,30 @@ import unittest
 import os
 import logging
 import json
+import gzip
+import shutil
+import signal
+import tempfile
+import threading
+import time
 from unittest.mock import patch
+from urllib.request import Request, urlopen
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
 from flask_api import status    # HTTP Status Codes
-from service.models import Inventory, DataValidationError
+from service.models import Inventory, DataValidationError, \
+    READ_YOUR_WRITES
 from service.service import app, initialize_logging
+from service.profiling import ProfilerMiddleware
+from service.memprofile import MemoryProfiler
+from service.compression import build_assets
+from service.events import ChangeHub
+from service.webhooks import WebhookDispatcher
+from service.tracing import JsonLinesExporter
+from service import service
 from inventory_factory import InventoryFactory
+from test_webhooks import WebhookReceiver
+from benchmarks.couchdb_standin import CouchDBStandin
 
 ######################################################################
 #  T E S T   C A S E S
@@ -52,6 +71,10 @@ class TestInventoryServer(unittest.TestCase):
         Inventory.init_db("test")
         Inventory.remove_all()
         self.app = app.test_client()
+        # the tests that read twice expect the handler to run twice
+        patcher = patch.object(service.collection_cache, 'max_bytes', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     # def tearDown(self):
     #     DB.session.remove()
@@ -84,6 +107,250 @@ class TestInventoryServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertIn(b'Healthy', resp.data)
 
+    def test_metrics(self):
+        """ Expose request and database metrics """
+        self._create_inventories(1)
+        resp = self.app.get('/inventory')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('text/plain', resp.headers['Content-Type'])
+        text = resp.get_data(as_text=True)
+        self.assertIn('inventory_http_request_duration_seconds_count'
+                      '{endpoint="inventory_collection",method="GET"}', text)
+        self.assertIn('inventory_http_responses_total{endpoint='
+                      '"inventory_collection",method="POST",status="201"}',
+                      text)
+        self.assertIn('inventory_http_requests_in_flight 1', text)
+        self.assertIn('inventory_db_operation_duration_seconds_count'
+                      '{operation="create"}', text)
+        self.assertIn('inventory_db_operation_duration_seconds_count'
+                      '{operation="all"}', text)
+
+    def test_server_timing(self):
+        """ Break the request time down in a Server-Timing header """
+        self._create_inventories(2)
+        resp = self.app.get('/inventory')
+        self.assertNotIn('Server-Timing', resp.headers)
+        app.config['SERVER_TIMING'] = True
+        self.addCleanup(app.config.update, SERVER_TIMING=False)
+        resp = self.app.get('/inventory')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        timing = resp.headers['Server-Timing']
+        for entry in ('db;dur=', 'deserialize;dur=', 'marshal;dur=',
+                      'total;dur='):
+            self.assertIn(entry, timing)
+        self.assertRegex(timing, r'db-calls;desc="[1-9]\d*"')
+
+    def test_trace_request(self):
+        """ Export a trace of a request and its CouchDB calls """
+        self._create_inventories(2)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'traces.jsonl')
+        trace_id = '4bf92f3577b34da6a3ce929d0e0e4736'
+        with patch.object(service.tracer, 'exporter',
+                          JsonLinesExporter(path)):
+            resp = self.app.get('/inventory', headers={
+                'traceparent': '00-{}-00f067aa0ba902b7-00'.format(trace_id)})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertFalse(os.path.exists(path))
+            resp = self.app.get('/inventory', headers={
+                'traceparent': '00-{}-00f067aa0ba902b7-01'.format(trace_id)})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        with open(path) as stream:
+            spans = [json.loads(line) for line in stream]
+        self.assertEqual({span['trace_id'] for span in spans}, {trace_id})
+        root = [span for span in spans if span['name'] == 'GET /inventory']
+        self.assertEqual(len(root), 1)
+        self.assertEqual(root[0]['parent_id'], '00f067aa0ba902b7')
+        self.assertEqual(root[0]['attributes']['http.status_code'], 200)
+        names = [span['name'] for span in spans
+                 if span['parent_id'] == root[0]['span_id']]
+        self.assertIn('couchdb GET', names)
+        self.assertEqual(names.count('deserialize'), 2)
+        self.assertIn('marshal', names)
+
+    def test_compression(self):
+        """ Compress large responses for the clients that accept it """
+        self._create_inventories(20)
+        plain = self.app.get('/inventory')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+        resp = self.app.get('/inventory',
+                            headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertLess(len(resp.data), len(plain.data))
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+        resp = self.app.get('/inventory',
+                            headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        # small responses are sent as they are
+        resp = self.app.get('/inventory/missing',
+                            headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertNotIn('Vary', resp.headers)
+        app.config['COMPRESS'] = False
+        self.addCleanup(app.config.update, COMPRESS=True)
+        resp = self.app.get('/inventory', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_static_assets(self):
+        """ Serve the built assets precompressed with long cache headers """
+        resp = self.app.get('/')
+        self.assertIn(b'static/js/rest_api.js', resp.data)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        manifest = build_assets(app.static_folder, directory)
+        self.addCleanup(app.config.update, ASSETS_DIR=app.config['ASSETS_DIR'])
+        app.config['ASSETS_DIR'] = directory
+        resp = self.app.get('/')
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        hashed = manifest['js/rest_api.js']
+        self.assertIn('assets/{}'.format(hashed).encode(), resp.data)
+        self.assertNotIn(b'static/js/', resp.data)
+
+        with open(os.path.join(app.static_folder, 'js', 'rest_api.js'),
+                  'rb') as stream:
+            source = stream.read()
+        resp = self.app.get('/assets/' + hashed,
+                            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertIn('javascript', resp.content_type)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertEqual(gzip.decompress(resp.data), source)
+        resp.close()
+        resp = self.app.get('/assets/' + hashed)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, source)
+        resp.close()
+        resp = self.app.get('/assets/js/missing.js')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_fast_json(self):
+        """ Encode responses byte for byte like the marshalled ones """
+        inventory = self._create_inventories(3)[0]
+        requests = [
+            ('get', '/inventory', {}),
+            ('get', '/inventory?restock=true', {}),
+            ('get', '/inventory?condition=bogus', {}),
+            ('get', '/inventory/{}'.format(inventory.id), {}),
+            ('get', '/inventory/missing', {}),
+            ('get', '/inventory', {'headers': {'X-Fields': 'quantity'}}),
+            ('put', '/inventory/{}'.format(inventory.id),
+             {'json': inventory.serialize()}),
+            ('post', '/inventory', {'json': InventoryFactory().serialize()})]
+        self.addCleanup(app.config.update, FAST_JSON=True)
+        for method, url, kwargs in requests:
+            responses = []
+            for fast in (False, True):
+                app.config['FAST_JSON'] = fast
+                resp = getattr(self.app, method)(url, **kwargs)
+                data = resp.data
+                if method == 'post':    # a new id every time
+                    data = data.replace(resp.get_json()['_id'].encode(),
+                                        b'new-id')
+                responses.append((resp.status_code, resp.content_type,
+                                  'Location' in resp.headers, data))
+            self.assertEqual(responses[0], responses[1], url)
+        resp = self.app.get('/inventory', headers={'X-Fields': 'quantity'})
+        self.assertEqual(set(resp.get_json()[0]), {'quantity'})
+
+    def test_memory_profiling(self):
+        """ Report memory per endpoint and tracemalloc snapshots """
+        resp = self.app.get('/debug/memory')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        app.config.update(PROFILE_SECRET='s3cr3t', MEMORY_PROFILE=True)
+        self.addCleanup(app.config.update, PROFILE_SECRET=None,
+                        MEMORY_PROFILE=False)
+        self.addCleanup(service.memory_profiler.stop)
+        resp = self.app.get('/debug/memory', headers={'X-Profile': 'wrong'})
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+
+        admin = {'X-Profile': 's3cr3t'}
+        resp = self.app.post('/debug/memory/snapshot', headers=admin)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertTrue(data['tracing'])
+        self.assertGreater(data['rss_bytes'], 0)
+        self.assertNotIn('diff', data)
+        self._create_inventories(3)
+        self.app.get('/inventory')
+        resp = self.app.post('/debug/memory/snapshot?limit=5', headers=admin)
+        data = resp.get_json()
+        self.assertEqual(len(data['top']), 5)
+        self.assertIn('size_diff_bytes', data['diff'][0])
+        stats = data['endpoints']['GET inventory_collection']
+        self.assertEqual(stats['requests'], 1)
+        if service.memory_profiler.request_peaks:
+            self.assertGreater(stats['max_allocated_bytes'], 0)
+        # no peaks where tracemalloc can't reset them
+        profiler = MemoryProfiler()
+        profiler.request_peaks = False
+        profiler.request_finished('GET index', profiler.request_started())
+        self.assertNotIn('max_allocated_bytes',
+                         profiler.endpoint_report()['GET index'])
+        resp = self.app.post('/debug/memory/snapshot?group-by=module',
+                             headers=admin)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with patch('service.service.threading.Thread') as thread, \
+                patch.object(app.logger, 'warning') as warning:
+            service.log_memory_snapshot(signal.SIGUSR2, None)
+            thread.call_args[1]['target']()
+        self.assertIn('Memory snapshot', warning.call_args[0][0])
+
+    def test_profile_request(self):
+        """ Profile a request that presents the secret """
+        self._create_inventories(3)
+        client = Client(ProfilerMiddleware(app.wsgi_app, 's3cr3t',
+                                           interval=0.0005), BaseResponse)
+        resp = client.get('/inventory', headers={'X-Profile': 'wrong'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 3)
+
+        resp = client.get('/inventory', headers={'X-Profile': 's3cr3t'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['X-Profiled-Status'], '200 OK')
+        report = resp.get_data(as_text=True)
+        self.assertIn('cumulative', report)
+        self.assertIn('models.py', report)
+
+        resp = client.get('/inventory', headers={
+            'X-Profile': 's3cr3t', 'X-Profile-Format': 'collapsed'})
+        self.assertRegex(resp.get_data(as_text=True), r'^\S+;\S+ \d+\n')
+        resp = client.get('/inventory', headers={
+            'X-Profile': 's3cr3t', 'X-Profile-Format': 'svg'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        client = Client(ProfilerMiddleware(app.wsgi_app, 's3cr3t',
+                                           directory=directory), BaseResponse)
+        resp = client.get('/inventory', headers={'X-Profile': 's3cr3t'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 3)
+        self.assertTrue(os.path.isfile(resp.headers['X-Profile-File']))
+
+        # the streamed responses go through unprofiled and unbuffered
+        resp = client.get('/inventory/export', headers={'X-Profile': 's3cr3t'})
+        self.assertEqual(resp.headers['X-Profile-Skipped'],
+                         'streamed response')
+        self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 3)
+        events = iter([b'data: 1\n\n'])
+
+        def stream(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/event-stream')])
+            return events
+        started = []
+        app_iter = ProfilerMiddleware(stream, 's3cr3t')(
+            {'HTTP_X_PROFILE': 's3cr3t'},
+            lambda *args: started.append(args) or started.append)
+        self.assertIs(app_iter, events)
+        self.assertEqual(started[0][0], '200 OK')
+
     def test_disable_inventory(self):
         """ Disable an existing Inventory """
         # create inventories to update
@@ -408,6 +675,411 @@ class TestInventoryServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
 
+    def test_lookup_inventory(self):
+        """ Lookup a batch of Inventory by ids and product ids """
+        inventories = self._create_inventories(3)
+        Inventory(product_id=99, quantity=1, restock_level=2,
+                  condition='used', available=True).save()
+        ids = [inventories[2].id, 'nonexist', inventories[0].id,
+               inventories[2].id]
+        resp = self.app.post('/inventory/_lookup',
+                             json={'ids': ids, 'product_ids': [99]},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 5)
+        self.assertEqual([row['_id'] for row in data[:4]], ids)
+        self.assertEqual(data[0]['quantity'], inventories[2].quantity)
+        self.assertEqual(data[1]['error'], 'not_found')
+        self.assertEqual(data[3], data[0])
+        self.assertEqual(data[4]['product_id'], 99)
+        # bad payloads
+        resp = self.app.post('/inventory/_lookup', json={'ids': 'abc'},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/inventory/_lookup',
+                             json={'product_ids': ['1']},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/inventory/_lookup', json=[1],
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_ndjson(self):
+        """ Import Inventory from a streamed NDJSON body """
+        lines = [json.dumps(InventoryFactory().serialize()) for _ in range(5)]
+        lines[1] = '{"product_id": 1, "quantity": "many"'
+        lines[3] = json.dumps({'product_id': 1, 'quantity': 1,
+                               'restock_level': 1, 'condition': 'broken',
+                               'available': True})
+        body = '\n'.join(lines[:4]) + '\n\n' + lines[4] + '\n'
+        resp = self.app.post('/inventory/import', data=body,
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        summary = resp.get_json()
+        self.assertEqual(summary['lines'], 5)
+        self.assertEqual(summary['created'], 3)
+        self.assertEqual(summary['failed'], 2)
+        self.assertEqual([error['line'] for error in summary['errors']],
+                         [2, 4])
+        self.assertIn('Invalid JSON', summary['errors'][0]['error'])
+        self.assertIn('new/open_box/used', summary['errors'][1]['error'])
+        self.assertEqual(self.get_inventory_count(), 3)
+        resp = self.app.post('/inventory/import', data=body,
+                             content_type='application/json')
+        self.assertEqual(resp.status_code,
+                         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_import_csv(self):
+        """ Import Inventory from a CSV body """
+        body = ('condition,product_id,quantity,restock_level,available\n'
+                'new,1,10,5,true\n'
+                'used,2,x,5,false\n'
+                'open_box,3,1,5,maybe\n'
+                'used,4,0,2,FALSE\n')
+        resp = self.app.post('/inventory/import', data=body,
+                             content_type='text/csv; charset=utf-8')
+        summary = resp.get_json()
+        self.assertEqual(summary['created'], 2)
+        self.assertEqual([error['line'] for error in summary['errors']],
+                         [3, 4])
+        inventory = Inventory.find_by_product_id(4)[0]
+        self.assertEqual(inventory.available, False)
+        resp = self.app.post('/inventory/import', data='product_id\n1\n',
+                             content_type='text/csv')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('missing quantity', resp.get_json()['message'])
+
+    def test_import_upsert(self):
+        """ Import Inventory replacing the ones with the same natural key """
+        def row(product_id, quantity, condition='new'):
+            return json.dumps({'product_id': product_id, 'quantity': quantity,
+                               'restock_level': 1, 'condition': condition,
+                               'available': True}) + '\n'
+        resp = self.app.post('/inventory/import?upsert=true', data=row(1, 1),
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        Inventory.natural_keys = True
+        self.addCleanup(setattr, Inventory, 'natural_keys', False)
+        resp = self.app.post('/inventory/import', data=row(1, 1) + row(2, 2),
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.get_json()['created'], 2)
+        # without upsert, existing keys fail
+        resp = self.app.post('/inventory/import', data=row(1, 5),
+                             content_type='application/x-ndjson')
+        self.assertIn('1:new already exists',
+                      resp.get_json()['errors'][0]['error'])
+        body = row(1, 7) + row(3, 3) + row(3, 4) + row(2, 9, 'used')
+        resp = self.app.post('/inventory/import?upsert=true', data=body,
+                             content_type='application/x-ndjson')
+        summary = resp.get_json()
+        self.assertEqual((summary['created'], summary['updated'],
+                          summary['failed']), (2, 2, 0))
+        self.assertEqual(Inventory.find('1:new').quantity, 7)
+        self.assertEqual(Inventory.find('3:new').quantity, 4)
+        self.assertEqual(self.get_inventory_count(), 4)
+
+    def test_update_after_import_upsert(self):
+        """ Update an Inventory an upsert import replaced """
+        Inventory.natural_keys = True
+        self.addCleanup(setattr, Inventory, 'natural_keys', False)
+        inventory = {'product_id': 1, 'quantity': 1, 'restock_level': 1,
+                     'condition': 'new', 'available': True}
+        resp = self.app.post('/inventory', json=inventory,
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        inventory_id = resp.get_json()['_id']
+        resp = self.app.post('/inventory/import?upsert=true',
+                             data=json.dumps(dict(inventory, quantity=5)),
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.get_json()['updated'], 1)
+        resp = self.app.put('/inventory/{}'.format(inventory_id),
+                            json=dict(inventory, quantity=9),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(Inventory.find(inventory_id).quantity, 9)
+
+    @patch('service.models.EXPORT_PAGE_SIZE', 2)
+    def test_export(self):
+        """ Stream every Inventory page by page and resume an export """
+        inventories = self._create_inventories(5)
+        ids = sorted(inventory.id for inventory in inventories)
+        resp = self.app.get('/inventory/export')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertTrue(resp.headers['X-Update-Seq'])
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([row['_id'] for row in rows], ids)
+        self.assertEqual(set(rows[0]), {'_id', 'product_id', 'quantity',
+                                        'restock_level', 'condition',
+                                        'available'})
+        resp = self.app.get('/inventory/export?after={}'.format(ids[2]))
+        self.assertEqual([json.loads(line)['_id'] for line
+                          in resp.data.splitlines()], ids[3:])
+
+        resp = self.app.get('/inventory/export?format=csv')
+        self.assertEqual(resp.mimetype, 'text/csv')
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], '_id,product_id,quantity,restock_level,'
+                                   'condition,available')
+        self.assertEqual(len(lines), 6)
+        # an export imports again
+        Inventory.remove_all()
+        resp = self.app.post('/inventory/import', data=resp.data,
+                             content_type='text/csv')
+        self.assertEqual(resp.get_json()['created'], 5)
+
+        resp = self.app.get('/inventory/export?format=xml')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/inventory/export?since=0&after=x')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch('service.models.EXPORT_PAGE_SIZE', 2)
+    def test_export_changes(self):
+        """ Stream the Inventory changed since a previous export """
+        inventories = self._create_inventories(3)
+        since = self.app.get('/inventory/export').headers['X-Update-Seq']
+        resp = self.app.get('/inventory/export?since={}'.format(since))
+        self.assertEqual(resp.data, b'')
+        inventories[0].quantity = 1000
+        self.app.put('/inventory/{}'.format(inventories[0].id),
+                     json=inventories[0].serialize())
+        self.app.delete('/inventory/{}'.format(inventories[1].id))
+        new = self._create_inventories(1)[0]
+        resp = self.app.get('/inventory/export?since={}'.format(since))
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([row['_id'] for row in rows],
+                         [inventories[0].id, inventories[1].id, new.id])
+        self.assertEqual(rows[0]['quantity'], 1000)
+        self.assertEqual(rows[1], {'_id': inventories[1].id,
+                                   '_deleted': True,
+                                   '_seq': rows[1]['_seq']})
+        # resume after the first row
+        resp = self.app.get('/inventory/export?format=csv&since={}'
+                            .format(rows[0]['_seq']))
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertTrue(lines[0].endswith('_deleted,_seq'))
+        self.assertTrue(lines[1].startswith(inventories[1].id + ',,'))
+        self.assertEqual(len(lines), 3)
+        resp = self.app.get('/inventory/export?since=1,2')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_changes(self):
+        """ List the changes of Inventory since a sequence """
+        resp = self.app.get('/inventory/changes?since=now')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        inventories = self._create_inventories(3)
+        resp = self.app.get('/inventory/changes?since={}'
+                            .format(resp.get_json()['last_seq']))
+        data = resp.get_json()
+        self.assertEqual([change['id'] for change in data['results']],
+                         [inventory.id for inventory in inventories])
+        self.assertEqual(data['results'][0]['inventory']['quantity'],
+                         inventories[0].quantity)
+        self.assertEqual(data['pending'], 0)
+        since = data['last_seq']
+        resp = self.app.get('/inventory/changes?since={}'.format(since))
+        self.assertEqual(resp.get_json()['results'], [])
+        self.app.delete('/inventory/{}'.format(inventories[1].id))
+        new = self._create_inventories(1)[0]
+        resp = self.app.get('/inventory/changes?limit=1&since={}'
+                            .format(since))
+        data = resp.get_json()
+        self.assertEqual(data['results'], [{
+            'seq': data['last_seq'], 'id': inventories[1].id,
+            'deleted': True, 'inventory': None}])
+        self.assertEqual(data['pending'], 1)
+        resp = self.app.get('/inventory/changes?since={}'
+                            .format(data['last_seq']))
+        self.assertEqual([change['id'] for change in
+                          resp.get_json()['results']], [new.id])
+        resp = self.app.get('/inventory/changes?since=1,2')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/inventory/changes?feed=continuous')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_changes_longpoll(self):
+        """ Long poll the changes of Inventory """
+        resp = self.app.get('/inventory/changes?since=now&feed=longpoll'
+                            '&timeout=0.1')
+        data = resp.get_json()
+        self.assertEqual(data['results'], [])
+        since = data['last_seq']
+        inventory = InventoryFactory()
+        writer = threading.Timer(0.2, inventory.create)
+        writer.start()
+        self.addCleanup(writer.join)
+        resp = self.app.get('/inventory/changes?feed=longpoll&timeout=10'
+                            '&since={}'.format(since))
+        data = resp.get_json()
+        self.assertEqual([change['id'] for change in data['results']],
+                         [inventory.id])
+
+    def test_events(self):
+        """ Stream the changes of Inventory as Server-Sent Events """
+        hub = ChangeHub(poll_timeout=0.2)
+        for name, value in (('hub', hub), ('event_streams',
+                                           threading.BoundedSemaphore(1))):
+            patcher = patch.object(service, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(app.config.update,
+                        EVENTS_DURATION=app.config['EVENTS_DURATION'])
+        app.config['EVENTS_DURATION'] = 1
+        inventory = InventoryFactory(quantity=1, restock_level=5,
+                                     available=True)
+        writer = threading.Timer(0.3, inventory.create)
+        writer.start()
+        self.addCleanup(writer.join)
+        resp = self.app.get('/inventory/events?restock=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        body = resp.get_data(as_text=True)
+        resp.close()  # as the server does when the stream ends
+        self.assertNotIn('Content-Encoding', resp.headers)
+        events = [event.splitlines() for event in body.split('\n\n')
+                  if 'event: ' in event]
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0][1], 'event: create')
+        data = json.loads(events[0][2][len('data: '):])
+        self.assertEqual(data['_id'], inventory.id)
+        self.assertEqual(data['inventory']['quantity'], 1)
+        # reconnect after the creation: the disable is replayed
+        last_event_id = events[0][0][len('id: '):]
+        self.app.put('/inventory/{}/disable'.format(inventory.product_id))
+        app.config['EVENTS_DURATION'] = 0
+        resp = self.app.get('/inventory/events',
+                            headers={'Last-Event-ID': last_event_id})
+        body = resp.get_data(as_text=True)
+        resp.close()
+        self.assertIn('"available": false', body)
+        resp = self.app.get('/inventory/events?restock=maybe')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # the streams that ended gave their slot back, an open one keeps it
+        self.assertTrue(service.event_streams.acquire(blocking=False))
+        resp = self.app.get('/inventory/events')
+        self.assertEqual(resp.status_code,
+                         status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_restock_webhooks(self):
+        """ POST the restock crossings of the writes to the webhooks """
+        receiver = WebhookReceiver()
+        self.addCleanup(receiver.stop)
+        dispatcher = WebhookDispatcher([receiver.url], batch_interval=0.1)
+        patcher = patch.object(Inventory, 'restock_listeners',
+                               [dispatcher.send])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        inventory = InventoryFactory(quantity=50, restock_level=10)
+        resp = self.app.post('/inventory', json=inventory.serialize())
+        inventory.id = resp.get_json()['_id']
+        inventory.quantity = 9
+        resp = self.app.put('/inventory/{}'.format(inventory.id),
+                            json=inventory.serialize())
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        inventory.quantity = 10
+        self.app.put('/inventory/{}'.format(inventory.id),
+                     json=inventory.serialize())
+        self.assertTrue(dispatcher.flush(5))
+        events = receiver.events()
+        self.assertEqual([event['crossing'] for event in events],
+                         ['below', 'above'])
+        self.assertEqual(events[-1]['inventory_id'], inventory.id)
+
+    def test_create_inventory_natural_key_conflict(self):
+        """ Create an Inventory twice with natural keys """
+        Inventory.natural_keys = True
+        self.addCleanup(setattr, Inventory, 'natural_keys', False)
+        test_inventory = {"product_id": 2, "quantity": 100,
+                          "restock_level": 40, "condition": 'new',
+                          "available": True}
+        resp = self.app.post('/inventory', json=test_inventory,
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.get_json()['_id'], '2:new')
+        resp = self.app.post('/inventory', json=test_inventory,
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+    def test_read_your_writes_cookie(self):
+        """ Writes pin the client's reads to the primary with a cookie """
+        Inventory.init_db("test", replica_url=Inventory.client.server_url)
+        self.addCleanup(Inventory.init_db, "test")
+        test_inventory = InventoryFactory()
+        resp = self.app.post('/inventory',
+                             json=test_inventory.serialize(),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIn('read-primary-until', resp.headers['Set-Cookie'])
+        with patch.object(Inventory.replica_of(Inventory.database),
+                          'all_docs') as replica:
+            resp = self.app.get('/inventory')
+            self.assertEqual(len(resp.get_json()), 1)
+            replica.assert_not_called()
+        # a client can't pin itself for longer than a write does
+        self.app.set_cookie('localhost', 'read-primary-until', '1e12')
+        resp = self.app.get('/inventory')
+        until = float(resp.headers['Set-Cookie'].split(';')[0].split('=')[1])
+        self.assertLessEqual(until, time.time() + READ_YOUR_WRITES)
+
+    def test_collection_cache(self):
+        """ Serve repeated list queries from the response cache """
+        patcher = patch.object(service.collection_cache, 'max_bytes',
+                               1024 * 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self._create_inventories(2)
+        resp = self.app.get('/inventory?available=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['X-Cache'], 'MISS')
+        resp = self.app.get('/inventory?available=TRUE')
+        self.assertEqual(resp.headers['X-Cache'], 'HIT')
+        self.assertEqual(resp.get_json(), self.app.get(
+            '/inventory?available=true').get_json())
+        # a write changes the version
+        count = len(self.app.get('/inventory').get_json())
+        self._create_inventories(1)
+        resp = self.app.get('/inventory')
+        self.assertEqual(resp.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(resp.get_json()), count + 1)
+        resp = self.app.get('/inventory', headers={'X-Fields': 'quantity'})
+        self.assertNotIn('X-Cache', resp.headers)
+        # the reads pinned to the primary after a write skip it too
+        self.app.set_cookie('localhost', service.READ_PRIMARY_COOKIE,
+                            str(time.time() + 60))
+        resp = self.app.get('/inventory')
+        self.assertNotIn('X-Cache', resp.headers)
+
+    def test_collection_cache_replica(self):
+        """ Version the cached responses by the replica they are read from """
+        replica = CouchDBStandin(('127.0.0.1', 0))
+        replica.start()
+        self.addCleanup(replica.server_close)
+        self.addCleanup(replica.shutdown)
+        urlopen(Request(replica.url + 'test', method='PUT'))
+        # the first request of the app opens the database without replica
+        self.app.get('/healthcheck')
+        Inventory.init_db("test", replica_url=replica.url)
+        self.addCleanup(Inventory.init_db, "test")
+        for name, value in (('max_bytes', 1024 * 1024), ('seq_interval', 0)):
+            patcher = patch.object(service.collection_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        inventory = Inventory(product_id=1, quantity=10, restock_level=5,
+                              condition="new", available=True)
+        inventory.create()
+        # the replica has not received the write yet
+        resp = self.app.get('/inventory')
+        self.assertEqual(resp.headers['X-Cache'], 'MISS')
+        self.assertEqual(resp.get_json(), [])
+        self.assertEqual(self.app.get('/inventory').headers['X-Cache'],
+                         'HIT')
+        Inventory.replica_of(Inventory.database).create_document(
+            inventory.serialize())
+        resp = self.app.get('/inventory')
+        self.assertEqual(resp.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(resp.get_json()), 1)
+
     def test_delete_inventory(self):
         """ Delete an inventory """
         inventory = self._create_inventories(2)[0]
@@ -0,0 +1,118 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Test cases for the single-flight reads
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import threading
+import time
+import unittest
+from service.singleflight import SingleFlight, DB_READS, \
+    DB_READS_COALESCED, coalescing_ratio
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSingleFlight(unittest.TestCase):
+    """ Test Cases for SingleFlight """
+
+    def setUp(self):
+        DB_READS.reset()
+        DB_READS_COALESCED.reset()
+        self.flight = SingleFlight(copy=list)
+        self.release = threading.Event()
+        self.calls = 0
+
+    def read(self, result=None, error=None):
+        """ A read that waits for self.release """
+        self.calls += 1
+        self.release.wait(5)
+        if error is not None:
+            raise error
+        return result
+
+    def run_threads(self, count, func):
+        """ Calls func in count threads, returns their results in order """
+        results = [None] * count
+
+        def call(number):
+            try:
+                results[number] = func()
+            except ValueError as error:
+                results[number] = error
+        threads = [threading.Thread(target=call, args=(number,))
+                   for number in range(count)]
+        for thread in threads:
+            thread.start()
+            # let each thread reach the flight before the next one
+            time.sleep(0.02)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_coalesce(self):
+        """ Share one call between identical calls in flight """
+        results = self.run_threads(3, lambda: self.flight.do(
+            'key', lambda: self.read(['a']), 'find'))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [['a'], ['a'], ['a']])
+        # the followers get copies
+        self.assertIsNot(results[0], results[1])
+        self.assertIsNot(results[1], results[2])
+        self.assertEqual(DB_READS.value(operation='find', flight='leader'),
+                         1)
+        self.assertAlmostEqual(coalescing_ratio('find'), 2 / 3)
+        self.assertAlmostEqual(DB_READS_COALESCED.value(operation='find'),
+                               2 / 3)
+        # a call after the flight ran runs again
+        self.assertEqual(self.flight.do('key', lambda: self.read(['b'])),
+                         ['b'])
+        self.assertEqual(self.calls, 2)
+
+    def test_errors(self):
+        """ Share the exception of the call """
+        error = ValueError('down')
+        results = self.run_threads(2, lambda: self.flight.do(
+            'key', lambda: self.read(error=error)))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [error, error])
+
+    def test_coalesce_decorator(self):
+        """ Key the calls by their arguments, unless bypassed """
+        bypass = threading.Event()
+        flight = SingleFlight(bypass=bypass.is_set)
+
+        class Model():
+            """ Stands in for Inventory """
+            @classmethod
+            @flight.coalesce('find_by')
+            def find_by(cls, **kwargs):
+                """ Counts the reads """
+                return self.read(kwargs)
+        results = self.run_threads(4, lambda: Model.find_by(
+            product_id={'$in': [1, 2]}, available=True))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results[0], results[3])
+        self.release.clear()
+        self.run_threads(2, lambda: Model.find_by(
+            product_id=len(results)))
+        self.assertEqual(self.calls, 2)
+        bypass.set()
+        self.run_threads(2, lambda: Model.find_by(product_id=1))
+        self.assertEqual(self.calls, 4)
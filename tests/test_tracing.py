@@ -0,0 +1,88 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Test cases for request tracing
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+from unittest.mock import MagicMock
+from service.tracing import Tracer, parse_traceparent, span, traced, \
+    current_span
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+class TestTracing(unittest.TestCase):
+    """ Test Cases for the request tracer """
+
+    def test_parse_traceparent(self):
+        """ Parse W3C traceparent headers """
+        header = '00-{}-{}-{}'
+        self.assertEqual(parse_traceparent(
+            header.format(TRACE_ID, PARENT_ID, '01')),
+                         (TRACE_ID, PARENT_ID, True))
+        self.assertFalse(parse_traceparent(
+            header.format(TRACE_ID, PARENT_ID, '00'))[2])
+        for invalid in (None, '', 'garbage',
+                        header.format('0' * 32, PARENT_ID, '01'),
+                        header.format(TRACE_ID, 'z' * 16, '01'),
+                        header.format(TRACE_ID, PARENT_ID, '01') + '-extra',
+                        'ff' + header.format(TRACE_ID, PARENT_ID, '01')[2:]):
+            self.assertIsNone(parse_traceparent(invalid))
+
+    def test_sampling(self):
+        """ Trace only the sampled requests """
+        exporter = MagicMock()
+        self.assertIsNone(Tracer(None).start_trace('GET /'))
+        self.assertIsNone(Tracer(exporter, 0.0).start_trace('GET /'))
+        self.assertIsNotNone(Tracer(exporter, 1.0).start_trace('GET /'))
+        # the caller's sampling decision wins
+        self.assertIsNotNone(Tracer(exporter, 0.0).start_trace(
+            'GET /', '00-{}-{}-01'.format(TRACE_ID, PARENT_ID)))
+
+    def test_child_spans(self):
+        """ Nest child spans under the active span and export them """
+        exporter = MagicMock()
+        tracer = Tracer(exporter)
+
+        @traced('work')
+        def work():
+            return current_span().name
+
+        self.assertEqual(work.__name__, 'work')
+        with span('untraced') as ignored:
+            ignored.set('key', 'value')
+        root = tracer.start_trace('GET /inventory')
+        with root:
+            self.assertEqual(work(), 'work')
+            with span('couchdb GET', **{'http.method': 'GET'}) as call:
+                call.event('retry', delay=1)
+        self.assertIsNone(current_span())
+        tracer.finish(root)
+        spans = exporter.export.call_args[0][0]
+        self.assertEqual([item.name for item in spans],
+                         ['work', 'couchdb GET', 'GET /inventory'])
+        self.assertEqual({item.parent_id for item in spans[:2]},
+                         {root.span_id})
+        record = spans[1].to_dict()
+        self.assertEqual(record['trace_id'], root.trace.trace_id)
+        self.assertEqual(record['events'][0]['name'], 'retry')
+        self.assertEqual(record['attributes'], {'http.method': 'GET'})
@@ -0,0 +1,135 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Test cases for the restock webhooks
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from service.webhooks import WebhookDispatcher, sign
+
+######################################################################
+#  W E B H O O K   R E C E I V E R
+######################################################################
+class WebhookReceiver(HTTPServer):
+    """ A local HTTP server that records the webhooks POSTed to it """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ReceiverHandler)
+        self.requests = []  # (headers, body)
+        self.statuses = []  # statuses to answer before 204s
+        self.url = 'http://127.0.0.1:{}/hook'.format(self.server_port)
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stops serving """
+        self.shutdown()
+        self.server_close()
+
+    def events(self):
+        """ Returns the events of the successful requests """
+        return [event for headers, body in self.requests
+                if headers.get('X-Status') == '204'
+                for event in json.loads(body)['events']]
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    """ Records a request, answers with the next status """
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Handles a webhook """
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status = self.server.statuses.pop(0) if self.server.statuses \
+            else 204
+        headers = dict(self.headers, **{'X-Status': str(status)})
+        self.server.requests.append((headers, body))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+def event(number, crossing='below'):
+    """ Returns a restock event """
+    return {'id': 'a:{}-x'.format(number), 'crossing': crossing,
+            'inventory_id': 'a', 'product_id': 1, 'condition': 'new',
+            'quantity': number, 'restock_level': 5}
+
+class TestWebhooks(unittest.TestCase):
+    """ Test Cases for WebhookDispatcher """
+
+    def setUp(self):
+        self.receiver = WebhookReceiver()
+        self.addCleanup(self.receiver.stop)
+        self.dispatcher = WebhookDispatcher([self.receiver.url],
+                                            batch_interval=0.1,
+                                            retry_delay=0.01)
+
+    def test_batches(self):
+        """ POST the queued events in batches """
+        self.dispatcher.batch_size = 2
+        for number in range(3):
+            self.dispatcher.send(event(number))
+        self.assertTrue(self.dispatcher.flush(5))
+        self.assertEqual([len(json.loads(body)['events'])
+                          for _, body in self.receiver.requests], [2, 1])
+        self.assertEqual([item['quantity'] for item in
+                          self.receiver.events()], [0, 1, 2])
+
+    def test_dedup(self):
+        """ Send an event once """
+        self.dispatcher.send(event(1))
+        self.dispatcher.send(event(1))
+        self.dispatcher.send(event(2, 'above'))
+        self.dispatcher.flush(5)
+        self.assertEqual([item['id'] for item in self.receiver.events()],
+                         ['a:1-x', 'a:2-x'])
+
+    def test_retries(self):
+        """ Retry the failed deliveries, not the rejected ones """
+        self.receiver.statuses = [503, 503]
+        self.dispatcher.send(event(1))
+        self.dispatcher.flush(5)
+        self.assertEqual(len(self.receiver.requests), 3)
+        self.assertEqual(len(self.receiver.events()), 1)
+        self.receiver.statuses = [400]
+        self.dispatcher.send(event(2))
+        self.dispatcher.flush(5)
+        self.assertEqual(len(self.receiver.requests), 4)
+        self.assertEqual(len(self.receiver.events()), 1)
+        # an unreachable URL gives up after max_attempts
+        self.dispatcher.urls.append('http://127.0.0.1:1/hook')
+        self.dispatcher.max_attempts = 2
+        self.dispatcher.send(event(3))
+        self.assertTrue(self.dispatcher.flush(5))
+        self.assertEqual(len(self.receiver.events()), 2)
+
+    def test_signature(self):
+        """ Sign the bodies with the secret """
+        self.dispatcher.secret = 's3cr3t'
+        self.dispatcher.send(event(1))
+        self.dispatcher.flush(5)
+        headers, body = self.receiver.requests[0]
+        self.assertEqual(headers['X-Inventory-Signature'],
+                         sign('s3cr3t', body))